@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Mergeable aggregates of archived data.
+#
+# An AggregateState holds, for every group (e.g. every NanoPi, direction and hour of day),
+# the count, mean, sum of squared deviations from the mean (M2), minimum and maximum of the
+# values, plus a quantile sketch. States computed on separate parts of the data can be merged,
+# and the merged state gives the same count, mean, variance, minimum and maximum as computing
+# over all of the data at once (up to rounding), and percentiles to within a fixed relative
+# error. This means that the work can be split over processes (or machines, by saving states
+# to files and merging them), and that new data can be added to a saved state without
+# recomputing it from scratch.
+#
+# Means and M2 are merged with Chan et al.'s parallel algorithm rather than kept as sums of
+# values and of squares, which would lose most of their precision for large values that vary
+# little, such as bandwidths in bits per second.
+#
+# The quantile sketch is a DDSketch: values are counted in logarithmically sized bins, so that
+# the estimate of every value is within relative_accuracy of it. quantile(...) interpolates
+# between the two values nearest the quantile, as pandas does, so for values of zero or more
+# every percentile is within relative_accuracy of pandas' (negative values count as zero).
+
+import argparse
+import math
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+import archive
+import instrument
+import outofcore
+
+
+RELATIVE_ACCURACY = 0.01
+
+# values of zero (or less) all go into this bin
+ZERO_BIN = np.iinfo(np.int32).min
+
+
+class AggregateState:
+    """Count, mean, M2, min, max and a quantile sketch of values for each group.
+
+    Build one with AggregateState.from_values(...) or compute(...) rather than directly.
+
+    Arguments:
+    by - a list of the names of the keys the values are grouped by
+    moments - a dataframe indexed by the groups, with 'count', 'mean', 'm2' (the sum of squared
+              deviations from the mean), 'min' and 'max' columns
+    sketch - a series of counts indexed by the groups plus a 'bin' level
+    relative_accuracy - the relative accuracy of the sketch
+    """
+
+    def __init__(self, by, moments, sketch, relative_accuracy=RELATIVE_ACCURACY):
+        self.by = list(by)
+        self.moments = moments
+        self.sketch = sketch
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+
+    @classmethod
+    def empty(cls, by, relative_accuracy=RELATIVE_ACCURACY):
+        """Returns a state with no values, which merges with anything."""
+        index = pd.MultiIndex.from_arrays([[] for _ in by], names=by)
+        moments = pd.DataFrame({'count': [], 'mean': [], 'm2': [], 'min': [], 'max': []}, index=index)
+        sketch_index = pd.MultiIndex.from_arrays([[] for _ in range(len(by) + 1)], names=by + ['bin'])
+        return cls(by, moments, pd.Series([], index=sketch_index, dtype=np.int64), relative_accuracy)
+
+    @classmethod
+    def from_values(cls, values, keys, relative_accuracy=RELATIVE_ACCURACY):
+        """Computes the state of a set of values.
+
+        Arguments:
+        values - a pandas series of values; NaN values are ignored
+        keys - a list of named pandas series (or arrays) to group the values by, aligned with values
+        relative_accuracy - the relative accuracy of the quantile sketch
+        """
+        by = [key.name for key in keys]
+        present = values.notna().values
+        values = values.loc[present]
+        keys = [pd.Series(np.asarray(key)[present], name=name, index=values.index) for key, name in zip(keys, by)]
+        if not len(values):
+            return cls.empty(by, relative_accuracy)
+        grouped = values.groupby(keys)
+        # deviations from the mean of each group, rather than the values themselves, are squared
+        deviations = values - grouped.transform('mean')
+        moments = pd.DataFrame({'count': grouped.count(),
+                                'mean': grouped.mean(),
+                                'm2': (deviations ** 2).groupby(keys).sum(),
+                                'min': grouped.min(),
+                                'max': grouped.max()})
+
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bins = np.ceil(np.log(values.values) / math.log(gamma))
+        bins = np.where(values.values > 0, bins, ZERO_BIN).astype(np.int32)
+        sketch = values.groupby(keys + [pd.Series(bins, name='bin', index=values.index)]).count()
+        return cls(by, moments, sketch, relative_accuracy)
+
+    def merge(self, other):
+        """Returns a new state combining the values of this state and another."""
+        if self.by != other.by or self.relative_accuracy != other.relative_accuracy:
+            raise ValueError("can only merge states with the same groups and accuracy")
+        return merge_all([self, other])
+
+    def count(self):
+        return self.moments.loc[:, 'count']
+
+    def mean(self):
+        return self.moments.loc[:, 'mean']
+
+    def var(self, ddof=1):
+        return self.moments.loc[:, 'm2'] / (self.moments.loc[:, 'count'] - ddof)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.var(ddof))
+
+    def min(self):
+        return self.moments.loc[:, 'min']
+
+    def max(self):
+        return self.moments.loc[:, 'max']
+
+    def quantile(self, q):
+        """Returns the estimated q-quantile (0 <= q <= 1) of each group, e.g. q=0.95 for the 95th percentile.
+
+        Like pandas' default, the quantile is interpolated between the values at the ranks on
+        either side of q * (count - 1).
+        """
+        sketch = self.sketch.sort_index()
+        groups = sketch.index.droplevel('bin')
+        cumulative = sketch.groupby(level=self.by).cumsum().values
+        totals = self.count().reindex(groups).values
+        position = q * (totals - 1)
+        lower = np.floor(position)
+
+        def value_at(rank):
+            # the estimate of the value at a rank (from 0) is that of the first bin holding more values than the rank
+            reached = pd.Series(cumulative > rank, index=sketch.index)
+            first = reached.groupby(level=self.by).idxmax()
+            bins = np.array([key[-1] for key in first.values], dtype=np.int64)
+            estimates = np.where(bins == ZERO_BIN, 0.0,
+                                 2 * np.power(self.gamma, bins.astype(float)) / (self.gamma + 1))
+            return pd.Series(estimates, index=first.index)
+
+        below = value_at(lower)
+        above = value_at(np.minimum(lower + 1, totals - 1))
+        fraction = pd.Series(position - lower, index=groups).groupby(level=self.by).first()
+        result = below + (above - below) * fraction.reindex(below.index)
+        # the estimate can't be outside the range of the values
+        return result.clip(lower=self.min().reindex(result.index), upper=self.max().reindex(result.index))
+
+    def save(self, path):
+        """Saves the state to a file, e.g. to merge it with states computed elsewhere."""
+        pd.to_pickle({'by': self.by, 'moments': self.moments, 'sketch': self.sketch,
+                      'relative_accuracy': self.relative_accuracy}, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a state saved with save(...)."""
+        data = pd.read_pickle(path)
+        moments = data['moments']
+        if 'sumsq' in moments.columns:
+            # saved with sums of values and of squares, whose variance is only as precise as they are
+            count = moments.loc[:, 'count']
+            mean = moments.loc[:, 'sum'] / count
+            moments = pd.DataFrame({'count': count, 'mean': mean,
+                                    'm2': (moments.loc[:, 'sumsq'] - count * mean ** 2).clip(lower=0),
+                                    'min': moments.loc[:, 'min'], 'max': moments.loc[:, 'max']})
+        return cls(data['by'], moments, data['sketch'], data['relative_accuracy'])
+
+
+def merge_all(states):
+    """Merges any number of states with the same groups into one."""
+    states = list(states)
+    first = states[0]
+    parts = pd.concat([state.moments for state in states])
+    grouped = parts.groupby(level=first.by)
+    moments = grouped.agg({'count': 'sum', 'min': 'min', 'max': 'max'})
+    # Chan et al.: the merged mean is the mean of the parts' means weighted by their counts, and the
+    # merged M2 adds each part's count times the squared distance of its mean from the merged mean
+    weighted = (parts.loc[:, 'count'] * parts.loc[:, 'mean']).groupby(level=first.by).sum()
+    moments['mean'] = weighted / moments.loc[:, 'count']
+    offsets = parts.loc[:, 'mean'] - moments.loc[:, 'mean'].reindex(parts.index).values
+    moments['m2'] = grouped['m2'].sum() + (parts.loc[:, 'count'] * offsets ** 2).groupby(level=first.by).sum()
+    moments = moments.loc[:, ['count', 'mean', 'm2', 'min', 'max']]
+    sketch = pd.concat([state.sketch for state in states]).groupby(level=first.by + ['bin']).sum()
+    return AggregateState(first.by, moments, sketch, first.relative_accuracy)
+
+
+def _compute_partition(task):
+    metric, directory, by, first, last, chunk_size, relative_accuracy = task
+    arch = archive.Archive(metric, directory)
+    states = []
+    for position in range(first, last, chunk_size):
+        chunk = outofcore.chunk_frame(arch, position, min(position + chunk_size, last))
+        states.append(AggregateState.from_values(chunk.loc[:, 'value'], outofcore._keys(chunk, by), relative_accuracy))
+    if not states:
+        return AggregateState.empty(by, relative_accuracy)
+    return merge_all(states)
+
+
+def compute(arch, by, start=None, end=None, processes=None, partitions=None,
+            chunk_size=outofcore.CHUNK_SIZE, relative_accuracy=RELATIVE_ACCURACY):
+    """Computes the aggregate state of an archive, splitting the work over a pool of processes.
+
+    Arguments:
+    arch - an archive.Archive
+    by - a list of the keys to group by: any of 'datetime', 'nanopi', 'direction',
+         'hour' (of day) and 'dayofweek'
+    start - the first time to include, or None
+    end - the last time to include, or None
+    processes - the number of worker processes; None means one per CPU, 1 means no pool
+    partitions - the number of parts to split the archive into; defaults to the number of processes
+    chunk_size - the number of records each process handles at a time
+    relative_accuracy - the relative accuracy of the quantile sketch
+    """
+    processes = processes or multiprocessing.cpu_count()
+    partitions = partitions or processes
+    first, last = arch.bounds(start, end)
+    step = max(1, -(-(last - first) // partitions))
+    tasks = [(arch.metric, arch.directory, list(by), position, min(position + step, last),
+              chunk_size, relative_accuracy)
+             for position in range(first, last, step)]
+    with instrument.stage('aggregate.{}.{}'.format(arch.metric, '_'.join(by)), rows_in=last - first) as stage:
+        if processes == 1 or len(tasks) <= 1:
+            states = [_compute_partition(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                states = pool.map(_compute_partition, tasks)
+        state = merge_all(states) if states else AggregateState.empty(list(by), relative_accuracy)
+        stage['rows_out'] = len(state.moments)
+    return state
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Computes aggregate statistics of an archive in parallel.")
+    parser.add_argument('metric', choices=list(outofcore.LABELS))
+    parser.add_argument('by', nargs='*', default=['nanopi'],
+                        help="keys to group by: datetime, nanopi, direction, hour, dayofweek (default: nanopi)")
+    parser.add_argument('-d', dest='directory', default=archive.ARCHIVE_DIR, help="archive directory")
+    parser.add_argument('-p', dest='processes', default=None, type=int, help="number of processes")
+    parser.add_argument('-o', dest='output', default=None, help="save the state to this file")
+    parser.add_argument('-m', dest='merge', action='append', default=[],
+                        help="merge in a state saved earlier; may be repeated")
+    args = parser.parse_args()
+
+    state = compute(archive.Archive(args.metric, args.directory), args.by, processes=args.processes)
+    for path in args.merge:
+        state = state.merge(AggregateState.load(path))
+    if args.output:
+        state.save(args.output)
+    summary = pd.DataFrame({'count': state.count(), 'mean': state.mean(), 'std': state.std(),
+                            'min': state.min(), 'p50': state.quantile(0.5), 'p95': state.quantile(0.95),
+                            'max': state.max()})
+    print(summary.to_string())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Finds unusual measurements in the dataframes produced by the common.get_XX_dataframe(...) functions.
+#
+# The baseline of each NanoPi (and direction) is the median of its measurements at the same
+# hour of day over the whole dataframe, and the spread is the median absolute deviation (MAD)
+# from that median. A measurement is flagged when its robust z-score,
+#     0.6745 * (value - median) / MAD
+# is further from zero than the threshold. Medians and MADs are barely affected by the anomalies
+# themselves, unlike means and standard deviations. Flagged hours that follow each other are
+# then merged into intervals, so an outage of a day shows up as one row rather than 24.
+#
+# Everything is done with grouped pandas operations, so years of data from every NanoPi take
+# seconds. The flags can be drawn on the plot_all(...) plots with anomalies=...
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+import instrument
+
+
+# robust z-scores further from zero than this are anomalies
+THRESHOLD = 3.5
+
+# hours of day with fewer measurements than this get no baseline and are never flagged
+MIN_SAMPLES = 8
+
+# turns a MAD into the equivalent of a standard deviation for normally distributed data
+MAD_SCALE = 0.6745
+
+VALUE_COLUMNS = ['bandwidth', 'jitter', 'latency']
+
+
+def _value_column(df):
+    for column in VALUE_COLUMNS:
+        if column in df.columns:
+            return column
+    raise ValueError("the dataframe has none of the columns {}".format(', '.join(VALUE_COLUMNS)))
+
+
+def _device_levels(index):
+    return [name for name in ['nanopi', 'direction'] if name in index.names]
+
+
+def scores(df, column=None, min_samples=MIN_SAMPLES):
+    """Returns a dataframe of the baseline, MAD and robust z-score of every measurement.
+
+    The dataframe has the same index as df (without the rows that have no value) and the
+    columns 'value', 'baseline', 'mad' and 'score'. Scores are NaN where there is no baseline.
+
+    Arguments:
+    df - a dataframe produced by one of the common.get_XX_dataframe(...) functions
+    column - the column to look at; by default the one of 'bandwidth', 'jitter' and 'latency' that df has
+    min_samples - the fewest measurements an hour of day needs to get a baseline
+    """
+    column = column or _value_column(df)
+    values = df.loc[:, column].dropna()
+    hours = pd.Series(values.index.get_level_values('datetime').hour, index=values.index, name='hour')
+    keys = [values.index.get_level_values(level) for level in _device_levels(values.index)] + [hours]
+
+    grouped = values.groupby(keys)
+    baseline = grouped.transform('median')
+    count = grouped.transform('count')
+    deviation = (values - baseline).abs()
+    mad = deviation.groupby(keys).transform('median')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = MAD_SCALE * (values - baseline) / mad
+    # a MAD of 0 means at least half the values are identical; anything else is an anomaly only if it differs
+    score = score.where(mad > 0, np.where(values == baseline, 0.0, np.sign(values - baseline) * np.inf))
+    score = score.where(count >= min_samples)
+    return pd.DataFrame({'value': values, 'baseline': baseline, 'mad': mad, 'score': score})
+
+
+def detect(df, column=None, threshold=THRESHOLD, min_samples=MIN_SAMPLES):
+    """Returns the anomalous measurements of a dataframe.
+
+    The result has the same index as df and the columns 'value', 'baseline', 'mad', 'score'
+    (see scores(...)) and 'kind', which is 'high' or 'low'.
+
+    Arguments:
+    df - a dataframe produced by one of the common.get_XX_dataframe(...) functions
+    column - the column to look at; by default the one of 'bandwidth', 'jitter' and 'latency' that df has
+    threshold - robust z-scores further from zero than this are anomalies
+    min_samples - the fewest measurements an hour of day needs to get a baseline
+    """
+    column = column or _value_column(df)
+    with instrument.stage('anomaly.{}.detect'.format(column), rows_in=len(df)) as stage:
+        table = scores(df, column, min_samples)
+        flags = table.loc[table.loc[:, 'score'].abs() > threshold].copy()
+        flags.loc[:, 'kind'] = np.where(flags.loc[:, 'score'] > 0, 'high', 'low')
+        stage['rows_out'] = len(flags)
+    return flags
+
+
+def intervals(flags, gap='1H'):
+    """Merges anomalous measurements that follow each other into intervals.
+
+    Returns a dataframe with a row per interval and the columns 'nanopi' (and 'direction'),
+    'kind', 'start', 'end', 'count' (the number of anomalous measurements), 'baseline'
+    (the median baseline), 'value' (the median value) and 'peak_score' (the score furthest from zero).
+
+    Arguments:
+    flags - the dataframe returned by detect(...)
+    gap - measurements at most this far apart belong to the same interval
+    """
+    devices = _device_levels(flags.index)
+    columns = devices + ['kind', 'start', 'end', 'count', 'baseline', 'value', 'peak_score']
+    if not len(flags):
+        return pd.DataFrame(columns=columns)
+    table = flags.reset_index()
+    table = table.sort_values(devices + ['kind', 'datetime'], kind='stable')
+    same = np.ones(len(table), dtype=bool)
+    for name in devices + ['kind']:
+        same &= (table.loc[:, name] == table.loc[:, name].shift()).values
+    close = (table.loc[:, 'datetime'].diff() <= pd.Timedelta(gap)).values
+    table.loc[:, 'interval'] = np.cumsum(~(same & close))
+    table.loc[:, 'abs_score'] = table.loc[:, 'score'].abs()
+    peak = table.loc[table.groupby('interval')['abs_score'].idxmax(), ['interval', 'score']].set_index('interval')
+    grouped = table.groupby('interval')
+    result = grouped.agg(**{name: (name, 'first') for name in devices + ['kind']},
+                         start=('datetime', 'min'), end=('datetime', 'max'), count=('datetime', 'size'),
+                         baseline=('baseline', 'median'), value=('value', 'median'))
+    result.loc[:, 'peak_score'] = peak.loc[:, 'score']
+    return result.sort_values(['start'] + devices).reset_index(drop=True).loc[:, columns]
+
+
+def overlay(ax, flags, direction=None):
+    """Draws the anomalous measurements as black crosses on a plot made from a pandas series or dataframe.
+
+    All the crosses are drawn as a single line with markers, so this is cheap however many there are.
+
+    Arguments:
+    ax - the matplotlib axes, e.g. the one returned by df.plot()
+    flags - the dataframe returned by detect(...)
+    direction - for bandwidth, the direction ('up' or 'down') whose anomalies to draw
+    """
+    if direction is not None:
+        flags = flags.xs(direction, level='direction', drop_level=False)
+    if not len(flags):
+        return
+    points = pd.Series(flags.loc[:, 'value'].values, index=flags.index.get_level_values('datetime')).sort_index()
+    points.plot(ax=ax, style='x', color='black', markersize=4, legend=False)
+
+
+if __name__ == '__main__':
+
+    import archive
+
+    parser = argparse.ArgumentParser(description="Lists anomalous intervals in archived data.")
+    parser.add_argument('metrics', nargs='*', default=VALUE_COLUMNS)
+    parser.add_argument('-d', dest='directory', default=archive.ARCHIVE_DIR, help="archive directory")
+    parser.add_argument('-t', dest='threshold', default=THRESHOLD, type=float,
+                        help="robust z-score threshold (default: {})".format(THRESHOLD))
+    parser.add_argument('-o', dest='output', default=None, help="directory to write <metric>_anomalies.csv to")
+    args = parser.parse_args()
+
+    for metric in args.metrics:
+        df = archive.Archive(metric, args.directory).to_dataframe(reindex=False)
+        table = intervals(detect(df, threshold=args.threshold))
+        print("{}: {} anomalous interval(s)".format(metric, len(table)))
+        if args.output:
+            table.to_csv(os.path.join(args.output, '{}_anomalies.csv'.format(metric)), index=False)
+        else:
+            print(table.to_string(index=False))
+    instrument.summary()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# A compact binary archive of raw measurements, one per metric.
+#
+# Each archive is a pair of numpy files in the archive directory:
+#   <metric>.<version>.npy       fixed-width records of (time, nanopi, direction, value), sorted by time
+#   <metric>.<version>.time.npy  the sorted timestamps on their own, used for binary search
+# plus a small <metric>.json file with the metadata needed to rebuild a dataframe, which names
+# the version. Writing an archive writes a new version and then replaces the .json file, so
+# readers see either the old files or the new ones, never a mix of the two.
+#
+# Archives are opened with np.load(..., mmap_mode='r'), so opening one costs nothing,
+# only the pages of the file that are actually touched get read, and several processes
+# reading the same archive share it through the page cache.
+
+import argparse
+import glob
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+import common
+
+
+ARCHIVE_DIR = 'data/archive'
+
+RECORD_DTYPE = np.dtype([
+    ('time', '<i8'),        # nanoseconds since the epoch, UTC
+    ('nanopi', '<i4'),
+    ('direction', 'i1'),    # see DIRECTIONS; -1 if the metric has no direction
+    ('value', '<f8'),
+])
+
+DIRECTIONS = ['up', 'down']
+
+# the column of the dataframe that ends up in the 'value' field, for each metric
+VALUE_COLUMNS = {
+    'bandwidth': 'bandwidth',
+    'jitter': 'jitter',
+    'latency': 'latency',
+    'ping': 'state',
+}
+
+# ping states are stored as numbers
+PING_STATES = ['up', 'down']
+
+
+def _paths(metric, directory, version=None):
+    # archives written before versions were named have none
+    base = os.path.join(directory, metric if version is None else '{}.{}'.format(metric, version))
+    return base + '.npy', base + '.time.npy', os.path.join(directory, metric + '.json')
+
+
+def _read_meta(path):
+    with open(path, 'rt') as file:
+        return json.load(file)
+
+
+def write(df, metric, directory=ARCHIVE_DIR):
+    """Writes a dataframe produced by one of the common.get_XX_dataframe(...) functions to an archive.
+
+    Rows without a value (such as the ones added by re-indexing) are left out,
+    as are the 'id' and 'upload_date' columns. An existing archive for the metric is replaced.
+
+    Arguments:
+    df - the pandas dataframe to archive
+    metric - one of 'bandwidth', 'jitter', 'latency' and 'ping'
+    directory - the directory the archive files are written to
+    """
+    column = VALUE_COLUMNS[metric]
+    data = df.loc[:, column].dropna()
+    times = data.index.get_level_values('datetime')
+    tz = str(times.tz) if times.tz is not None else None
+
+    records = np.empty(len(data), dtype=RECORD_DTYPE)
+    records['time'] = times.asi8
+    records['nanopi'] = data.index.get_level_values('nanopi')
+    if 'direction' in data.index.names:
+        records['direction'] = pd.Categorical(data.index.get_level_values('direction'),
+                                              categories=DIRECTIONS).codes
+    else:
+        records['direction'] = -1
+    if metric == 'ping':
+        records['value'] = pd.Categorical(data.values, categories=PING_STATES).codes
+    else:
+        records['value'] = data.values
+    records = records[np.lexsort((records['direction'], records['nanopi'], records['time']))]
+
+    os.makedirs(directory, exist_ok=True)
+    # other processes may be reading the archive, so the records are written as a new version
+    # next to the old one, and replacing the metadata switches readers over to it all at once
+    version = 'v{:x}{:x}'.format(time.time_ns(), os.getpid())
+    records_path, time_path, meta_path = _paths(metric, directory, version)
+    np.save(records_path, records)
+    np.save(time_path, np.ascontiguousarray(records['time']))
+    temporary_path = '{}.{}.tmp'.format(meta_path, os.getpid())
+    with open(temporary_path, 'wt') as file:
+        json.dump({'metric': metric, 'column': column, 'tz': tz, 'count': len(records),
+                   'has_direction': 'direction' in data.index.names,
+                   'duplicates': int(df.attrs.get('duplicates', 0)), 'version': version}, file)
+    os.replace(temporary_path, meta_path)
+
+    # readers that have the old version open keep it until they let go of it
+    for path in glob.glob(os.path.join(glob.escape(directory), glob.escape(metric) + '.*npy')):
+        if path not in (records_path, time_path):
+            os.remove(path)
+
+
+class Archive:
+    """A memory-mapped archive of one metric.
+
+    Arguments:
+    metric - one of 'bandwidth', 'jitter', 'latency' and 'ping'
+    directory - the directory the archive files are in
+    """
+
+    def __init__(self, metric, directory=ARCHIVE_DIR):
+        self.metric = metric
+        self.directory = directory
+        meta_path = _paths(metric, directory)[2]
+        while True:
+            self.meta = _read_meta(meta_path)
+            records_path, time_path, _ = _paths(metric, directory, self.meta.get('version'))
+            try:
+                self.records = np.load(records_path, mmap_mode='r')
+                self.times = np.load(time_path, mmap_mode='r')
+                break
+            except FileNotFoundError:
+                # retried if a newer version replaced this one after the metadata was read
+                if _read_meta(meta_path) == self.meta:
+                    raise
+
+    def __len__(self):
+        return len(self.records)
+
+    def _timestamp(self, value, end=False):
+        if isinstance(value, str) and end:
+            # like .loc and query.select(...), a partial date string as the end includes the whole period
+            timestamp = pd.Period(value).end_time
+        else:
+            timestamp = pd.Timestamp(value)
+        if timestamp.tz is None and self.meta['tz'] is not None:
+            timestamp = timestamp.tz_localize(self.meta['tz'])
+        return timestamp.value
+
+    def bounds(self, start=None, end=None):
+        """Returns the (first, last + 1) positions of the records between start and end, inclusive.
+
+        Uses binary search on the timestamp index, so only a handful of pages are read.
+
+        Arguments:
+        start - anything pd.Timestamp(...) accepts, or None for the beginning of the archive;
+                naive times are taken to be in the archive's timezone
+        end - as start, or None for the end of the archive; a date such as '2018-05-31'
+              includes that whole day, as it does with query.select(...)
+        """
+        first = 0 if start is None else int(np.searchsorted(self.times, self._timestamp(start), side='left'))
+        last = (len(self.times) if end is None
+                else int(np.searchsorted(self.times, self._timestamp(end, end=True), side='right')))
+        return first, max(first, last)
+
+    def slice(self, start=None, end=None):
+        """Returns the records between start and end as a (memory-mapped) numpy array; see bounds(...)."""
+        first, last = self.bounds(start, end)
+        return self.records[first:last]
+
+    def to_dataframe(self, start=None, end=None, nanopis=None, reindex=True):
+        """Builds a dataframe like the ones produced by the common.get_XX_dataframe(...) functions.
+
+        The dataframe only has the value column (e.g. 'bandwidth'), not 'id' or 'upload_date'.
+
+        Arguments:
+        start - the first time to include; see bounds(...)
+        end - the last time to include; see bounds(...)
+        nanopis - a list of NanoPi IDs to include, or None for all of them
+        reindex - whether to re-index hourly metrics onto the full hourly grid, like the loaders do
+        """
+        records = self.slice(start, end)
+        if nanopis is not None:
+            records = records[np.isin(records['nanopi'], nanopis)]
+        times = pd.DatetimeIndex(records['time'].astype('datetime64[ns]'))
+        if self.meta['tz'] is not None:
+            times = times.tz_localize('UTC').tz_convert(self.meta['tz'])
+        arrays = [times, records['nanopi'].astype(np.int64)]
+        names = ['datetime', 'nanopi']
+        if self.meta['has_direction']:
+            arrays.append(pd.Categorical.from_codes(records['direction'], categories=DIRECTIONS).astype(object))
+            names.append('direction')
+        index = pd.MultiIndex.from_arrays(arrays, names=names)
+
+        column = self.meta['column']
+        if self.metric == 'ping':
+            values = pd.Categorical.from_codes(records['value'].astype(np.int8), categories=PING_STATES).astype(object)
+        else:
+            values = np.array(records['value'])
+        df = pd.DataFrame({column: values}, index=index)
+
+        if reindex and self.metric != 'ping' and len(df):
+            df = common.reindex_hourly(df, directions=DIRECTIONS if self.meta['has_direction'] else None)
+        # the duplicates the loaders removed before the archive was written; see quality.py
+        df.attrs['duplicates'] = self.meta.get('duplicates', 0)
+        return df
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Converts HDF5 snapshots in data/ to memory-mapped archives.")
+    parser.add_argument('metrics', nargs='*', default=list(VALUE_COLUMNS))
+    parser.add_argument('-i', dest='input', default='data', help="directory containing <metric>.h5 files")
+    parser.add_argument('-o', dest='output', default=ARCHIVE_DIR, help="archive directory")
+    args = parser.parse_args()
+
+    for metric in args.metrics:
+        print("Archiving {}...".format(metric))
+        write(common.read_snapshot(os.path.join(args.input, '{}.h5'.format(metric))), metric, args.output)
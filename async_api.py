@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# An asyncio client for the API, as an alternative to the blocking requests calls in common.py.
+#
+# It can be used from event-loop-based services, and lets ingestion parse one page while
+# the next is in flight: pages(...) fetches ahead of its consumer in a background task,
+# up to PREFETCH pages, and waits for the consumer when it is that far ahead.
+# All the requests made through one Client share a pool of keep-alive connections
+# and the limit on requests in flight (common.MAX_REQUESTS by default).
+#
+# Needs the httpx package (pip install httpx), which common.py does not.
+#
+#     async with async_api.Client(common.get_auth()) as client:
+#         async for results in client.pages(common.JITTER_URL, {'nanopi': 11}):
+#             ...
+
+import asyncio
+import argparse
+
+import common
+import instrument
+
+
+# pages fetched ahead of the consumer of pages(...)
+PREFETCH = 2
+
+# seconds to wait for a response
+TIMEOUT = 60
+
+
+def _auth(auth):
+    # the same auth objects that common.py takes: a requests HTTPBasicAuth, a (username, password) pair, or None
+    import httpx
+    if auth is None or isinstance(auth, httpx.Auth):
+        return auth
+    if isinstance(auth, tuple):
+        return httpx.BasicAuth(*auth)
+    return httpx.BasicAuth(auth.username, auth.password)
+
+
+class Client:
+    """An asynchronous API client; use it as an async context manager.
+
+    Arguments:
+    auth - the requests auth object returned by common.get_auth(), a (username, password) pair, or None
+    max_requests - the most requests that may be in flight at once; defaults to common.MAX_REQUESTS
+    timeout - the number of seconds to wait for a response
+    """
+
+    def __init__(self, auth=None, max_requests=None, timeout=TIMEOUT):
+        self.auth = auth
+        self.max_requests = max_requests or common.MAX_REQUESTS
+        self.timeout = timeout
+        self._client = None
+        self._slots = None
+
+    async def __aenter__(self):
+        import httpx
+        limits = httpx.Limits(max_connections=self.max_requests, max_keepalive_connections=self.max_requests)
+        self._client = httpx.AsyncClient(auth=_auth(self.auth), limits=limits, timeout=self.timeout)
+        self._slots = asyncio.Semaphore(self.max_requests)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+        self._client = None
+
+    async def get(self, url, params=None):
+        """Makes a GET request and returns the response, raising an exception for HTTP errors.
+
+        Arguments:
+        url - the url that will be requested
+        params - a dict containing URL parameters for the request
+        """
+        async with self._slots:
+            response = await self._client.get(url, params=params)
+        response.raise_for_status()
+        return response
+
+    async def pages(self, url, params=None, prefetch=PREFETCH, progress=None):
+        """Pages through the REST API, yielding the list of results of each page as it arrives.
+
+        Pages are fetched in a background task, at most prefetch pages ahead of the loop
+        that consumes them. If the loop stops early, the background task is cancelled.
+
+        Arguments:
+        url - the url of the first page
+        params - a dict containing URL parameters for API requests
+        prefetch - the most pages fetched but not yet consumed
+        progress - a function called as progress(pages, rows, total, done) after every page, or None
+        """
+        queue = asyncio.Queue(maxsize=prefetch)
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+
+        async def produce(url, params):
+            try:
+                with instrument.stage('fetch.' + endpoint, pages=0, bytes=0, rows_out=0) as stage:
+                    while url:
+                        response = await self.get(url, params)
+                        # the next url already contains the parameters
+                        params = None
+                        json = response.json()
+                        results = json.get('results')
+                        url = json.get('next')
+                        stage['pages'] += 1
+                        stage['bytes'] += len(response.content)
+                        stage['rows_out'] += len(results)
+                        if progress:
+                            progress(stage['pages'], stage['rows_out'], json.get('count'), url is None)
+                        # waits here while the consumer is prefetch pages behind
+                        await queue.put((results, None))
+                await queue.put((None, None))
+            except Exception as error:
+                await queue.put((None, error))
+
+        producer = asyncio.ensure_future(produce(url, params))
+        try:
+            while True:
+                results, error = await queue.get()
+                if error is not None:
+                    raise error
+                if results is None:
+                    break
+                yield results
+        finally:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+
+    async def get_from_api(self, url, params=None, progress=None):
+        """Pages through the REST API and returns all the results, like common.get_from_api(...).
+
+        Arguments:
+        url - the url that will be requested
+        params - a dict containing URL parameters for API requests
+        progress - a function called as progress(pages, rows, total, done) after every page, or None
+        """
+        results = []
+        async for page in self.pages(url, params, progress=progress):
+            results.extend(page)
+        return results
+
+    async def get_nanopi_list(self, params=None):
+        """Gets a list of all NanoPis from the API, like common.get_nanopi_list(...).
+
+        Arguments:
+        params - a dict containing URL parameters for the request
+        """
+        response = await self.get(common.NANOPI_URL, params)
+        return response.json()
+
+
+async def fetch_all(auth, urls, max_requests=None, progress=common.print_progress):
+    """Fetches several endpoints at the same time over one connection pool.
+
+    Returns a dict where the keys are the names and the values are lists of results.
+
+    Arguments:
+    auth - the requests auth object returned by common.get_auth(), a (username, password) pair, or None
+    urls - a dict where the keys are names, e.g. 'jitter', and the values are (url, params) pairs
+    max_requests - the most requests that may be in flight at once; defaults to common.MAX_REQUESTS
+    progress - a function called as progress(name, pages, rows, total, done) after every page, or None
+    """
+    async with Client(auth, max_requests) as client:
+        def callback(name):
+            return (lambda *args: progress(name, *args)) if progress else None
+
+        results = await asyncio.gather(*[client.get_from_api(url, params, progress=callback(name))
+                                         for name, (url, params) in urls.items()])
+    return dict(zip(urls, results))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Fetches every endpoint of the API concurrently and counts the rows.")
+    parser.add_argument('-j', dest='max_requests', type=int, default=None,
+                        help="most requests in flight at once (default: {})".format(common.MAX_REQUESTS))
+    args = parser.parse_args()
+
+    urls = {'bandwidth': (common.IPERF3_URL, None),
+            'jitter': (common.JITTER_URL, None),
+            'latency': (common.LATENCY_URL, None),
+            'ping': (common.PING_URL, {'state': 'down'})}
+    results = asyncio.run(fetch_all(common.get_auth(), urls, args.max_requests))
+    for name, rows in results.items():
+        print("{}: {} rows".format(name, len(rows)))
+    instrument.summary()
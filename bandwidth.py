@@ -2,35 +2,38 @@
 
 # Contains plotting functions related to bandwidth test results.
 
-import requests
-from getpass import getpass
-import pandas as pd
-import numpy as np
 import matplotlib
 matplotlib.use('svg')
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-import common
+import instrument
+import plot_cache
+import plot_data
+import nanopi_registry
+import facets
+import anomaly
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth')
 def plot_average(df, nanopi_names=None, plot_name='average_bandwidth.svg',
                  title='Average Bandwidth by Location', chart_width=10):
     """Produces a bar graph depicting average upload bandwidth and average download bandwidth for each nanopi.
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the chart
     """
     averages = df.loc[:, 'bandwidth'].groupby(['nanopi', 'direction']).mean().unstack()
+    plot_data.save(averages, plot_name, 'bandwidth')
     ax = averages.plot(kind='bar')
     ax.set(xlabel='Location', ylabel='Bandwidth (Mbit/s)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in averages.index:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, averages.index)
         ax.set_xticklabels(labels, rotation=0)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -38,6 +41,8 @@ def plot_average(df, nanopi_names=None, plot_name='average_bandwidth.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth')
 def plot_24h_average(df, plot_name='24h_average_bandwidth.svg',
                      title="Average Bandwidth by Hour (Aggregate)", chart_width=10):
     """Produces two graphs, up and down, depicting average aggregate bandwidth for all NanoPis by hour of day.
@@ -49,6 +54,7 @@ def plot_24h_average(df, plot_name='24h_average_bandwidth.svg',
     chart_width - the width of the chart
     """
     by_hour = df.loc[:, 'bandwidth'].unstack().groupby(by=(lambda x: x[0].hour)).mean()
+    plot_data.save(by_hour, plot_name, 'bandwidth', index=['hour'])
     ax = by_hour.plot()
     ax.set(xlabel='Hour of Day', ylabel='Bandwidth (Mbit/s)', title=title)
     fig = ax.get_figure()
@@ -57,46 +63,57 @@ def plot_24h_average(df, plot_name='24h_average_bandwidth.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth', prefixes=('up_', 'down_'))
 def plot_24h(df, nanopi_names=None, plot_name='24h_bandwidth.svg',
-             title="Average Bandwidth by Hour (Individual)", chart_width=10):
+             title="Average Bandwidth by Hour (Individual)", chart_width=10, facet=False):
     """Produces a graph showing the average hourly bandwidth for each individual nanopi
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the chart
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
     """
     by_hour = df.loc[:, 'bandwidth'].unstack().unstack().groupby(by=(lambda x: x.hour)).mean()
+    plot_data.save(by_hour, plot_name, 'bandwidth', index=['hour'])
+    if facet:
+        for direction in ['up', 'down']:
+            facets.save(facets.plot(by_hour.loc[:, direction], nanopi_names, groups=facet,
+                                    title='{} ({})'.format(title, direction.capitalize()), xlabel='Hour of Day',
+                                    ylabel='Bandwidth (Mbit/s)', chart_width=chart_width, xticks=facets.HOUR_TICKS),
+                        plot_data.prefixed(direction + '_', plot_name))
+        return
     # up
     ax = by_hour.loc[:, 'up'].plot()
     up_title = title + ' (Up)'
     ax.set(xlabel='Hour of Day', ylabel='Bandwidth (Mbit/s)', title=up_title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_hour.loc[:, 'up'].columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_hour.loc[:, 'up'].columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('up_' + plot_name)
+    fig.savefig(plot_data.prefixed('up_', plot_name))
     fig.clear()
     # down
     ax = by_hour.loc[:, 'down'].plot()
     down_title = title + ' (Down)'
     ax.set(xlabel='Hour of Day', ylabel='Bandwidth (Mbit/s)', title=down_title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_hour.loc[:, 'down'].columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_hour.loc[:, 'down'].columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('down_' + plot_name)
+    fig.savefig(plot_data.prefixed('down_', plot_name))
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth')
 def plot_dow_average(df, plot_name='dow_average_bandwidth.svg',
                      title="Average Bandwidth by Day of Week (Aggregate)", chart_width=10):
     """Produces a graph showing the average aggregated bandwidth for all nanopis by day of week
@@ -108,6 +125,7 @@ def plot_dow_average(df, plot_name='dow_average_bandwidth.svg',
     chart_width - the width of the chart
     """
     by_dow = df.loc[:, 'bandwidth'].unstack().groupby(by=(lambda x: x[0].dayofweek)).mean().reindex(range(7))
+    plot_data.save(by_dow, plot_name, 'bandwidth', index=['dow'])
     ax = by_dow.plot()
     dows = ['_', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     ax.set_xticklabels(dows, rotation=0)
@@ -118,18 +136,31 @@ def plot_dow_average(df, plot_name='dow_average_bandwidth.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth', prefixes=('up_', 'down_'))
 def plot_dow(df, nanopi_names=None, plot_name='dow_bandwidth.svg',
-             title="Average Bandwidth by Day of Week (Individual)", chart_width=10):
+             title="Average Bandwidth by Day of Week (Individual)", chart_width=10, facet=False):
     """Produces a graph depicting the average individual bandwidth for each nanopi by day of week
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the chart
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
     """
     by_dow = df.loc[:, 'bandwidth'].unstack().unstack().groupby(by=(lambda x: x.dayofweek)).mean()
+    plot_data.save(by_dow, plot_name, 'bandwidth', index=['dow'])
+    if facet:
+        for direction in ['up', 'down']:
+            facets.save(facets.plot(by_dow.loc[:, direction], nanopi_names, groups=facet,
+                                    title='{} ({})'.format(title, direction.capitalize()), xlabel='Day of Week',
+                                    ylabel='Bandwidth (Mbit/s)', chart_width=chart_width, xticks=facets.DOW_TICKS),
+                        plot_data.prefixed(direction + '_', plot_name))
+        return
     # the _ is not shown because 0th element goes at origin but there is no xtick at origin
     dows = ['_', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     # up
@@ -138,13 +169,11 @@ def plot_dow(df, nanopi_names=None, plot_name='dow_bandwidth.svg',
     up_title = title + ' (Up)'
     ax.set(xlabel='Day of Week', ylabel='Bandwidth (Mbit/s)', title=up_title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_dow.loc[:, 'up'].columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_dow.loc[:, 'up'].columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('up_' + plot_name)
+    fig.savefig(plot_data.prefixed('up_', plot_name))
     fig.clear()
     # down
     ax = by_dow.loc[:, 'down'].plot()
@@ -152,28 +181,30 @@ def plot_dow(df, nanopi_names=None, plot_name='dow_bandwidth.svg',
     down_title = title + ' (Down)'
     ax.set(xlabel='Day of Week', ylabel='Bandwidth (Mbit/s)', title=down_title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_dow.loc[:, 'down'].columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_dow.loc[:, 'down'].columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('down_' + plot_name)
+    fig.savefig(plot_data.prefixed('down_', plot_name))
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth')
 def plot_all_average(df, plot_name='all_average_bandwidth.svg',
                      title="Bandwidth over Entire Trial (Aggregate)", chart_width=10):
     """Use when you want to plot the average of multiple locations each hour over unlimited time
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the chart
     """
     averages = df.loc[:, 'bandwidth'].unstack().groupby('datetime').mean()
+    plot_data.save(averages, plot_name, 'bandwidth')
     ax = averages.plot()
     ax.set(xlabel='Date', ylabel='Bandwidth (Mbit/s)', title=title)
     fig = ax.get_figure()
@@ -182,59 +213,80 @@ def plot_all_average(df, plot_name='all_average_bandwidth.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth', prefixes=('up_', 'down_'))
 def plot_all(df, nanopi_names=None, plot_name='all_bandwidth.svg',
-             title="Bandwidth over Entire Trial (Individual)", chart_width=10):
+             title="Bandwidth over Entire Trial (Individual)", chart_width=10, facet=False,
+             anomalies=None):
     """Use when you want to plot the individual data from multiple locations each hour over unlimited time
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the chart
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
+    anomalies - a dataframe of anomalous measurements from anomaly.detect(...) to mark with black crosses,
+                or None; not drawn when facet is set
     """
+    data = df.loc[:, 'bandwidth'].unstack().unstack()
+    plot_data.save(data, plot_name, 'bandwidth')
+    if facet:
+        for direction in ['up', 'down']:
+            facets.save(facets.plot(data.loc[:, direction], nanopi_names, groups=facet,
+                                    title='{} ({})'.format(title, direction.capitalize()), xlabel='Date',
+                                    ylabel='Bandwidth (Mbit/s)', chart_width=chart_width),
+                        plot_data.prefixed(direction + '_', plot_name))
+        return
     # up
-    up_bandwidth = df.loc[:, 'bandwidth'].unstack().unstack().loc[:, 'up']
+    up_bandwidth = data.loc[:, 'up']
     ax = up_bandwidth.plot()
+    if anomalies is not None:
+        anomaly.overlay(ax, anomalies, direction='up')
     up_title = title + ' (Up)'
     ax.set(xlabel='Date', ylabel='Bandwidth (Mbit/s)', title=up_title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in up_bandwidth.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, up_bandwidth.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('up_' + plot_name)
+    fig.savefig(plot_data.prefixed('up_', plot_name))
     fig.clear()
     # down
-    down_bandwidth = df.loc[:, 'bandwidth'].unstack().unstack().loc[:, 'down']
+    down_bandwidth = data.loc[:, 'down']
     ax = down_bandwidth.plot()
+    if anomalies is not None:
+        anomaly.overlay(ax, anomalies, direction='down')
     down_title = title + ' (Down)'
     ax.set(xlabel='Date', ylabel='Bandwidth (Mbit/s)', title=down_title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in down_bandwidth.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, down_bandwidth.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('down_' + plot_name)
+    fig.savefig(plot_data.prefixed('down_', plot_name))
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('bandwidth', prefixes=('up_', 'down_'))
 def plot_coverage(df, nanopi_names=None, plot_name='coverage_bandwidth.svg',
                   title="Bandwidth Test Coverage", chart_width=10):
     """Produces two plots, up and down, that depict which bandwidth tests were missed over the given data
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the chart
     """
     coverage = df.loc[:, 'bandwidth'].unstack().unstack().fillna(value=False).apply(lambda y: y.apply(lambda x: bool(x)))
+    plot_data.save(coverage, plot_name, 'present')
     # for legend
     black_patch = mpatches.Patch(color='black', label='missing')
     white_patch = mpatches.Patch(color='white', label='present')
@@ -245,9 +297,7 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_bandwidth.svg',
     fig, ax = plt.subplots()
     ax.imshow(data, aspect='auto', cmap=plt.cm.gray, interpolation='nearest')
     if nanopi_names:
-        labels = []
-        for nanopi_id in coverage.loc[:, 'up'].columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, coverage.loc[:, 'up'].columns)
         ax.set_yticklabels(['_', *labels])
     #ax.set_xticklabels(coverage.loc[:, 'up'].index.date)
     #fig.autofmt_xdate()
@@ -256,7 +306,7 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_bandwidth.svg',
     ax.set(ylabel='Location', title=up_title)
     ax.legend(handles=[black_patch, white_patch])
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('up_' + plot_name)
+    fig.savefig(plot_data.prefixed('up_', plot_name))
     fig.clear()
     # down
     data = []
@@ -265,9 +315,7 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_bandwidth.svg',
     fig, ax = plt.subplots()
     ax.imshow(data, aspect='auto', cmap=plt.cm.gray, interpolation='nearest')
     if nanopi_names:
-        labels = []
-        for nanopi_id in coverage.loc[:, 'down'].columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, coverage.loc[:, 'down'].columns)
         ax.set_yticklabels(['_', *labels])
     #ax.set_xticklabels(coverage.loc[:, 'down'].index.date)
     #fig.autofmt_xdate()
@@ -276,18 +324,16 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_bandwidth.svg',
     ax.set(ylabel='Location', title=down_title)
     ax.legend(handles=[black_patch, white_patch])
     fig.set_size_inches(chart_width, 6)
-    fig.savefig('down_' + plot_name)
+    fig.savefig(plot_data.prefixed('down_', plot_name))
     fig.clear()
 
 
 if __name__ == '__main__':
 
-    username = input("API Username: ")
-    password = getpass(prompt="API Password: ")
-    auth = requests.auth.HTTPBasicAuth(username, password)
+    import common
 
-    nanopis = requests.get(common.NANOPI_URL, auth=auth).json()
-    nanopi_names = {nanopi.get('id'):nanopi.get('location_info') for nanopi in nanopis}
+    auth = common.get_auth()
+    nanopi_names = nanopi_registry.load(auth)
 
     df = common.get_bandwidth_dataframe(auth)
     plot_average(df, nanopi_names=nanopi_names)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Times the loaders in common.py and every plotting function against
+# synthetic data served by a local stand-in API, at several scales.
+#
+# Scales are given as NANOPISxDAYS, e.g.:
+#
+#     ./benchmark.py -s 5x7 -s 20x30 -o bench.json
+
+import argparse
+import contextlib
+import inspect
+import io
+import json
+import os
+import tempfile
+import time
+import requests
+
+import common
+import fake_api
+import instrument
+import pipeline
+import plot_cache
+import synthetic
+
+
+DEFAULT_SCALES = ['5x7', '10x30', '20x90']
+
+LOADERS = [
+    ('bandwidth', common.get_bandwidth_dataframe),
+    ('jitter', common.get_jitter_dataframe),
+    ('latency', common.get_latency_dataframe),
+    ('ping', common.get_ping_dataframe),
+]
+
+
+def plot_functions(metric):
+    """Returns a list of (name, function) pairs for every plotting function of a metric."""
+    module = __import__(metric)
+    return [(name, getattr(module, name)) for name in sorted(dir(module))
+            if name.startswith('plot_') and callable(getattr(module, name))]
+
+
+def timed(func, *args, repeat=1, **kwargs):
+    """Calls func repeat times and returns a tuple of (best time in seconds, last result)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_scale(nanopis, days, page_size=100, repeat=1, plots=True, seed=0):
+    """Runs every benchmark at one scale and returns a list of result dicts."""
+    results = []
+
+    def record(name, seconds, rows=None):
+        result = {'nanopis': nanopis, 'days': days, 'name': name,
+                  'seconds': round(seconds, 6), 'peak_rss': instrument.peak_rss()}
+        if rows is not None:
+            result['rows'] = rows
+        results.append(result)
+        print("{:>4}x{:<5} {:<40} {:>10.3f}s".format(nanopis, days, name, seconds))
+
+    seconds, data = timed(synthetic.generate, nanopis=nanopis, days=days, seed=seed)
+    record('synthetic.generate', seconds, sum(len(records) for records in data.values()))
+
+    api = fake_api.FakeAPI(data, page_size=page_size)
+    fake_api.point_common_at(api.start())
+    auth = requests.auth.HTTPBasicAuth('benchmark', 'benchmark')
+    nanopi_names = {nanopi.get('id'): nanopi.get('location_info') for nanopi in data['nanopi']}
+    try:
+        frames = {}
+        for metric, loader in LOADERS:
+            # keep the loaders' progress messages out of the results table
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, df = timed(loader, auth, repeat=repeat)
+            record('common.{}'.format(loader.__name__), seconds, len(df))
+            frames[metric] = df
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, df = timed(pipeline.load, metric, auth, repeat=repeat)
+            record('pipeline.load({})'.format(metric), seconds, len(df))
+    finally:
+        api.stop()
+
+    if plots:
+        # always render, so that the timings are of actual rendering
+        plot_cache.enabled = False
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                for metric, df in frames.items():
+                    for name, func in plot_functions(metric):
+                        if 'nanopi_names' in inspect.signature(func).parameters:
+                            seconds, _ = timed(func, df, nanopi_names=nanopi_names, repeat=repeat)
+                        else:
+                            seconds, _ = timed(func, df, repeat=repeat)
+                        record('{}.{}'.format(metric, name), seconds)
+            finally:
+                os.chdir(cwd)
+
+    return results
+
+
+def parse_scale(scale):
+    nanopis, days = scale.lower().split('x')
+    return int(nanopis), int(days)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks loaders and plots against synthetic data.")
+    parser.add_argument('-s', dest='scales', action='append', metavar='NANOPISxDAYS',
+                        help="scale to run at; may be repeated (default: {})".format(' '.join(DEFAULT_SCALES)))
+    parser.add_argument('-r', dest='repeat', default=1, type=int, help="repetitions; the best time is kept")
+    parser.add_argument('-o', dest='output', default=None, help="write results to this JSON file")
+    parser.add_argument('--page-size', dest='page_size', default=100, type=int)
+    parser.add_argument('--no-plots', dest='plots', action='store_false', help="only time the loaders")
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales or DEFAULT_SCALES:
+        nanopis, days = parse_scale(scale)
+        results.extend(run_scale(nanopis, days, page_size=args.page_size,
+                                 repeat=args.repeat, plots=args.plots))
+
+    if args.output:
+        with open(args.output, 'wt') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Single command line entry point for the common tasks:
+#
+#     ./cli.py fetch [METRIC ...]        pull data from the API into data/ (HDF5 snapshots and archives)
+#     ./cli.py sync [-o DIR]             pull data from the API and export it as compact CSV
+#     ./cli.py plot METRIC [TYPE ...]    plot from the archives in data/archive/
+#
+# fetch and sync also write a data-quality report (quality.csv and quality.json; see quality.py).
+#
+# The API, directories and so on are those of the site chosen with --site in the configuration
+# file (see config.py); --site may be repeated, or be 'all', to work on several sites at once,
+# each in a process of its own. --set KEY=VALUE overrides a setting.
+#
+# Only the standard library and config.py are imported up front, so --help and bad arguments
+# are quick. pandas and requests are imported by the subcommand that needs them, and `plot`
+# imports matplotlib with the module of the metric being plotted, and no other metric's module.
+
+import argparse
+import functools
+import importlib
+import inspect
+import os
+import sys
+
+
+METRICS = ['bandwidth', 'jitter', 'latency', 'ping']
+
+NANOPIS_FILE = 'nanopis.json'
+
+
+def fetch(site, args):
+    import threading
+    import common
+    import archive
+    import instrument
+    import memo
+    import quality
+    import nanopi_registry
+
+    auth = site.auth()
+    if args.max_requests:
+        common.set_max_requests(args.max_requests)
+    os.makedirs(args.output, exist_ok=True)
+    # PyTables isn't thread-safe, so only one snapshot is written at a time
+    hdf_lock = threading.Lock()
+    measurements = {}
+
+    def fetch_nanopis():
+        nanopi_registry.load(auth, os.path.join(args.output, NANOPIS_FILE), refresh=True)
+
+    def fetch_metric(metric):
+        # unchanged data costs a single request, and is read from the copy kept in the data directory
+        df = memo.load(metric, auth, directory=os.path.join(args.output, 'memo'))
+        archive.write(df, metric, os.path.join(args.output, 'archive'))
+        if metric == 'ping':
+            import rollup
+            counts = rollup.Rollup(os.path.join(args.output, 'rollup'))
+            counts.update(df, source='api')
+            counts.save()
+        with hdf_lock:
+            common.write_snapshot(df, os.path.join(args.output, '{}.h5'.format(metric)))
+        measurements[metric] = quality.measure(df, metric)
+        print("{}: saved".format(metric))
+
+    common.fetch_all([('nanopis', fetch_nanopis)] +
+                     [(metric, functools.partial(fetch_metric, metric)) for metric in args.metrics])
+    write_quality(measurements, args.output)
+    instrument.summary()
+
+
+def write_quality(measurements, directory):
+    import quality
+
+    daily, summary = quality.report({metric: measurements[metric] for metric in METRICS if metric in measurements})
+    print(quality.format_summary(summary))
+    quality.write(daily, summary, directory)
+
+
+def sync(site, args):
+    import pandas as pd
+    import common
+    import export
+    import instrument
+    import pipeline
+    import quality
+
+    auth = site.auth()
+    if args.max_requests:
+        common.set_max_requests(args.max_requests)
+    os.makedirs(args.output, exist_ok=True)
+    measurements = {}
+
+    def sync_nanopis():
+        pd.DataFrame(common.get_nanopi_list(auth)).to_csv(os.path.join(args.output, 'nanopis.csv'))
+
+    def sync_metric(metric):
+        df = pipeline.load(metric, auth)
+        if args.plain:
+            df.to_csv(os.path.join(args.output, '{}.csv'.format(metric)))
+        else:
+            export.write(df, os.path.join(args.output, metric), dropna=not args.keep_missing,
+                         compression=None if args.compression == 'none' else args.compression,
+                         sibling=args.sibling)
+        measurements[metric] = quality.measure(df, metric)
+        print("{}: saved".format(metric))
+
+    common.fetch_all([('nanopis', sync_nanopis)] +
+                     [(metric, functools.partial(sync_metric, metric)) for metric in args.metrics])
+    write_quality(measurements, args.output)
+    instrument.summary()
+
+
+def plot(site, args):
+    import archive
+    import instrument
+    import nanopi_registry
+    import plot_cache
+    import plot_data
+
+    if args.data_format:
+        plot_data.data_format = args.data_format
+    if args.cache:
+        plot_cache.enabled = True
+    module = importlib.import_module(args.metric)
+    functions = {name[len('plot_'):]: getattr(module, name) for name in dir(module)
+                 if name.startswith('plot_') and callable(getattr(module, name))}
+    plot_types = args.types or sorted(functions)
+    unknown = [plot_type for plot_type in plot_types if plot_type not in functions]
+    if unknown:
+        sys.exit("Unknown plot type(s) for {}: {} (choose from {})".format(
+            args.metric, ', '.join(unknown), ', '.join(sorted(functions))))
+
+    # the NanoPi list saved by fetch; an empty registry if there isn't one
+    nanopi_names = nanopi_registry.load(path=os.path.join(args.data, NANOPIS_FILE))
+
+    nanopis = [int(nanopi) for nanopi in args.nanopis.split(',')] if args.nanopis else None
+    if args.metric == 'ping' and not args.raw:
+        # hourly counts rather than every ping
+        import rollup
+        df = rollup.load(os.path.join(args.data, 'rollup'), os.path.join(args.data, 'archive')).hourly(
+            start=args.start, end=args.end, nanopis=nanopis)
+    else:
+        df = archive.Archive(args.metric, os.path.join(args.data, 'archive')).to_dataframe(
+            start=args.start, end=args.end, nanopis=nanopis)
+    os.makedirs(args.output, exist_ok=True)
+    # plotting functions write into the current directory
+    cwd = os.getcwd()
+    os.chdir(args.output)
+    try:
+        for plot_type in plot_types:
+            print("Plotting {} {}...".format(args.metric, plot_type))
+            func = functions[plot_type]
+            parameters = inspect.signature(func).parameters
+            kwargs = {}
+            if 'nanopi_names' in parameters:
+                kwargs['nanopi_names'] = nanopi_names
+            if args.facet and 'facet' in parameters:
+                kwargs['facet'] = True
+            func(df, **kwargs)
+    finally:
+        os.chdir(cwd)
+    instrument.summary()
+
+
+def for_site(args, site, several=False):
+    """Returns a copy of the parsed arguments with the directories not given filled in from a site's settings.
+
+    Arguments:
+    args - the parsed arguments
+    site - a config.Site
+    several - whether several sites are being worked on, in which case directories that
+              were given get a subdirectory per site
+    """
+    args = argparse.Namespace(**vars(args))
+    # a relative data_dir is in the repository, wherever the command runs; see config.Site.data_path(...)
+    defaults = {'fetch': {'output': site.data_path()}, 'sync': {'output': site.sync_dir},
+                'plot': {'data': site.data_path(), 'output': site.plot_dir}}[args.command]
+    for name, default in defaults.items():
+        value = getattr(args, name)
+        if value is None:
+            value = default
+        elif several:
+            value = os.path.join(value, site.name)
+        setattr(args, name, value)
+    return args
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetches living-lab data and plots it.")
+    parser.add_argument('--config', help="configuration file (default: LLV_CONFIG or llv.ini); see config.py")
+    parser.add_argument('--site', dest='sites', action='append', metavar='SITE',
+                        help="site to work on, or 'all'; may be repeated (default: LLV_SITE or the only site)")
+    parser.add_argument('--set', dest='overrides', action='append', metavar='KEY=VALUE',
+                        help="override a setting of the sites, e.g. --set base_url=http://localhost:8000")
+    parser.add_argument('-P', dest='processes', type=int,
+                        help="most sites worked on at once (default: all of them)")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    fetch_parser = subparsers.add_parser('fetch', help="pull data from the API into HDF5 snapshots and archives")
+    fetch_parser.add_argument('metrics', nargs='*', default=METRICS, metavar='METRIC')
+    fetch_parser.add_argument('-o', dest='output', help="data directory (default: the site's data_dir)")
+    fetch_parser.add_argument('-j', dest='max_requests', type=int,
+                              help="most API requests in flight at once (default: the site's max_requests)")
+    fetch_parser.set_defaults(func=fetch)
+
+    sync_parser = subparsers.add_parser('sync', help="pull data from the API and export it as CSV")
+    sync_parser.add_argument('metrics', nargs='*', default=['bandwidth', 'jitter', 'latency'],
+                             metavar='METRIC')
+    sync_parser.add_argument('-o', dest='output', help="output directory (default: the site's sync_dir)")
+    sync_parser.add_argument('-j', dest='max_requests', type=int,
+                             help="most API requests in flight at once (default: the site's max_requests)")
+    sync_parser.add_argument('-c', dest='compression', default='gzip', choices=['none', 'gzip', 'zstd'],
+                             help="compression of the CSV files (default: gzip)")
+    sync_parser.add_argument('--keep-missing', action='store_true', help="keep the rows of hours with no data")
+    sync_parser.add_argument('--sibling', choices=['parquet', 'feather'],
+                             help="also write a Parquet or Feather file of each metric")
+    sync_parser.add_argument('--plain', action='store_true',
+                             help="write full, uncompressed CSV files as pandas does by default")
+    sync_parser.set_defaults(func=sync)
+
+    plot_parser = subparsers.add_parser('plot', help="plot from the archives written by fetch")
+    plot_parser.add_argument('metric', choices=METRICS)
+    plot_parser.add_argument('types', nargs='*', metavar='TYPE',
+                             help="plotting function without 'plot_', e.g. 24h (default: all of them)")
+    plot_parser.add_argument('-d', dest='data', help="data directory (default: the site's data_dir)")
+    plot_parser.add_argument('-o', dest='output', help="directory to write plots to (default: the site's plot_dir)")
+    plot_parser.add_argument('--start', help="first time to plot, e.g. 2018-05-30")
+    plot_parser.add_argument('--end', help="last time to plot, e.g. 2018-05-31")
+    plot_parser.add_argument('--nanopis', help="comma-separated NanoPi IDs to plot, e.g. 11,12,13")
+    plot_parser.add_argument('--facet', action='store_true',
+                             help="draw one small plot per NanoPi instead of one line each (24h, dow and all)")
+    plot_parser.add_argument('--raw', action='store_true',
+                             help="plot ping from every archived ping rather than the hourly counts")
+    plot_parser.add_argument('--save-data', dest='data_format', choices=['parquet', 'json'],
+                             help="also save the data behind each plot next to it; see plot_data.py")
+    plot_parser.add_argument('--cache', action='store_true',
+                             help="skip plots whose data and code haven't changed; see plot_cache.py")
+    plot_parser.set_defaults(func=plot)
+
+    args = parser.parse_args(argv)
+    unknown = [metric for metric in getattr(args, 'metrics', []) if metric not in METRICS]
+    if unknown:
+        parser.error("unknown metric(s): {} (choose from {})".format(', '.join(unknown), ', '.join(METRICS)))
+
+    import config
+    try:
+        chosen = config.select(config.load(args.config, config.parse_overrides(args.overrides)), args.sites)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # ask for any missing credentials now, rather than in the processes working on the sites;
+    # without a terminal to ask on (e.g. under cron), say which settings are missing instead
+    if args.command != 'plot':
+        try:
+            for site in chosen:
+                site.ask_credentials()
+        except ValueError as e:
+            parser.error(str(e))
+    if len(chosen) == 1:
+        chosen[0].apply()
+        args.func(chosen[0], for_site(args, chosen[0]))
+        return
+    config.run(run_site, chosen, args, processes=args.processes)
+
+
+def run_site(site, args):
+    """Runs a command for one of several sites; see config.run(...)."""
+    print("Working on site {}".format(site.name))
+    args.func(site, for_site(args, site, several=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,38 @@
 #!/usr/bin/env python3
 
-# Combines the pings from different dates in data/ping/
-# and writes them to /home/ubuntu/data/ping.csv .
+# Combines the pings from different dates in data/ping/ (written by get_ping.py; see config.Site.data_path(...))
+# and writes them to ping.csv in the site's sync_dir (/home/ubuntu/data/ by default; see config.py).
 
 import os
+import argparse
 import pandas as pd
+import config
 
 
 def combine_pings(source_dir):
     _, _, file_list = list(os.walk(source_dir))[0]
-    df = pd.read_csv(os.path.join(source_dir, file_list[0]))
-    del file_list[0]
-    for file_name in file_list:
-        new_df = pd.read_csv(os.path.join(source_dir, file_name))
-        df = df.append(new_df, ignore_index=True)
-    df.loc[:, 'time'] = pd.to_datetime(df.loc[:, 'time'])
-    df.loc[:, 'down'] = df.loc[:, 'down'].astype(int)
-    df.loc[:, 'up'] = df.loc[:, 'up'].astype(int)
+    # a single concat rather than appending one day at a time, which copies everything read so far every time
+    df = pd.concat([pd.read_csv(os.path.join(source_dir, file_name)) for file_name in sorted(file_list)],
+                   ignore_index=True)
+    # a day without any failed (or successful) pings has no column for them; assign(...) rather
+    # than df.loc[:, ...] = ..., which keeps the old (float) dtype in pandas 2
+    df = df.assign(time=pd.to_datetime(df.loc[:, 'time']),
+                   **{state: df.loc[:, state].fillna(0).astype(int) if state in df.columns else 0
+                      for state in ['down', 'up']})
     df = df.set_index(['nanopi_id', 'time']).sort_index()
     return df
 
 
 if __name__ == '__main__':
 
-    source_dir = '/home/ubuntu/living-lab-visualize/data/ping/'
-    dest_dir = '/home/ubuntu/data/'
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', dest='config', default=None, help="configuration file (default: LLV_CONFIG or llv.ini)")
+    parser.add_argument('--site', dest='site', default=None, help="site to combine (default: LLV_SITE, or the only site)")
+    args = parser.parse_args()
+
+    site = config.get(args.site, args.config)
+    source_dir = site.data_path('ping')
+    dest_dir = site.sync_dir
 
     df = combine_pings(source_dir)
 
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
-import requests
 import pandas as pd
 from getpass import getpass
 import os
+import warnings
+import functools
+import threading
+import concurrent.futures
+import instrument
+import decoders
+
+# requests is imported by the functions that use it, so that
+# scripts which only work with local data don't pay for importing it
 
 
 # BASE_URL is the base API URL
+# config.py sets these and TIMEZONE for the site being worked on; see config.Site.apply()
 BASE_URL = "http://localhost:5000"
 NANOPI_URL = "{}/nanopi/".format(BASE_URL)
 IPERF3_URL = "{}/iperf3/".format(BASE_URL)
@@ -16,8 +25,63 @@ PING_URL = "{}/ping/".format(BASE_URL)
 
 TIMEZONE = 'America/Edmonton'
 
+# the most HTTP requests to the API that may be in flight at once, across all threads
+MAX_REQUESTS = int(os.environ.get('LLV_MAX_REQUESTS', '4'))
+
+_request_slots = threading.BoundedSemaphore(MAX_REQUESTS)
+
+# per-thread progress callback, set by fetch_all(...)
+_progress = threading.local()
+_print_lock = threading.Lock()
+
+
+def get_auth():
+    """Returns a requests auth object for the API.
+
+    The username and password are taken from the LLV_API_USERNAME and LLV_API_PASSWORD
+    environment variables if they are set, and asked for otherwise.
+    """
+    import requests
+    username = os.environ.get('LLV_API_USERNAME') or input("API Username: ")
+    password = os.environ.get('LLV_API_PASSWORD') or getpass(prompt="API Password: ")
+    return requests.auth.HTTPBasicAuth(username, password)
+
+
+def set_base_url(base_url):
+    """Points the endpoint URLs at a different API.
+
+    Arguments:
+    base_url - the base API URL, e.g. "http://localhost:5000"
+    """
+    global BASE_URL, NANOPI_URL, IPERF3_URL, JITTER_URL, LATENCY_URL, PING_URL
+    BASE_URL = base_url
+    NANOPI_URL = "{}/nanopi/".format(base_url)
+    IPERF3_URL = "{}/iperf3/".format(base_url)
+    JITTER_URL = "{}/jitter/".format(base_url)
+    LATENCY_URL = "{}/sockperf/".format(base_url)
+    PING_URL = "{}/ping/".format(base_url)
+
+
+def set_max_requests(count):
+    """Sets the most HTTP requests to the API that may be in flight at once, across all threads.
+
+    Arguments:
+    count - the number of requests
+    """
+    global MAX_REQUESTS, _request_slots
+    MAX_REQUESTS = count
+    _request_slots = threading.BoundedSemaphore(count)
+
 
-def get_from_api(url, auth, params):
+def _get(url, auth, params=None):
+    import requests
+    with _request_slots:
+        response = requests.get(url, auth=auth, params=params)
+    response.raise_for_status()
+    return response
+
+
+def get_from_api(url, auth, params, decoder=None):
     """Pages through the REST API and retrieves all the data for a certain set of parameters.
 
     Very similar to  a regular call to requests.get(...).json(),
@@ -29,22 +93,27 @@ def get_from_api(url, auth, params):
     url - the url that will be requested
     auth - the requests auth object; see requests docs
     params - a dict containing URL parameters for API requests; see requests docs
+    decoder - the JSON decoder to use, from decoders.get(...); defaults to decoders.get()
     """
-    results = []
-    response = requests.get(url, auth=auth, params=params)
-    response.raise_for_status()
-    json = response.json()
-    for result in json.get('results'):
-        results.append(result)
-    url = json.get('next')
-
-    while url:
-        response = requests.get(url, auth=auth)
-        response.raise_for_status()
-        json = response.json()
-        for result in json.get('results'):
-            results.append(result)
-        url = json.get('next')
+    decoder = decoder or decoders.get()
+    endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+    progress = getattr(_progress, 'callback', None)
+    with instrument.stage('fetch.' + endpoint, pages=0, bytes=0) as stage:
+        results = []
+        while url:
+            response = _get(url, auth, params)
+            # the next url already contains the parameters
+            params = None
+            stage['pages'] += 1
+            stage['bytes'] += len(response.content)
+            json = decoder.loads(response.content)
+            for result in json.get('results'):
+                results.append(result)
+            url = json.get('next')
+            if progress:
+                progress(stage['pages'], len(results), json.get('count'), url is None)
+
+        stage['rows_out'] = len(results)
 
     return results
 
@@ -58,67 +127,77 @@ def get_nanopi_list(auth, params=None):
     auth - the requests auth object; see requests docs
     params - a dict containing URL parameters for the request; see requests docs
     """
-    response = requests.get(NANOPI_URL, auth=auth, params=params)
-    response.raise_for_status()
-    return response.json()
+    return _get(NANOPI_URL, auth, params).json()
 
 
-def get_bandwidth_dataframe(auth, params=None):
-    """Gets bandwidth data from the API and formats it as a pandas dataframe.
+def reindex_hourly(df, directions=None):
+    """Re-indexes a dataframe onto the full hourly grid so that missing data shows up as NaN rows.
+
+    The grid covers every hour from the first to the last datetime in df,
+    every NanoPi in df and, if given, every direction. The resulting index is
+    lexsorted (by datetime, then nanopi, then direction), so that slicing it is fast.
+    Assumes that df is sorted by datetime.
 
     Arguments:
-    auth - the requests auth object; see requests docs
-    params - a dict containing URL parameters for API requests; see requests docs
+    df - a dataframe indexed by (datetime, nanopi) or (datetime, nanopi, direction)
+    directions - a list of directions, e.g. ['up', 'down'], or None if df has no direction level
     """
-    # get list of results from API with given parameters
-    print("Getting raw data from API...")
-    results = get_from_api(IPERF3_URL, auth, params)
+    start = df.index.get_level_values('datetime')[0]
+    end = df.index.get_level_values('datetime')[-1]
+    iterables = [
+        pd.date_range(start, end=end, freq='H'),
+        sorted(set(df.index.get_level_values('nanopi')))
+    ]
+    names = ['datetime', 'nanopi']
+    if directions is not None:
+        iterables.append(sorted(directions))
+        names.append('direction')
+    new_index = pd.MultiIndex.from_product(iterables, names=names)
+    return df.reindex(index=new_index)
 
-    # put initial multiindex together
-    print("Putting initial dataframe together...")
+
+def parse_bandwidth(results):
+    """Formats a list of bandwidth results from the API as a pandas dataframe, before removing duplicates.
+
+    Arguments:
+    results - a list of results, e.g. one page of them
+    """
     for result in results:
         result['upload_date'] = pd.Timestamp(result.get('upload_date'))
     index_tuples = [[x.get('upload_date').floor('H'), x.get('nanopi'), x.get('direction')] for x in results]
     index = pd.MultiIndex.from_tuples(index_tuples, names=['datetime', 'nanopi', 'direction'])
 
     # parse bulk of data
-    df = pd.DataFrame({'id': [x.get('id') for x in results],
-                       'bandwidth': [x.get('bandwidth') for x in results],
-                       'upload_date': [x.get('upload_date') for x in results]},
-                      index=index)
+    return pd.DataFrame({'id': [x.get('id') for x in results],
+                         'bandwidth': [x.get('bandwidth') for x in results],
+                         'upload_date': [x.get('upload_date') for x in results]},
+                        index=index)
 
-    # remove duplicates
-    print("Removing duplicates...")
-    df1 = df.loc[~df.index.duplicated(keep='last'), :]
 
-    # reindex to highlight missing data
-    print("Re-indexing dataframe...")
-    start = df.index.get_level_values('datetime')[0]
-    end = df.index.get_level_values('datetime')[-1]
-    iterables = [
-        pd.date_range(start, end=end, freq='H'),
-        set(df.index.get_level_values('nanopi')),
-        ['up', 'down']
-    ]
-    new_index = pd.MultiIndex.from_product(iterables, names=['datetime', 'nanopi', 'direction'])
-    df2 = df1.reindex(index=new_index)
+def parse_jitter(results):
+    """Formats a list of jitter results from the API as a pandas dataframe, before removing duplicates.
 
-    return df2
+    Arguments:
+    results - a list of results, e.g. one page of them
+    """
+    for result in results:
+        result['upload_date'] = pd.Timestamp(result.get('upload_date'))
+    index_tuples = [[x.get('upload_date').floor('H'), x.get('nanopi')] for x in results]
+    index = pd.MultiIndex.from_tuples(index_tuples, names=['datetime', 'nanopi'])
 
+    # parse bulk of data
+    return pd.DataFrame({'id': [x.get('id') for x in results],
+                         'jitter': [x.get('jitter') for x in results],
+                         'upload_date': [x.get('upload_date') for x in results]},
+                        index=index)
 
-def get_jitter_dataframe(auth, params=None):
-    """Gets jitter data from the API and formats it as a pandas dataframe.
+
+def parse_latency(results):
+    """Formats a list of latency results from the API as a pandas dataframe, before removing duplicates.
 
     Arguments:
-    auth - the requests auth object; see requests docs
-    params - a dict containing URL parameters for API requests; see requests docs
+    results - a list of results, e.g. one page of them
     """
-    # get list of results from API with given parameters
-    print("Getting raw data from API...")
-    results = get_from_api(JITTER_URL, auth, params)
-
-    # put initial multiindex together
-    print("Putting initial dataframe together...")
     for result in results:
         result['upload_date'] = pd.Timestamp(result.get('upload_date'))
     index_tuples = [[x.get('upload_date').floor('H'), x.get('nanopi')] for x in results]
@@ -126,70 +205,159 @@ def get_jitter_dataframe(auth, params=None):
 
     # parse bulk of data
     df = pd.DataFrame({'id': [x.get('id') for x in results],
-                       'jitter': [x.get('jitter') for x in results],
+                       'latency': [x.get('latency') for x in results],
                        'upload_date': [x.get('upload_date') for x in results]},
                       index=index)
+    df.loc[:, 'latency'] = df.loc[:, 'latency']/1000
+    return df
+
+
+def parse_ping(results):
+    """Formats a list of ping results from the API as a pandas dataframe, before sorting it.
+
+    Arguments:
+    results - a list of results, e.g. one page of them
+    """
+    for result in results:
+        result['upload_date'] = pd.Timestamp(result.get('upload_date'))
+        result['time'] = pd.Timestamp(result.get('time')).tz_convert(TIMEZONE)
+    index_tuples = [[x.get('time'), x.get('nanopi')] for x in results]
+    index = pd.MultiIndex.from_tuples(index_tuples, names=['datetime', 'nanopi'])
+
+    # parse bulk of data
+    return pd.DataFrame({'id': [x.get('id') for x in results],
+                         'state': [x.get('state') for x in results],
+                         'upload_date': [x.get('upload_date') for x in results]},
+                        index=index)
+
+
+def _to_datetimes(values):
+    # parses ISO 8601 strings all at once, falling back to one at a time (as the parse_XX functions do)
+    # if they don't all have the same UTC offset; times the decoders already parsed are in UTC
+    if getattr(values, 'dtype', None) is not None and values.dtype.kind == 'M':
+        return pd.DatetimeIndex(values).tz_localize('UTC')
+    if all(isinstance(value, str) and value.endswith('Z') for value in values):
+        # pandas is much slower with a UTC offset in the strings than without one
+        return pd.to_datetime(pd.Index([value[:-1] for value in values], dtype=object),
+                              format='ISO8601').tz_localize('UTC')
+    try:
+        with warnings.catch_warnings():
+            # pandas warns about mixed offsets before returning an Index of objects
+            warnings.simplefilter('ignore', category=FutureWarning)
+            times = pd.to_datetime(pd.Index(values, dtype=object), format='ISO8601')
+    except (ValueError, TypeError):
+        times = None
+    if not isinstance(times, pd.DatetimeIndex) or times.tz is None:
+        times = pd.Index([pd.Timestamp(value) for value in values])
+    return times
+
+
+def parse_columns(metric, columns):
+    """Formats columns of results as a pandas dataframe, the same as the parse_XX(...) functions do with results.
+
+    Parsing columns is much faster than parsing results one at a time: the times are all
+    parsed at once and the columns go straight into the dataframe.
+
+    Arguments:
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    columns - a dict of arrays (or lists), one per field, e.g. from decoders.get().columns(content, metric)
+    """
+    upload_date = _to_datetimes(columns['upload_date'])
+    if metric == 'ping':
+        times = _to_datetimes(columns['time'])
+        arrays = [times.tz_convert(TIMEZONE) if isinstance(times, pd.DatetimeIndex)
+                  else pd.Index([time.tz_convert(TIMEZONE) for time in times]), columns['nanopi']]
+        names = ['datetime', 'nanopi']
+    else:
+        hours = (upload_date.floor('H') if isinstance(upload_date, pd.DatetimeIndex)
+                 else pd.Index([time.floor('H') for time in upload_date]))
+        arrays = [hours, columns['nanopi']]
+        names = ['datetime', 'nanopi']
+        if metric == 'bandwidth':
+            arrays.append(columns['direction'])
+            names.append('direction')
+    index = pd.MultiIndex.from_arrays(arrays, names=names)
+    value = {'bandwidth': 'bandwidth', 'jitter': 'jitter', 'latency': 'latency', 'ping': 'state'}[metric]
+    df = pd.DataFrame({'id': columns['id'], value: columns[value], 'upload_date': upload_date},
+                      index=index)
+    if metric == 'latency':
+        df.loc[:, 'latency'] = df.loc[:, 'latency']/1000
+    return df
+
+
+def finalize(metric, df):
+    """Finishes a dataframe made by one of the parse_XX(...) functions (or several of them concatenated).
+
+    Removes duplicates and re-indexes bandwidth, jitter and latency dataframes onto the hourly grid,
+    and sorts ping dataframes. The number of duplicates removed is kept in df.attrs['duplicates'].
+
+    Arguments:
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    df - the dataframe
+    """
+    if metric == 'ping':
+        return df.sort_index()
 
     # remove duplicates
     print("Removing duplicates...")
-    df1 = df.loc[~df.index.duplicated(keep='last'), :]
+    with instrument.stage('{}.dedupe'.format(metric), rows_in=len(df)) as stage:
+        df1 = df.loc[~df.index.duplicated(keep='last'), :]
+        stage['rows_out'] = len(df1)
 
     # reindex to highlight missing data
     print("Re-indexing dataframe...")
-    start = df.index.get_level_values('datetime')[0]
-    end = df.index.get_level_values('datetime')[-1]
-    iterables = [
-        pd.date_range(start, end=end, freq='H'),
-        set(df.index.get_level_values('nanopi'))
-    ]
-    new_index = pd.MultiIndex.from_product(iterables, names=['datetime', 'nanopi'])
-    df2 = df1.reindex(index=new_index)
+    with instrument.stage('{}.reindex'.format(metric), rows_in=len(df1)) as stage:
+        df2 = reindex_hourly(df1, directions=['up', 'down'] if metric == 'bandwidth' else None)
+        stage['rows_out'] = len(df2)
+
+    # kept for data-quality reports; see quality.py
+    df2.attrs['duplicates'] = len(df) - len(df1)
 
     return df2
 
 
-def get_latency_dataframe(auth, params=None):
-    """Gets latency data from the API and formats it as a pandas dataframe.
+def _get_dataframe(metric, url, parse, auth, params):
+    # get list of results from API with given parameters
+    print("Getting raw data from API...")
+    results = get_from_api(url, auth, params)
+
+    # put initial multiindex together
+    print("Putting initial dataframe together...")
+    with instrument.stage('{}.build'.format(metric), rows_in=len(results)) as stage:
+        df = parse(results)
+        stage['rows_out'] = len(df)
+
+    return finalize(metric, df)
+
+
+def get_bandwidth_dataframe(auth, params=None):
+    """Gets bandwidth data from the API and formats it as a pandas dataframe.
 
     Arguments:
     auth - the requests auth object; see requests docs
     params - a dict containing URL parameters for API requests; see requests docs
     """
+    return _get_dataframe('bandwidth', IPERF3_URL, parse_bandwidth, auth, params)
 
-    # get list of results from API with given parameters
-    print("Getting raw data from API...")
-    results = get_from_api(LATENCY_URL, auth, params)
 
-    # put initial multiindex together
-    print("Putting initial dataframe together...")
-    for result in results:
-        result['upload_date'] = pd.Timestamp(result.get('upload_date'))
-    index_tuples = [[x.get('upload_date').floor('H'), x.get('nanopi')] for x in results]
-    index = pd.MultiIndex.from_tuples(index_tuples, names=['datetime', 'nanopi'])
+def get_jitter_dataframe(auth, params=None):
+    """Gets jitter data from the API and formats it as a pandas dataframe.
 
-    # parse bulk of data
-    df = pd.DataFrame({'id': [x.get('id') for x in results],
-                       'latency': [x.get('latency') for x in results],
-                       'upload_date': [x.get('upload_date') for x in results]},
-                      index=index)
-    df.loc[:, 'latency'] = df.loc[:, 'latency']/1000
+    Arguments:
+    auth - the requests auth object; see requests docs
+    params - a dict containing URL parameters for API requests; see requests docs
+    """
+    return _get_dataframe('jitter', JITTER_URL, parse_jitter, auth, params)
 
-    # remove duplicates
-    print("Removing duplicates...")
-    df1 = df.loc[~df.index.duplicated(keep='last'), :]
 
-    # reindex to highlight missing data
-    print("Re-indexing dataframe...")
-    start = df.index.get_level_values('datetime')[0]
-    end = df.index.get_level_values('datetime')[-1]
-    iterables = [
-        pd.date_range(start, end=end, freq='H'),
-        set(df.index.get_level_values('nanopi'))
-    ]
-    new_index = pd.MultiIndex.from_product(iterables, names=['datetime', 'nanopi'])
-    df2 = df1.reindex(index=new_index)
+def get_latency_dataframe(auth, params=None):
+    """Gets latency data from the API and formats it as a pandas dataframe.
 
-    return df2
+    Arguments:
+    auth - the requests auth object; see requests docs
+    params - a dict containing URL parameters for API requests; see requests docs
+    """
+    return _get_dataframe('latency', LATENCY_URL, parse_latency, auth, params)
 
 
 def get_ping_dataframe(auth, params={'state': 'down'}):
@@ -199,40 +367,118 @@ def get_ping_dataframe(auth, params={'state': 'down'}):
     auth - the requests auth object; see requests docs
     params - a dict containing URL parameters for API requests; see requests docs
     """
+    return _get_dataframe('ping', PING_URL, parse_ping, auth, params)
 
-    # get list of results from API with given parameters
-    print("Getting raw data from API...")
-    results = get_from_api(PING_URL, auth, params)
 
-    # put initial multiindex together
-    print("Putting initial dataframe together...")
-    for result in results:
-        result['upload_date'] = pd.Timestamp(result.get('upload_date'))
-        result['time'] = pd.Timestamp(result.get('time')).tz_convert(TIMEZONE)
-    index_tuples = [[x.get('time'), x.get('nanopi')] for x in results]
-    index = pd.MultiIndex.from_tuples(index_tuples, names=['datetime', 'nanopi'])
+def write_snapshot(df, path):
+    """Writes a dataframe to an HDF5 snapshot, which read_snapshot(...) reads back.
 
-    # parse bulk of data
-    df = pd.DataFrame({'id': [x.get('id') for x in results],
-                       'state': [x.get('state') for x in results],
-                       'upload_date': [x.get('upload_date') for x in results]},
-                      index=index)
+    PyTables can't store an index level with a time zone, so the 'datetime' level is
+    stored as UTC without one.
 
+    Arguments:
+    df - the dataframe, e.g. from one of the get_XX_dataframe(...) functions
+    path - the .h5 file to write
+    """
+    level = df.index.names.index('datetime')
+    times = pd.to_datetime(df.index.levels[level], utc=True).tz_localize(None)
+    df.set_axis(df.index.set_levels(times, level=level)).to_hdf(path, 'df')
+
+
+def read_snapshot(path):
+    """Reads a dataframe written by write_snapshot(...), with its times in TIMEZONE again.
+
+    Arguments:
+    path - the .h5 file to read
+    """
+    df = pd.read_hdf(path, 'df')
+    level = df.index.names.index('datetime')
+    times = df.index.levels[level]
+    if times.tz is None:
+        df.index = df.index.set_levels(times.tz_localize('UTC').tz_convert(TIMEZONE), level=level)
     return df
 
 
-if __name__ == '__main__':
+def print_progress(name, pages, rows, total, done):
+    """Prints the progress of one of the fetches run by fetch_all(...).
 
-    username = input("API Username: ")
-    password = getpass(prompt="API Password: ")
-    auth = requests.auth.HTTPBasicAuth(username, password)
+    Prints the first page, every tenth page and the last page, so that
+    several fetches running at once don't flood the terminal.
 
-    try:
-        os.mkdir('data')
-    except OSError:
-        pass
-
-    get_bandwidth_dataframe(auth).to_hdf('data/bandwidth.h5', 'df')
-    get_jitter_dataframe(auth).to_hdf('data/jitter.h5', 'df')
-    get_latency_dataframe(auth).to_hdf('data/latency.h5', 'df')
-    get_ping_dataframe(auth).to_hdf('data/ping.h5', 'df')
+    Arguments:
+    name - the name of the fetch, e.g. 'jitter'
+    pages - the number of pages fetched so far
+    rows - the number of rows fetched so far
+    total - the total number of rows, as reported by the API, or None if unknown
+    done - whether this was the last page
+    """
+    if pages == 1 or pages % 10 == 0 or done:
+        with _print_lock:
+            print("{}: {} page(s), {} of {} rows{}".format(
+                name, pages, rows, total if total is not None else '?', ', done' if done else ''))
+
+
+def fetch_all(tasks, max_workers=None, progress=print_progress):
+    """Runs several fetches (or any other functions) at the same time, one thread each.
+
+    The fetches share the limit of MAX_REQUESTS requests in flight (see set_max_requests(...)),
+    so the API isn't overloaded, but otherwise don't wait for each other: the total time is
+    about that of the slowest fetch rather than the sum of all of them.
+    If any of the functions fails, the others still run to the end and the first exception
+    is then raised.
+
+    Arguments:
+    tasks - a list of (name, function) pairs; each function is called without arguments
+            and would typically fetch a dataframe and save it
+    max_workers - the number of threads; defaults to one per task
+    progress - a function called as progress(name, pages, rows, total, done) after every page
+               fetched with get_from_api(...), or None
+    """
+    tasks = list(tasks)
+
+    def run(name, func):
+        _progress.callback = (lambda *args: progress(name, *args)) if progress else None
+        try:
+            return func()
+        finally:
+            _progress.callback = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or max(1, len(tasks))) as executor:
+        futures = [executor.submit(run, name, func) for name, func in tasks]
+    return {name: future.result() for (name, _), future in zip(tasks, futures)}
+
+
+if __name__ == '__main__':
+
+    # the settings are applied to the common module that the other modules import, rather than to this script
+    import common
+    import config
+    import archive
+
+    site = config.get().apply()
+    auth = site.auth()
+    data_dir = site.data_path()
+    os.makedirs(data_dir, exist_ok=True)
+
+    # PyTables isn't thread-safe, so only one snapshot is written at a time
+    hdf_lock = threading.Lock()
+
+    def fetch_and_save(metric, get_dataframe):
+        df = get_dataframe(auth)
+        archive.write(df, metric, os.path.join(data_dir, 'archive'))
+        if metric == 'ping':
+            import rollup
+            counts = rollup.Rollup(os.path.join(data_dir, 'rollup'))
+            counts.update(df, source='api')
+            counts.save()
+        with hdf_lock:
+            common.write_snapshot(df, os.path.join(data_dir, '{}.h5'.format(metric)))
+        print("{}: saved".format(metric))
+
+    common.fetch_all([(metric, functools.partial(fetch_and_save, metric, get_dataframe))
+                      for metric, get_dataframe in [('bandwidth', common.get_bandwidth_dataframe),
+                                                    ('jitter', common.get_jitter_dataframe),
+                                                    ('latency', common.get_latency_dataframe),
+                                                    ('ping', common.get_ping_dataframe)]])
+
+    instrument.summary()
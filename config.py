@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# Deployment settings: which API to use, where to keep data, and so on, for one or several sites.
+#
+# Settings are read, each overriding the one before, from:
+#
+#   1. the defaults in DEFAULTS below, which match a single deployment on its own server
+#   2. a configuration file: llv.ini in the current directory, or the file named by LLV_CONFIG
+#   3. environment variables: LLV_<KEY> for every site, then LLV_<SITE>_<KEY> for one site
+#      (e.g. LLV_BASE_URL, LLV_EDMONTON_BASE_URL)
+#   4. overrides given on the command line (./cli.py --set KEY=VALUE)
+#
+# Every section of the configuration file except [DEFAULT] is a site:
+#
+#     [DEFAULT]
+#     timezone = America/Edmonton
+#
+#     [edmonton]
+#     base_url = http://edmonton.example.org:5000
+#     data_dir = sites/edmonton/data
+#     sync_dir = sites/edmonton/csv
+#
+#     [calgary]
+#     base_url = http://calgary.example.org:5000
+#     data_dir = sites/calgary/data
+#     sync_dir = sites/calgary/csv
+#
+# If there are no sections, there is a single site called 'default'. Credentials can be set
+# with username and password, but are better kept in LLV_<SITE>_API_USERNAME and
+# LLV_<SITE>_API_PASSWORD (or LLV_API_USERNAME and LLV_API_PASSWORD) than in the file.
+#
+# The rest of the code reads its settings from module constants, such as common.BASE_URL.
+# Site.apply() sets them, so a process works for one site at a time. run(...) works for several
+# sites at once with a pool of processes, one site per process, so each site's connections,
+# caches and settings stay apart. ./config.py prints the settings of every site.
+
+import os
+import sys
+import argparse
+import configparser
+import multiprocessing
+from collections import OrderedDict
+
+
+CONFIG_PATH = 'llv.ini'
+
+# the directory of the scripts, which relative paths in data_path(...) are taken from
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SITE = 'default'
+
+DEFAULTS = OrderedDict([
+    ('base_url', 'http://localhost:5000'),
+    ('timezone', 'America/Edmonton'),
+    # where ./cli.py fetch keeps HDF5 snapshots, archives and rollups, and where ./cli.py plot reads them
+    ('data_dir', 'data'),
+    # where ./cli.py sync and to_csv.py write CSV files
+    ('sync_dir', '/home/ubuntu/data'),
+    # where ./cli.py plot writes plots
+    ('plot_dir', '.'),
+    # how to_csv.py writes the metrics: 'plain' (<metric>.csv, as pandas writes them) or
+    # 'compact' (<metric>.csv.gz without the hours with no data; see export.py)
+    ('export_format', 'plain'),
+    # the database of the API server, read by get_ping.py
+    ('sqlite_path', '/home/ubuntu/management/app/db.sqlite3'),
+    ('max_requests', '4'),
+    ('username', ''),
+    ('password', ''),
+])
+
+# environment variables whose names don't follow LLV_<KEY>
+ENVIRONMENT_NAMES = {'username': 'API_USERNAME', 'password': 'API_PASSWORD'}
+
+
+class Site:
+    """The settings of one deployment.
+
+    Every key in DEFAULTS is an attribute, e.g. site.base_url.
+
+    Arguments:
+    name - the name of the site
+    settings - a dict of settings; missing ones take their default
+    """
+
+    def __init__(self, name, settings=None):
+        self.name = name
+        values = OrderedDict(DEFAULTS)
+        values.update(settings or {})
+        unknown = [key for key in values if key not in DEFAULTS]
+        if unknown:
+            raise ValueError("unknown setting(s) for site {}: {}".format(name, ', '.join(unknown)))
+        for key, value in values.items():
+            setattr(self, key, value)
+        self.base_url = self.base_url.rstrip('/')
+        self.max_requests = int(self.max_requests)
+
+    def __repr__(self):
+        return 'Site({!r}, base_url={!r})'.format(self.name, self.base_url)
+
+    def settings(self, hide_password=True):
+        """Returns the settings as a dict."""
+        values = OrderedDict((key, getattr(self, key)) for key in DEFAULTS)
+        if hide_password and values['password']:
+            values['password'] = '********'
+        return values
+
+    def auth(self, interactive=None):
+        """Returns a requests auth object for the site's API, asking for the username and password if they aren't set.
+
+        Arguments:
+        interactive - whether to ask for missing credentials rather than raise a ValueError;
+                      defaults to whether standard input is a terminal, so scripts run by cron fail at once
+        """
+        import requests
+        if not (self.username and self.password):
+            self.ask_credentials(interactive)
+        return requests.auth.HTTPBasicAuth(self.username, self.password)
+
+    def ask_credentials(self, interactive=None):
+        """Asks for the username and password of the site's API, if they aren't set; see auth(...)."""
+        from getpass import getpass
+        if interactive is None:
+            interactive = sys.stdin is not None and sys.stdin.isatty()
+        if not interactive and not (self.username and self.password):
+            site_variable = 'LLV_{}_API'.format(self.name.upper().replace('-', '_'))
+            raise ValueError("no API credentials for site {}: set {}_USERNAME and {}_PASSWORD (or LLV_API_USERNAME "
+                             "and LLV_API_PASSWORD), or username and password in the configuration file".format(
+                                 self.name, site_variable, site_variable))
+        if not self.username:
+            self.username = input("API Username for {}: ".format(self.name))
+        if not self.password:
+            self.password = getpass(prompt="API Password for {}: ".format(self.name))
+
+    def data_path(self, *parts):
+        """Returns the absolute path of a file or directory in data_dir, taking a relative data_dir
+        to be in the repository, so that scripts run by cron find it whatever directory they run in."""
+        return os.path.join(REPO_DIR, self.data_dir, *parts)
+
+    def apply(self):
+        """Points this process at the site: sets the URLs and timezone in common.py and the request limit."""
+        # imported here, so that reading the settings doesn't import pandas
+        import common
+        common.set_base_url(self.base_url)
+        common.TIMEZONE = self.timezone
+        common.set_max_requests(self.max_requests)
+        return self
+
+
+def _environment(key, site_name, environ):
+    name = ENVIRONMENT_NAMES.get(key, key.upper())
+    site_variable = 'LLV_{}_{}'.format(site_name.upper().replace('-', '_'), name)
+    return environ.get(site_variable, environ.get('LLV_{}'.format(name)))
+
+
+def load(path=None, overrides=None, environ=None):
+    """Returns an OrderedDict where the keys are site names and the values are Sites.
+
+    Arguments:
+    path - the configuration file; defaults to LLV_CONFIG, or llv.ini if it exists
+    overrides - a dict of settings that override all others, for every site
+    environ - the environment variables; defaults to os.environ
+    """
+    environ = os.environ if environ is None else environ
+    path = path or environ.get('LLV_CONFIG')
+    parser = configparser.ConfigParser(interpolation=None)
+    if path:
+        with open(path, 'rt') as file:
+            parser.read_file(file)
+    elif os.path.exists(CONFIG_PATH):
+        parser.read(CONFIG_PATH)
+
+    names = parser.sections() or [DEFAULT_SITE]
+    sites = OrderedDict()
+    for name in names:
+        section = parser[name] if parser.has_section(name) else parser.defaults()
+        settings = OrderedDict((key, section[key]) for key in section)
+        for key in DEFAULTS:
+            value = _environment(key, name, environ)
+            if value is not None:
+                settings[key] = value
+        settings.update(overrides or {})
+        sites[name] = Site(name, settings)
+    return sites
+
+
+def get(name=None, path=None, overrides=None):
+    """Returns the settings of one site.
+
+    Arguments:
+    name - the name of the site; defaults to LLV_SITE, or the only site there is
+    path - the configuration file; see load(...)
+    overrides - a dict of settings that override all others
+    """
+    return select(load(path, overrides), [name] if name else None)[0]
+
+
+def select(sites, names=None):
+    """Returns a list of the named sites.
+
+    Arguments:
+    sites - a dict returned by load(...)
+    names - a list of site names, where 'all' means every site; defaults to LLV_SITE, or the only site there is
+    """
+    if not names:
+        names = [os.environ['LLV_SITE']] if os.environ.get('LLV_SITE') else None
+    if not names:
+        if len(sites) > 1:
+            raise ValueError("choose a site: {}, or all".format(', '.join(sites)))
+        return list(sites.values())
+    if 'all' in names:
+        return list(sites.values())
+    unknown = [name for name in names if name not in sites]
+    if unknown:
+        raise ValueError("unknown site(s) {} (choose from {})".format(', '.join(unknown), ', '.join(sites)))
+    return [sites[name] for name in names]
+
+
+def parse_overrides(items):
+    """Turns a list of 'KEY=VALUE' strings into a dict of settings."""
+    overrides = OrderedDict()
+    for item in items or []:
+        key, separator, value = item.partition('=')
+        if not separator or key not in DEFAULTS:
+            raise ValueError("expected KEY=VALUE with KEY one of {}, got {}".format(', '.join(DEFAULTS), item))
+        overrides[key] = value
+    return overrides
+
+
+def _run_site(func, site, args):
+    site.apply()
+    return func(site, *args)
+
+
+def run(func, sites, *args, processes=None):
+    """Calls func(site, *args) for each site in a pool of processes, each site in a process of its own.
+
+    Every process starts afresh and applies its site's settings before calling func, so sites
+    don't share connections, caches or module settings. func and args must be picklable,
+    e.g. func must be defined at the top level of a module. Returns a dict where the keys
+    are site names and the values are what func returned; an exception in any site is
+    raised once every site has finished.
+
+    Arguments:
+    func - the function to call
+    sites - a list of Sites
+    processes - the most sites worked on at once; defaults to all of them
+    """
+    sites = list(sites)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes or len(sites), maxtasksperchild=1) as pool:
+        pending = [(site.name, pool.apply_async(_run_site, (func, site, args))) for site in sites]
+        results = OrderedDict()
+        errors = []
+        for name, result in pending:
+            try:
+                results[name] = result.get()
+            except Exception as e:
+                print("{}: failed: {}".format(name, e))
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Prints the settings of every site.")
+    parser.add_argument('-c', dest='config', default=None, help="configuration file (default: LLV_CONFIG or llv.ini)")
+    parser.add_argument('--set', dest='overrides', action='append', metavar='KEY=VALUE', help="override a setting")
+    args = parser.parse_args()
+
+    for site in load(args.config, parse_overrides(args.overrides)).values():
+        print("[{}]".format(site.name))
+        for key, value in site.settings().items():
+            print("{} = {}".format(key, value))
+        print()
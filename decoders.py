@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Pluggable JSON decoders for pages from the API.
+#
+# Every decoder can decode a page into plain Python objects (loads(...)), which is what
+# common.get_from_api(...) uses, or straight into one typed numpy array per field (columns(...)),
+# which common.parse_columns(...) turns into a dataframe without pandas inferring and converting
+# the type of every value again. Three decoders are available:
+#
+#   stdlib    the json module; always available
+#   orjson    the orjson package, several times faster than json
+#   msgspec   the msgspec package, decoding each endpoint into typed structs that only
+#             contain the fields the loaders use, so the rest of each result is skipped
+#
+# get() returns the fastest one that is installed, or the one named by the LLV_JSON_DECODER
+# environment variable. ./decoders.py compares them on synthetic pages.
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+
+# the fields of each metric's results that the loaders use
+FIELDS = {
+    'bandwidth': ['id', 'nanopi', 'direction', 'bandwidth', 'upload_date'],
+    'jitter': ['id', 'nanopi', 'jitter', 'upload_date'],
+    'latency': ['id', 'nanopi', 'latency', 'upload_date'],
+    'ping': ['id', 'nanopi', 'state', 'time', 'upload_date'],
+}
+
+# fastest first
+PREFERENCE = ['msgspec', 'orjson', 'stdlib']
+
+
+def _integers(values):
+    try:
+        return np.array(values, dtype=np.int64)
+    except TypeError:
+        # some are missing, which int64 can't hold
+        return np.array(values, dtype=np.float64)
+
+
+def _floats(values):
+    # missing values become NaN
+    return np.array(values, dtype=np.float64)
+
+
+def _strings(values):
+    return np.array(values, dtype=object)
+
+
+def _datetimes(values):
+    # the API gives times in UTC, e.g. '2018-05-30T22:30:00.000000Z', which numpy parses much faster
+    # without the 'Z'; times with other offsets (or missing ones) are left as strings for pandas
+    if all(isinstance(value, str) and value.endswith('Z') for value in values):
+        try:
+            return np.array([value[:-1] for value in values], dtype='datetime64[ns]')
+        except ValueError:
+            pass
+    return np.array(values, dtype=object)
+
+
+# how each field is converted to an array
+COLUMN_TYPES = {'id': _integers, 'nanopi': _integers, 'direction': _strings, 'state': _strings,
+                'bandwidth': _floats, 'jitter': _floats, 'latency': _floats,
+                'upload_date': _datetimes, 'time': _datetimes}
+
+
+class StdlibDecoder:
+    """Decodes pages with the json module from the standard library."""
+
+    name = 'stdlib'
+
+    def loads(self, content):
+        """Decodes a page (bytes or str) into Python objects."""
+        return json.loads(content)
+
+    def columns(self, content, metric):
+        """Decodes a page of results into columns.
+
+        Returns a tuple of (columns, count, next), where columns is a dict of numpy arrays, one
+        per field in FIELDS[metric], count is the total number of results and next is the URL of
+        the next page (or None). IDs are int64 (float64 with NaN if any are missing), values are
+        float64, times are datetime64[ns] in UTC (or strings, if any aren't in UTC) and
+        directions and states are strings; see COLUMN_TYPES.
+
+        Arguments:
+        content - the body of the response, as bytes or str
+        metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+        """
+        page = self.loads(content)
+        results = page.get('results') or []
+        columns = {field: COLUMN_TYPES[field]([result.get(field) for result in results])
+                   for field in FIELDS[metric]}
+        return columns, page.get('count'), page.get('next')
+
+
+class OrjsonDecoder(StdlibDecoder):
+    """Decodes pages with the orjson package."""
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+
+
+class MsgspecDecoder(StdlibDecoder):
+    """Decodes pages with the msgspec package, into typed structs for the results of each endpoint."""
+
+    name = 'msgspec'
+
+    def __init__(self):
+        import msgspec
+        from typing import Optional, List
+
+        self.loads = msgspec.json.decode
+        # missing or null fields are None, as with dict.get(...); fields not listed here are skipped
+        optional = Optional[int], Optional[str], Optional[float]
+        types = {'id': optional[0], 'nanopi': optional[0], 'direction': optional[1], 'state': optional[1],
+                 'upload_date': optional[1], 'time': optional[1],
+                 'bandwidth': optional[2], 'jitter': optional[2], 'latency': optional[2]}
+        self._decoders = {}
+        for metric, fields in FIELDS.items():
+            result = msgspec.defstruct('{}Result'.format(metric.capitalize()),
+                                       [(field, types[field], None) for field in fields])
+            page = msgspec.defstruct('{}Page'.format(metric.capitalize()),
+                                     [('count', Optional[int], None), ('next', Optional[str], None),
+                                      ('results', List[result], [])])
+            self._decoders[metric] = msgspec.json.Decoder(page)
+
+    def columns(self, content, metric):
+        page = self._decoders[metric].decode(content)
+        results = page.results
+        columns = {field: COLUMN_TYPES[field]([getattr(result, field) for result in results])
+                   for field in FIELDS[metric]}
+        return columns, page.count, page.next
+
+
+DECODERS = {'stdlib': StdlibDecoder, 'orjson': OrjsonDecoder, 'msgspec': MsgspecDecoder}
+
+
+def concatenate(parts, metric):
+    """Joins the columns of several pages, from columns(...), into one dict of arrays.
+
+    Arguments:
+    parts - a list of dicts of arrays, e.g. one per page
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    """
+    columns = {}
+    for field in FIELDS[metric]:
+        arrays = [part[field] for part in parts]
+        if any(array.dtype == object for array in arrays):
+            # times in UTC on some pages and with other offsets on others are all left as strings
+            arrays = [np.char.add(np.datetime_as_string(array), 'Z').astype(object) if array.dtype.kind == 'M'
+                      else array for array in arrays]
+        columns[field] = np.concatenate(arrays) if arrays else COLUMN_TYPES[field]([])
+    return columns
+
+
+_instances = {}
+
+
+def available():
+    """Returns the names of the decoders that can be used here, fastest first."""
+    names = []
+    for name in PREFERENCE:
+        try:
+            get(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get(name=None):
+    """Returns a decoder.
+
+    Arguments:
+    name - 'stdlib', 'orjson' or 'msgspec'; None means the one named by the LLV_JSON_DECODER
+           environment variable, or else the fastest one that is installed
+    """
+    name = name or os.environ.get('LLV_JSON_DECODER')
+    if name is None:
+        for name in PREFERENCE:
+            try:
+                return get(name)
+            except ImportError:
+                pass
+    if name not in DECODERS:
+        raise ValueError("the decoder must be one of {}".format(', '.join(PREFERENCE)))
+    decoder = _instances.get(name)
+    if decoder is None:
+        decoder = DECODERS[name]()
+        _instances[name] = decoder
+    return decoder
+
+
+if __name__ == '__main__':
+
+    import common
+    import synthetic
+
+    parser = argparse.ArgumentParser(description="Compares the JSON decoders on synthetic pages.")
+    parser.add_argument('-n', dest='nanopis', default=10, type=int, help="number of NanoPis")
+    parser.add_argument('-d', dest='days', default=30, type=int, help="number of days")
+    parser.add_argument('-r', dest='repeat', default=3, type=int, help="repetitions; the best time is kept")
+    parser.add_argument('--page-size', dest='page_size', default=100, type=int)
+    args = parser.parse_args()
+
+    data = synthetic.generate(nanopis=args.nanopis, days=args.days)
+    endpoints = {'bandwidth': 'iperf3', 'jitter': 'jitter', 'latency': 'sockperf', 'ping': 'ping'}
+    parse = {'bandwidth': common.parse_bandwidth, 'jitter': common.parse_jitter,
+             'latency': common.parse_latency, 'ping': common.parse_ping}
+
+    def best(func):
+        seconds = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        return seconds
+
+    print("{:<10} {:<8} {:>8} {:>10} {:>10} {:>10}".format('metric', 'decoder', 'rows', 'loads', 'columns', 'dataframe'))
+    for metric, endpoint in endpoints.items():
+        records = data[endpoint]
+        url = '{}/{}/'.format(common.BASE_URL, endpoint)
+        pages = [json.dumps(page).encode() for page in synthetic.pages(records, args.page_size, url)]
+        for name in available():
+            decoder = get(name)
+            loads = best(lambda: [decoder.loads(page) for page in pages])
+            columns = best(lambda: [decoder.columns(page, metric) for page in pages])
+            # the whole path from bytes to a dataframe, by record as common.get_XX_dataframe(...) does
+            # and by column as pipeline.load(...) does
+            by_record = best(lambda: parse[metric]([result for page in pages
+                                                    for result in decoder.loads(page)['results']]))
+
+            def by_columns():
+                parts = [decoder.columns(page, metric)[0] for page in pages]
+                common.parse_columns(metric, concatenate(parts, metric))
+
+            by_column = best(by_columns)
+            print("{:<10} {:<8} {:>8} {:>9.3f}s {:>9.3f}s {:>9.3f}s  (by record: {:.3f}s)".format(
+                metric, name, len(records), loads, columns, by_column, by_record))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Compact exports of the dataframes produced by the common.get_XX_dataframe(...) functions.
+#
+# The loaders re-index their dataframes so that every missing hour is a row of NaNs,
+# which is what the plotting functions want but makes CSV files large and slow to write
+# and to read. write(...) can leave those rows out, writes floats with a fixed number
+# of significant digits, compresses the file (gzip, or zstd if the zstandard package is
+# installed), writes it in chunks, and can write a Parquet or Feather copy alongside it
+# (which needs the pyarrow package).
+#
+# pd.read_csv(...) reads the compressed files directly; to get the full hourly grid back,
+# pass the dataframe to common.reindex_hourly(...).
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+import common
+import instrument
+
+
+# enough digits for every value the NanoPis report
+FLOAT_FORMAT = '%.6g'
+
+CHUNK_SIZE = 100000
+
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# the default gzip level (9) is several times slower than this for files only a few percent smaller
+GZIP_LEVEL = 6
+
+SIBLING_FORMATS = ['parquet', 'feather']
+
+
+def compact(df, dropna=True):
+    """Returns a copy of a dataframe prepared for a compact export.
+
+    Arguments:
+    df - the pandas dataframe
+    dropna - whether to leave out rows in which every column is NaN, such as the ones added by re-indexing
+    """
+    if dropna:
+        df = df.dropna(how='all')
+    # columns that are floats only because re-indexing added NaNs (e.g. 'id') are written as integers
+    converted = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.kind == 'f':
+            present = values.dropna().values
+            if len(present) and np.array_equal(present, np.round(present)) and np.abs(present).max() < 2**53:
+                converted[column] = values.astype('Int64')
+    return df.assign(**converted) if converted else df
+
+
+def write(df, base, float_format=FLOAT_FORMAT, dropna=True, compression='gzip',
+          chunksize=CHUNK_SIZE, sibling=None):
+    """Writes a dataframe to a compact CSV file, and optionally a Parquet or Feather file alongside it.
+
+    Returns the list of files written.
+
+    Arguments:
+    df - the pandas dataframe to write
+    base - the path of the files without extension, e.g. 'data/bandwidth'
+    float_format - the format of floats, e.g. '%.6g'; None writes them at full precision
+    dropna - whether to leave out rows in which every column is NaN; see compact(...)
+    compression - None, 'gzip' or 'zstd'
+    chunksize - the number of rows formatted at a time
+    sibling - None, 'parquet' or 'feather'
+    """
+    if compression not in EXTENSIONS:
+        raise ValueError("compression must be one of {}".format(', '.join(str(key) for key in EXTENSIONS)))
+    if sibling is not None and sibling not in SIBLING_FORMATS:
+        raise ValueError("sibling must be one of {}".format(', '.join(SIBLING_FORMATS)))
+    name = os.path.basename(base)
+    paths = []
+    with instrument.stage('export.' + name, rows_in=len(df)) as stage:
+        df = compact(df, dropna)
+        path = base + '.csv' + EXTENSIONS[compression]
+        options = {'method': compression, 'compresslevel': GZIP_LEVEL} if compression == 'gzip' else compression
+        df.to_csv(path, float_format=float_format, compression=options, chunksize=chunksize)
+        paths.append(path)
+        if sibling is not None:
+            path = '{}.{}'.format(base, sibling)
+            # Parquet and Feather want plain columns rather than a MultiIndex
+            flat = df.reset_index()
+            if sibling == 'parquet':
+                flat.to_parquet(path, index=False)
+            else:
+                flat.to_feather(path)
+            paths.append(path)
+        stage['rows_out'] = len(df)
+        stage['bytes'] = sum(os.path.getsize(path) for path in paths)
+    return paths
+
+
+def read(path, tz='UTC'):
+    """Reads a file written by write(...) back into a dataframe with the original index.
+
+    Rows left out by write(...) are not restored; see common.reindex_hourly(...) for that.
+
+    Arguments:
+    path - the path of a .csv, .csv.gz, .csv.zst, .parquet or .feather file
+    tz - the timezone of the times read from CSV files, which only store UTC offsets,
+         e.g. common.TIMEZONE for ping data
+    """
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    elif path.endswith('.feather'):
+        df = pd.read_feather(path)
+    else:
+        df = pd.read_csv(path)
+    index = [column for column in ['datetime', 'nanopi', 'direction'] if column in df.columns]
+    for column in ['datetime', 'upload_date']:
+        if column in df.columns and df[column].dtype == object:
+            df[column] = pd.to_datetime(df[column], utc=True).dt.tz_convert(tz)
+    return df.set_index(index)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Converts HDF5 snapshots in data/ to compact CSV files.")
+    parser.add_argument('metrics', nargs='*', default=['bandwidth', 'jitter', 'latency', 'ping'])
+    parser.add_argument('-i', dest='input', default='data', help="directory containing <metric>.h5 files")
+    parser.add_argument('-o', dest='output', default='data', help="output directory")
+    parser.add_argument('-c', dest='compression', default='gzip', choices=['none', 'gzip', 'zstd'])
+    parser.add_argument('--keep-missing', action='store_true', help="keep the rows of missing hours")
+    parser.add_argument('--sibling', choices=SIBLING_FORMATS, help="also write a Parquet or Feather file")
+    args = parser.parse_args()
+
+    for metric in args.metrics:
+        df = common.read_snapshot(os.path.join(args.input, '{}.h5'.format(metric)))
+        for path in write(df, os.path.join(args.output, metric), dropna=not args.keep_missing,
+                          compression=None if args.compression == 'none' else args.compression,
+                          sibling=args.sibling):
+            print("Wrote {}".format(path))
+    instrument.summary()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Small multiples: one small panel per NanoPi (or per group of NanoPis) in a grid,
+# for when there are too many NanoPis to tell apart as lines on a single plot.
+#
+# The panels have the same axis limits, and all the lines of a panel are drawn as a single
+# LineCollection, so rendering time grows linearly with the number of NanoPis and no
+# legend has to be laid out. The limits are set on each panel rather than using
+# matplotlib's shared axes, since every change to a shared axis is passed on to all
+# the others, which makes building the grid quadratic in the number of panels.
+# Each panel also shows the median of all NanoPis in grey, so that every NanoPi
+# can be compared with the rest at a glance.
+#
+# The plot_24h(...), plot_dow(...) and plot_all(...) functions use this when they are
+# called with facet=True (one panel per NanoPi) or with facet set to a dict of groups.
+
+import math
+import warnings
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('svg')
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+
+import nanopi_registry
+
+
+# panels per row
+COLUMNS = 4
+
+HOUR_TICKS = ([0, 6, 12, 18, 23], ['0', '6', '12', '18', '23'])
+
+DOW_TICKS = (list(range(7)), ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
+
+
+def _panels(nanopi_ids, nanopi_names, groups):
+    # returns a list of (panel title, column positions, line labels)
+    if groups is None or groups is True:
+        names = (nanopi_registry.labels(nanopi_names, nanopi_ids) if nanopi_names
+                 else ['NanoPi {}'.format(nanopi_id) for nanopi_id in nanopi_ids])
+        return [(name, [position], None) for position, name in enumerate(names)]
+    members = {}
+    for position, nanopi_id in enumerate(nanopi_ids):
+        members.setdefault(groups.get(nanopi_id, 'Other'), []).append(position)
+    panels = []
+    for group, positions in members.items():
+        ids = [nanopi_ids[position] for position in positions]
+        labels = (nanopi_registry.labels(nanopi_names, ids) if nanopi_names
+                  else ['NanoPi {}'.format(nanopi_id) for nanopi_id in ids])
+        panels.append((str(group), positions, labels))
+    return panels
+
+
+def plot(data, nanopi_names=None, groups=None, title=None, xlabel=None, ylabel=None,
+         chart_width=10, columns=COLUMNS, xticks=None):
+    """Draws a grid of small plots, one per NanoPi or group of NanoPis, and returns the figure.
+
+    Arguments:
+    data - a pandas dataframe with a column per NanoPi ID, indexed by the x values
+           (e.g. hour of day, day of week or datetime)
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
+    groups - None (or True) for one panel per NanoPi, or a dict where the keys are NanoPi IDs and
+             the values are the names of the groups to put them in (e.g. {11: 'North', 12: 'North', 13: 'South'});
+             NanoPis that aren't in the dict go in a group called 'Other'
+    title - the title of the whole figure
+    xlabel - the label of the x axis
+    ylabel - the label of the y axis
+    chart_width - the width of the figure; the height follows from the number of rows
+    columns - the number of panels per row
+    xticks - a (positions, labels) pair such as HOUR_TICKS, or None for the default ticks
+    """
+    nanopi_ids = list(data.columns)
+    values = data.values.astype(float)
+    dates = isinstance(data.index, pd.DatetimeIndex)
+    x = mdates.date2num(data.index.to_pydatetime()) if dates else np.asarray(data.index, dtype=float)
+
+    panels = _panels(nanopi_ids, nanopi_names, groups)
+    columns = max(1, min(columns, len(panels)))
+    rows = max(1, math.ceil(len(panels) / columns))
+    panel_height = chart_width / columns * 0.6
+    height = panel_height * rows + 1
+    fig, axes = plt.subplots(rows, columns, squeeze=False, figsize=(chart_width, height))
+    # room in inches for the title at the top and the axis labels around the grid;
+    # a fixed layout like this is much cheaper than matplotlib's constrained layout
+    fig.subplots_adjust(left=0.08, right=0.98, top=1 - 0.6 / height, bottom=0.55 / height,
+                        wspace=0.12, hspace=0.35 * 1.8 / panel_height)
+
+    with warnings.catch_warnings():
+        # hours with no data from any NanoPi
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        median = np.nanmedian(values, axis=1) if len(nanopi_ids) > 1 else None
+        low, high = np.nanmin(values), np.nanmax(values)
+    xlim = (np.nanmin(x), np.nanmax(x)) if len(x) else None
+    margin = (high - low) * 0.05 or 1
+    ylim = (low - margin, high + margin) if np.isfinite(low) and np.isfinite(high) else None
+
+    for i, (ax, (name, positions, labels)) in enumerate(zip(axes.flat, panels)):
+        if median is not None:
+            ax.add_collection(LineCollection([np.column_stack([x, median])], colors='0.75', linewidths=0.8))
+        colors = ['C{}'.format(j % 10) for j in range(len(positions))]
+        segments = [np.column_stack([x, values[:, position]]) for position in positions]
+        ax.add_collection(LineCollection(segments, colors=colors, linewidths=1))
+        # collections don't take part in autoscaling, so every panel gets the same limits
+        if xlim:
+            ax.set_xlim(*xlim)
+        if ylim:
+            ax.set_ylim(*ylim)
+        if dates:
+            ax.xaxis_date(data.index.tz)
+            locator = mdates.AutoDateLocator(maxticks=4, tz=data.index.tz)
+            ax.xaxis.set_major_locator(locator)
+            ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator, tz=data.index.tz))
+        if xticks is not None:
+            ax.set_xticks(xticks[0])
+            ax.set_xticklabels(xticks[1])
+        # only the panels on the edges of the grid get tick labels
+        ax.tick_params(labelsize='x-small', labelleft=i % columns == 0,
+                       labelbottom=i + columns >= len(panels))
+        ax.set_title(name, fontsize='small')
+        if labels is not None and len(labels) > 1:
+            handles = [Line2D([], [], color=color) for color in colors]
+            ax.legend(handles, labels, fontsize='xx-small', frameon=False)
+    for ax in axes.flat[len(panels):]:
+        ax.set_visible(False)
+
+    if title:
+        fig.suptitle(title)
+    if xlabel:
+        fig.supxlabel(xlabel, fontsize='small')
+    if ylabel:
+        fig.supylabel(ylabel, fontsize='small')
+    return fig
+
+
+def save(fig, plot_name):
+    """Saves a figure made by plot(...) and frees it."""
+    fig.savefig(plot_name)
+    plt.close(fig)
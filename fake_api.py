@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the living-lab API.
+# Serves synthetic (or any other) records with the same URLs and pagination
+# as the real API, so that common.py can be run and benchmarked offline.
+
+import argparse
+import json
+import threading
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import common
+import synthetic
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeAPI:
+    """Serves records over HTTP the way the API does.
+
+    Endpoints are served at /<endpoint>/, e.g. /iperf3/. Every endpoint except
+    /nanopi/ is paginated with ?page=N (and an optional ?page_size=N); any other
+    URL parameter filters the records by equality on the field of the same name,
+    e.g. ?state=down. Authentication is accepted but not checked.
+
+    Arguments:
+    data - a dict where the keys are endpoint names and the values are lists of records,
+           as produced by synthetic.generate(...)
+    page_size - the default number of records per page
+    """
+
+    def __init__(self, data, page_size=100):
+        self.data = data
+        self.page_size = page_size
+        self.server = None
+        self.thread = None
+        self._filtered = {}
+
+    def start(self, host='127.0.0.1', port=0):
+        """Starts serving in a background thread and returns the base URL."""
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                api._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def stop(self):
+        """Stops serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, request):
+        parts = urlsplit(request.path)
+        endpoint = parts.path.strip('/')
+        if endpoint not in self.data:
+            request.send_error(404)
+            return
+        params = dict(parse_qsl(parts.query))
+        page = int(params.pop('page', 1))
+        page_size = int(params.pop('page_size', self.page_size))
+        key = (endpoint, tuple(sorted(params.items())))
+        records = self._filtered.get(key)
+        if records is None:
+            records = self.data[endpoint]
+            for field, value in params.items():
+                records = [record for record in records if str(record.get(field)) == value]
+            self._filtered[key] = records
+
+        if endpoint == 'nanopi':
+            body = records
+        else:
+            url = '{}/{}/'.format(self.base_url, endpoint)
+            if params:
+                url += '?' + urlencode(params)
+            if page_size != self.page_size:
+                url += ('&' if '?' in url else '?') + urlencode({'page_size': page_size})
+            body = synthetic.page(records, page, page_size, url)
+
+        content = json.dumps(body).encode()
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+
+def point_common_at(base_url):
+    """Points the endpoint URLs in common.py at a different API, e.g. a FakeAPI."""
+    common.set_base_url(base_url)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serves synthetic living-lab data on a local port.")
+    parser.add_argument('-n', dest='nanopis', default=10, type=int, help="number of NanoPis")
+    parser.add_argument('-d', dest='days', default=30, type=int, help="number of days")
+    parser.add_argument('-s', dest='seed', default=0, type=int, help="random seed")
+    parser.add_argument('-p', dest='port', default=5000, type=int, help="port to listen on")
+    parser.add_argument('--page-size', dest='page_size', default=100, type=int)
+    args = parser.parse_args()
+
+    print("Generating data...")
+    api = FakeAPI(synthetic.generate(nanopis=args.nanopis, days=args.days, seed=args.seed),
+                  page_size=args.page_size)
+    print("Serving at {}".format(api.start(port=args.port)))
+    try:
+        api.thread.join()
+    except KeyboardInterrupt:
+        api.stop()
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
-# Pulls ping data pertaining to a specific date from sqlite database,
-# processes it and writes results to file in data/ping/ .
+# Pulls ping data pertaining to a specific date (or -n days from it) from sqlite database,
+# processes it and writes results to file in data/ping/ (under the site's data_dir; see config.py).
 
 import os
+import datetime
 import pandas as pd
 import argparse
 import sqlite3
+import config
 
 def get_ping_count(conn, year, month, day):
     query = 'select * from testresults_pingresult where time between "{year}-{month:02}-{day:02} 00:00:00" and "{year}-{month:02}-{day:02} 23:59:59"'
@@ -22,9 +24,16 @@ if __name__ == '__main__':
     parser.add_argument('-y', dest='year', default=2018, type=int)
     parser.add_argument('-m', dest='month', required=True, type=int)
     parser.add_argument('-d', dest='day', required=True, type=int)
+    parser.add_argument('-n', dest='days', default=1, type=int, help="number of days to get, starting with the date given")
+    parser.add_argument('--config', dest='config', default=None, help="configuration file (default: LLV_CONFIG or llv.ini)")
+    parser.add_argument('--site', dest='site', default=None, help="site to read (default: LLV_SITE, or the only site)")
     args = parser.parse_args()
 
-    output_location = 'data/ping/'
-    conn = sqlite3.connect('/home/ubuntu/management/app/db.sqlite3')
-    df = get_ping_count(conn, args.year, args.month, args.day)
-    df.to_csv(os.path.join(output_location, '{}-{:02}-{:02}.csv'.format(args.year, args.month, args.day)))
+    site = config.get(args.site, args.config)
+    output_location = site.data_path('ping')
+    conn = sqlite3.connect(site.sqlite_path)
+    os.makedirs(output_location, exist_ok=True)
+    first = datetime.date(args.year, args.month, args.day)
+    for date in (first + datetime.timedelta(days=n) for n in range(args.days)):
+        df = get_ping_count(conn, date.year, date.month, date.day)
+        df.to_csv(os.path.join(output_location, '{}-{:02}-{:02}.csv'.format(date.year, date.month, date.day)))
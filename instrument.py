@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Lightweight instrumentation for the data pipeline.
+# Wraps stages of work (fetching, building dataframes, plotting) and records
+# wall time, peak RSS and whatever counters the stage sets (pages, bytes, rows).
+#
+# Instrumentation is off by default. Turn it on with configure(...) or by setting
+# the LLV_INSTRUMENT environment variable to 1. If LLV_INSTRUMENT_LOG is set,
+# each finished stage is appended to that file as one line of JSON; if
+# LLV_PROFILE_DIR is set, a cProfile dump is written there for each stage.
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+import cProfile
+import tracemalloc
+
+
+_settings = {
+    'enabled': os.environ.get('LLV_INSTRUMENT', '') not in ('', '0'),
+    'json_log': os.environ.get('LLV_INSTRUMENT_LOG') or None,
+    'profile_dir': os.environ.get('LLV_PROFILE_DIR') or None,
+    'trace_memory': os.environ.get('LLV_TRACE_MEMORY', '') not in ('', '0'),
+}
+
+# finished stage records, in the order they finished
+records = []
+
+# the cProfile object of the outermost profiled stage, if any;
+# nested stages are not profiled separately since cProfile cannot nest,
+# and neither are stages that run in other threads at the same time
+_active_profile = None
+_profile_lock = threading.Lock()
+
+# tracemalloc is global to the process, so it is started by the first stage that traces memory,
+# stopped by the last one running, and its peak is only reset when no other stage is running;
+# the peak_traced of stages that overlap is the peak since the first of them started
+_tracing_stages = 0
+_started_tracing = False
+
+
+def configure(enabled=True, json_log=None, profile_dir=None, trace_memory=False):
+    """Turns instrumentation on or off and sets where its output goes.
+
+    Arguments:
+    enabled - whether stages are measured at all
+    json_log - path of a file that each finished stage is appended to as a line of JSON;
+               '-' means stderr, None means no log
+    profile_dir - directory that a cProfile dump (and a tracemalloc snapshot, if
+                  trace_memory is set) is written to for each stage; None disables profiling
+    trace_memory - whether to track peak Python heap usage of each stage with tracemalloc
+    """
+    _settings['enabled'] = enabled
+    _settings['json_log'] = json_log
+    _settings['profile_dir'] = profile_dir
+    _settings['trace_memory'] = trace_memory
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def enabled():
+    """Returns whether instrumentation is turned on."""
+    return _settings['enabled']
+
+
+def reset():
+    """Forgets all recorded stages."""
+    del records[:]
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextlib.contextmanager
+def stage(name, **counters):
+    """Context manager that measures a stage of work.
+
+    Yields a dict that the caller may add counters to (for example 'pages', 'bytes',
+    'rows_in' or 'rows_out'). When the stage finishes the dict is filled in with
+    'stage', 'seconds' and 'peak_rss' and recorded. The dict is yielded even when
+    instrumentation is off, so callers never need to check.
+
+    Arguments:
+    name - the name of the stage, e.g. 'bandwidth.fetch'
+    counters - initial values of counters
+    """
+    global _active_profile, _tracing_stages, _started_tracing
+    record = dict(counters)
+    if not _settings['enabled']:
+        yield record
+        return
+
+    profile_dir = _settings['profile_dir']
+    trace_memory = _settings['trace_memory']
+    profile = None
+    if profile_dir:
+        with _profile_lock:
+            if _active_profile is None:
+                profile = cProfile.Profile()
+                _active_profile = profile
+    if trace_memory:
+        with _profile_lock:
+            if _tracing_stages == 0:
+                if tracemalloc.is_tracing():
+                    tracemalloc.reset_peak()
+                else:
+                    tracemalloc.start()
+                    _started_tracing = True
+            _tracing_stages += 1
+
+    start = time.perf_counter()
+    if profile:
+        profile.enable()
+    try:
+        yield record
+    finally:
+        if profile:
+            profile.disable()
+            _active_profile = None
+        record['stage'] = name
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        record['peak_rss'] = peak_rss()
+        if profile:
+            profile.dump_stats(os.path.join(profile_dir, '{}.prof'.format(name)))
+        if trace_memory:
+            with _profile_lock:
+                record['peak_traced'] = tracemalloc.get_traced_memory()[1]
+                if profile_dir:
+                    tracemalloc.take_snapshot().dump(os.path.join(profile_dir, '{}.tracemalloc'.format(name)))
+                _tracing_stages -= 1
+                if _tracing_stages == 0 and _started_tracing:
+                    tracemalloc.stop()
+                    _started_tracing = False
+        records.append(record)
+        _log(record)
+
+
+def instrumented(func):
+    """Decorator that runs a plotting function as an instrumented stage.
+
+    The stage is named after the module and function, and 'rows_in' is set to the
+    length of the dataframe passed as the first argument.
+    """
+    name = '{}.{}'.format(func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(df, *args, **kwargs):
+        with stage(name, rows_in=len(df)):
+            return func(df, *args, **kwargs)
+
+    return wrapper
+
+
+def _log(record):
+    path = _settings['json_log']
+    if not path:
+        return
+    line = json.dumps(record, sort_keys=True)
+    if path == '-':
+        print(line, file=sys.stderr)
+    else:
+        with open(path, 'at') as file:
+            file.write(line + '\n')
+
+
+def summary(file=None):
+    """Prints a table of all recorded stages.
+
+    Arguments:
+    file - the file object to print to; defaults to stdout
+    """
+    if not records:
+        return
+    columns = ['stage', 'seconds', 'pages', 'bytes', 'rows_in', 'rows_out', 'peak_rss']
+    rows = [columns]
+    for record in records:
+        row = []
+        for column in columns:
+            value = record.get(column, '')
+            if column == 'peak_rss' and value != '':
+                value = '{:.1f}M'.format(value / 2**20)
+            elif column == 'seconds':
+                value = '{:.3f}'.format(value)
+            row.append(str(value))
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        line = '  '.join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                         for i, (cell, width) in enumerate(zip(row, widths)))
+        print(line, file=file)
@@ -2,36 +2,39 @@
 
 # Contains plotting functions related to jitter test results.
 
-import requests
-from getpass import getpass
-import pandas as pd
-import numpy as np
 import matplotlib
 matplotlib.use('svg')
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 #import matplotlib.dates as dates
-import common
+import instrument
+import plot_cache
+import plot_data
+import nanopi_registry
+import facets
+import anomaly
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_average(df, nanopi_names=None, plot_name='average_jitter.svg',
                  title='Average Jitter by Location', chart_width=10):
     """Produces a graph showing average jitter over entire trial for each NanoPi.
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
     """
     averages = df.loc[:, 'jitter'].groupby(['nanopi']).mean()
+    plot_data.save(averages, plot_name, 'jitter')
     ax = averages.plot(kind='bar')
     ax.set(xlabel='Location', ylabel='Jitter (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in averages.index:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, averages.index)
         ax.set_xticklabels(labels, rotation=0)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -39,18 +42,22 @@ def plot_average(df, nanopi_names=None, plot_name='average_jitter.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_24h_average(df, nanopi_names=None, plot_name='24h_average_jitter.svg',
                      title="Average Jitter by Hour (Aggregate)", chart_width=10):
     """Produces a graph depicting average jitter over all NanoPis by hour of day.
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
     """
     by_hour = df.loc[:, 'jitter'].groupby(by=(lambda x: x[0].hour)).mean()
+    plot_data.save(by_hour, plot_name, 'jitter', index=['hour'])
     ax = by_hour.plot()
     ax.set(xlabel='Hour of Day', ylabel='Jitter (ms)', title=title)
     fig = ax.get_figure()
@@ -59,24 +66,32 @@ def plot_24h_average(df, nanopi_names=None, plot_name='24h_average_jitter.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_24h(df, nanopi_names=None, plot_name='24h_jitter.svg',
-             title="Average Jitter by Hour (Individual)", chart_width=10):
+             title="Average Jitter by Hour (Individual)", chart_width=10, facet=False):
     """Produces a graph showing the average hourly jitter for each NanoPi.
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
     """
     by_hour = df.loc[:, 'jitter'].unstack().groupby(by=(lambda x: x.hour)).mean()
+    plot_data.save(by_hour, plot_name, 'jitter', index=['hour'])
+    if facet:
+        facets.save(facets.plot(by_hour, nanopi_names, groups=facet, title=title, xlabel='Hour of Day',
+                                ylabel='Jitter (ms)', chart_width=chart_width, xticks=facets.HOUR_TICKS), plot_name)
+        return
     ax = by_hour.plot()
     ax.set(xlabel='Hour of Day', ylabel='Jitter (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_hour.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_hour.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -84,6 +99,8 @@ def plot_24h(df, nanopi_names=None, plot_name='24h_jitter.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_dow_average(df, plot_name='dow_average_jitter.svg',
                      title="Average Jitter by Day of Week (Aggregate)", chart_width=10):
     """Produces a graph showing the average aggregated jitter for all nanopis by day of week.
@@ -95,6 +112,7 @@ def plot_dow_average(df, plot_name='dow_average_jitter.svg',
     chart_width - the width of the produced plot
     """
     by_dow = df.loc[:, 'jitter'].groupby(by=(lambda x: x[0].dayofweek)).mean().reindex(range(7))
+    plot_data.save(by_dow, plot_name, 'jitter', index=['dow'])
     ax = by_dow.plot()
     dows = ['_', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     ax.set_xticklabels(dows, rotation=0)
@@ -105,27 +123,35 @@ def plot_dow_average(df, plot_name='dow_average_jitter.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_dow(df, nanopi_names=None, plot_name='dow_jitter.svg',
-             title="Average Jitter by Day of Week (Individual)", chart_width=10):
+             title="Average Jitter by Day of Week (Individual)", chart_width=10, facet=False):
     """Produces a graph depicting the average individual jitter for each nanopi by day of week.
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
     """
     by_dow = df.loc[:, 'jitter'].unstack().groupby(by=(lambda x: x.dayofweek)).mean().reindex(range(7))
+    plot_data.save(by_dow, plot_name, 'jitter', index=['dow'])
+    if facet:
+        facets.save(facets.plot(by_dow, nanopi_names, groups=facet, title=title, xlabel='Day of Week',
+                                ylabel='Jitter (ms)', chart_width=chart_width, xticks=facets.DOW_TICKS), plot_name)
+        return
     ax = by_dow.plot()
     # the _ is not shown because 0th element goes at origin but there is no xtick at origin
     dows = ['_', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     ax.set_xticklabels(dows, rotation=0)
     ax.set(xlabel='Day of Week', ylabel='Jitter (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_dow.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_dow.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -133,6 +159,8 @@ def plot_dow(df, nanopi_names=None, plot_name='dow_jitter.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_all_average(df, plot_name='all_average_jitter.svg',
                      title="Jitter over Entire Trial (Aggregate)", chart_width=10):
     """Use when you want to plot the average of multiple locations each hour over unlimited time.
@@ -144,6 +172,7 @@ def plot_all_average(df, plot_name='all_average_jitter.svg',
     chart_width - the width of the produced plot
     """
     averages = df.loc[:, 'jitter'].groupby('datetime').mean()
+    plot_data.save(averages, plot_name, 'jitter')
     ax = averages.plot()
     ax.set(xlabel='Date', ylabel='Jitter (ms)', title=title)
     fig = ax.get_figure()
@@ -152,24 +181,37 @@ def plot_all_average(df, plot_name='all_average_jitter.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_all(df, nanopi_names=None, plot_name='all_jitter.svg',
-             title="Jitter over Entire Trial (Individual)", chart_width=10):
+             title="Jitter over Entire Trial (Individual)", chart_width=10, facet=False,
+             anomalies=None):
     """Plots every datapoint for each individual nanopi that you give it.
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
+    anomalies - a dataframe of anomalous measurements from anomaly.detect(...) to mark with black crosses,
+                or None; not drawn when facet is set
     """
     data = df.loc[:, 'jitter'].unstack()
+    plot_data.save(data, plot_name, 'jitter')
+    if facet:
+        facets.save(facets.plot(data, nanopi_names, groups=facet, title=title, xlabel='Date',
+                                ylabel='Jitter (ms)', chart_width=chart_width), plot_name)
+        return
     ax = data.plot()
+    if anomalies is not None:
+        anomaly.overlay(ax, anomalies)
     ax.set(xlabel='Date', ylabel='Jitter (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in data.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, data.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -177,18 +219,22 @@ def plot_all(df, nanopi_names=None, plot_name='all_jitter.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('jitter')
 def plot_coverage(df, nanopi_names=None, plot_name='coverage_jitter.svg',
                   title="Coverage of Jitter Tests", chart_width=10):
     """Produces a plot that depicts which jitter tests were missed over the given data.
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
     """
     coverage = df.loc[:, 'jitter'].unstack().fillna(value=False).apply(lambda y: y.apply(lambda x: bool(x)))
+    plot_data.save(coverage, plot_name, 'present')
 #    xtick_dates = set([row.floor('D').toordinal() for row in coverage.index])
     black_patch = mpatches.Patch(color='black', label='missing')
     white_patch = mpatches.Patch(color='white', label='present')
@@ -198,9 +244,7 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_jitter.svg',
     fig, ax = plt.subplots()
     ax.imshow(data, aspect='auto', cmap=plt.cm.gray, interpolation='nearest')
     if nanopi_names:
-        labels = []
-        for nanopi_id in coverage.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, coverage.columns)
         ax.set_yticklabels(['_', *labels])
 #    ax.xaxis.set_major_formatter(dates.DateFormatter('%Y-%m-%d'))
 #    ax.xaxis.set_major_locator(dates.DayLocator(bymonthday=range(1, 32)))
@@ -218,12 +262,10 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_jitter.svg',
 
 if __name__ == '__main__':
 
-    username = input("API Username: ")
-    password = getpass(prompt="API Password: ")
-    auth = requests.auth.HTTPBasicAuth(username, password)
+    import common
 
-    nanopis = requests.get(common.NANOPI_URL, auth=auth).json()
-    nanopi_names = {nanopi.get('id'):nanopi.get('location_info') for nanopi in nanopis}
+    auth = common.get_auth()
+    nanopi_names = nanopi_registry.load(auth)
 
     df = common.get_jitter_dataframe(auth)
     plot_average(df, nanopi_names=nanopi_names)
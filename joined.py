@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# A joined view of all the metrics on one hourly (datetime, nanopi) grid, for correlating them.
+#
+# view(...) takes the dataframes produced by the common.get_XX_dataframe(...) functions and
+# returns a single dataframe with a column per metric:
+#   bandwidth_up, bandwidth_down   the bandwidth in each direction (Mbit/s)
+#   jitter                         the jitter (ms)
+#   latency                        the latency (ms)
+#   ping_down                      the number of failed pings in the hour
+# The grid is built once, and each metric is written straight into a column of it by
+# position, rather than unstacking and re-indexing a copy of every dataframe.
+# The view is cached for as long as the dataframes it was built from exist.
+#
+# plot_scatter(...), plot_correlation(...) and plot_correlation_by_nanopi(...) plot from the view.
+
+import weakref
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('svg')
+import matplotlib.pyplot as plt
+
+import instrument
+import plot_cache
+import plot_data
+import nanopi_registry
+
+
+COLUMNS = ['bandwidth_up', 'bandwidth_down', 'jitter', 'latency', 'ping_down']
+
+LABELS = {
+    'bandwidth_up': 'Bandwidth Up (Mbit/s)',
+    'bandwidth_down': 'Bandwidth Down (Mbit/s)',
+    'jitter': 'Jitter (ms)',
+    'latency': 'Latency (ms)',
+    'ping_down': 'Failed Pings per Hour',
+}
+
+
+def _grid(frames):
+    # the hourly times and sorted NanoPi IDs covering all of the frames
+    tz = None
+    starts, ends, nanopis = [], [], set()
+    for df in frames:
+        times = df.index.get_level_values('datetime')
+        if not len(times):
+            continue
+        if tz is None and times.tz is not None:
+            tz = times.tz
+        starts.append(times.min())
+        ends.append(times.max())
+        nanopis.update(df.index.get_level_values('nanopi').unique())
+    if not starts:
+        return pd.DatetimeIndex([], tz=tz), []
+    if tz is not None:
+        starts = [start.tz_convert(tz) for start in starts]
+        ends = [end.tz_convert(tz) for end in ends]
+    return pd.date_range(min(starts).floor('H'), max(ends).floor('H'), freq='H'), sorted(nanopis)
+
+
+def _positions(index, times, nanopis):
+    # the position of each row of an index in the flattened (time, nanopi) grid, or -1 if it isn't on it
+    row_times = index.get_level_values('datetime')
+    if row_times.tz is not None and times.tz is not None:
+        row_times = row_times.tz_convert(times.tz)
+    hours = row_times.floor('H')
+    time_positions = times.get_indexer(hours)
+    nanopi_positions = pd.Index(nanopis).get_indexer(index.get_level_values('nanopi'))
+    positions = time_positions * len(nanopis) + nanopi_positions
+    return np.where((time_positions >= 0) & (nanopi_positions >= 0), positions, -1)
+
+
+def build(bandwidth=None, jitter=None, latency=None, ping=None):
+    """Builds the joined view of the given dataframes; see view(...), which caches the result."""
+    frames = [df for df in (bandwidth, jitter, latency, ping) if df is not None]
+    with instrument.stage('joined.build', rows_in=sum(len(df) for df in frames)) as stage:
+        times, nanopis = _grid(frames)
+        size = len(times) * len(nanopis)
+        columns = {}
+
+        def fill(column, index, values):
+            array = np.full(size, np.nan)
+            positions = _positions(index, times, nanopis)
+            present = (positions >= 0) & ~np.isnan(values)
+            array[positions[present]] = values[present]
+            columns[column] = array
+
+        if bandwidth is not None:
+            directions = bandwidth.index.get_level_values('direction')
+            values = bandwidth.loc[:, 'bandwidth'].values.astype(float)
+            for direction in ['up', 'down']:
+                rows = np.asarray(directions == direction)
+                fill('bandwidth_' + direction, bandwidth.index[rows], values[rows])
+        if jitter is not None:
+            fill('jitter', jitter.index, jitter.loc[:, 'jitter'].values.astype(float))
+        if latency is not None:
+            fill('latency', latency.index, latency.loc[:, 'latency'].values.astype(float))
+        if ping is not None:
+            down = np.asarray(ping.loc[:, 'state'] == 'down')
+            positions = _positions(ping.index[down], times, nanopis)
+            counts = np.bincount(positions[positions >= 0], minlength=size).astype(float)
+            # pings are only stored when they fail, so an hour without any had none that failed
+            columns['ping_down'] = counts
+        for column in COLUMNS:
+            if column not in columns:
+                columns[column] = np.full(size, np.nan)
+
+        index = pd.MultiIndex.from_product([times, nanopis], names=['datetime', 'nanopi'])
+        df = pd.DataFrame(columns, index=index, columns=COLUMNS, copy=False)
+        stage['rows_out'] = len(df)
+    return df
+
+
+# joined views that view(...) has built, keyed by the ids of the dataframes they were built from
+_cache = {}
+
+
+def view(bandwidth=None, jitter=None, latency=None, ping=None):
+    """Returns the joined view of the given dataframes, building it the first time it is asked for.
+
+    The view is kept for as long as all of the dataframes exist. Call forget(...) with the
+    same arguments if you modify one of the dataframes in place.
+
+    Arguments:
+    bandwidth - the dataframe from common.get_bandwidth_dataframe(...), or None
+    jitter - the dataframe from common.get_jitter_dataframe(...), or None
+    latency - the dataframe from common.get_latency_dataframe(...), or None
+    ping - the dataframe from common.get_ping_dataframe(...), or None
+    """
+    frames = (bandwidth, jitter, latency, ping)
+    key = tuple(id(df) if df is not None else None for df in frames)
+    entry = _cache.get(key)
+    if entry is not None and all(ref() is df for ref, df in zip(entry[0], frames) if df is not None):
+        return entry[1]
+    df = build(bandwidth, jitter, latency, ping)
+    refs = [weakref.ref(frame, lambda ref, key=key: _cache.pop(key, None)) for frame in frames if frame is not None]
+    _cache[key] = (refs, df)
+    return df
+
+
+def forget(bandwidth=None, jitter=None, latency=None, ping=None):
+    """Discards the cached joined view of the given dataframes."""
+    _cache.pop(tuple(id(df) if df is not None else None for df in (bandwidth, jitter, latency, ping)), None)
+
+
+def correlations(joined, method='spearman', by_nanopi=False):
+    """Returns the correlations between the columns of a joined view.
+
+    Arguments:
+    joined - a dataframe returned by view(...)
+    method - 'pearson', 'spearman' or 'kendall'; see pandas.DataFrame.corr
+    by_nanopi - whether to compute the correlations of each NanoPi separately
+    """
+    columns = [column for column in COLUMNS if joined.loc[:, column].notna().any()]
+    if by_nanopi:
+        return joined.loc[:, columns].groupby(level='nanopi').corr(method=method)
+    return joined.loc[:, columns].corr(method=method)
+
+
+@instrument.instrumented
+@plot_cache.cached(COLUMNS)
+def plot_scatter(joined, x='bandwidth_down', y='latency', nanopi_names=None, plot_name='scatter.svg',
+                 title=None, chart_width=10):
+    """Produces a scatter plot of one metric against another, with a colour per NanoPi.
+
+    Arguments:
+    joined - a dataframe returned by view(...)
+    x - the column on the x axis; one of COLUMNS
+    y - the column on the y axis; one of COLUMNS
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
+    plot_name - the file name of the plot that is produced by this function
+    title - a string that will become the title of the produced plot
+    chart_width - the width of the produced plot
+    """
+    data = joined.loc[:, [x, y]].dropna()
+    plot_data.save(data, plot_name)
+    nanopi_ids = data.index.get_level_values('nanopi')
+    fig, ax = plt.subplots(figsize=(chart_width, 6))
+    # one scatter for all the points, coloured by NanoPi, rather than one per NanoPi
+    codes, uniques = pd.factorize(nanopi_ids, sort=True)
+    ax.scatter(data.loc[:, x].values, data.loc[:, y].values, c=codes % 10, cmap='tab10', vmin=0, vmax=9, s=4,
+               alpha=0.5, linewidths=0)
+    ax.set(xlabel=LABELS[x], ylabel=LABELS[y], title=title or '{} vs. {}'.format(LABELS[y], LABELS[x]))
+    labels = (nanopi_registry.labels(nanopi_names, uniques) if nanopi_names
+              else ['NanoPi {}'.format(nanopi_id) for nanopi_id in uniques])
+    handles = [plt.Line2D([], [], linestyle='none', marker='o', color='C{}'.format(i % 10)) for i in range(len(uniques))]
+    ax.legend(handles, labels, fontsize='small')
+    fig.savefig(plot_name)
+    plt.close(fig)
+
+
+@instrument.instrumented
+@plot_cache.cached(COLUMNS)
+def plot_correlation(joined, method='spearman', plot_name='correlation.svg',
+                     title='Correlation between Metrics', chart_width=8):
+    """Produces a heat map of the correlations between every pair of metrics, over all NanoPis.
+
+    Arguments:
+    joined - a dataframe returned by view(...)
+    method - 'pearson', 'spearman' or 'kendall'
+    plot_name - the file name of the plot that is produced by this function
+    title - a string that will become the title of the produced plot
+    chart_width - the width of the produced plot
+    """
+    matrix = correlations(joined, method)
+    plot_data.save(matrix, plot_name, method, index=['x'], columns=['y'])
+    fig, ax = plt.subplots(figsize=(chart_width, chart_width * 0.8))
+    image = ax.imshow(matrix.values, cmap='RdBu_r', vmin=-1, vmax=1)
+    labels = [LABELS[column] for column in matrix.columns]
+    ax.set_xticks(range(len(labels)))
+    ax.set_xticklabels(labels, rotation=30, ha='right')
+    ax.set_yticks(range(len(labels)))
+    ax.set_yticklabels(labels)
+    for (row, column), value in np.ndenumerate(matrix.values):
+        if not np.isnan(value):
+            ax.text(column, row, '{:.2f}'.format(value), ha='center', va='center', fontsize='small')
+    fig.colorbar(image, ax=ax)
+    ax.set(title='{} ({})'.format(title, method.capitalize()))
+    fig.tight_layout()
+    fig.savefig(plot_name)
+    plt.close(fig)
+
+
+@instrument.instrumented
+@plot_cache.cached(COLUMNS)
+def plot_correlation_by_nanopi(joined, x='bandwidth_down', y='latency', method='spearman', nanopi_names=None,
+                               plot_name='correlation_by_nanopi.svg', title=None, chart_width=10):
+    """Produces a bar graph of the correlation between two metrics at each NanoPi.
+
+    Arguments:
+    joined - a dataframe returned by view(...)
+    x - one of COLUMNS
+    y - another of COLUMNS
+    method - 'pearson', 'spearman' or 'kendall'
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
+    plot_name - the file name of the plot that is produced by this function
+    title - a string that will become the title of the produced plot
+    chart_width - the width of the produced plot
+    """
+    # DataFrame.corr(...) ranks the values itself, whereas Series.corr(...) needs scipy for Spearman
+    by_nanopi = joined.loc[:, [x, y]].groupby(level='nanopi').corr(method=method).xs(x, level=1).loc[:, y]
+    plot_data.save(by_nanopi, plot_name, method)
+    ax = by_nanopi.plot(kind='bar')
+    ax.set(xlabel='Location', ylabel='Correlation ({})'.format(method.capitalize()), ylim=(-1, 1),
+           title=title or 'Correlation of {} and {} by Location'.format(LABELS[x], LABELS[y]))
+    if nanopi_names:
+        ax.set_xticklabels(nanopi_registry.labels(nanopi_names, by_nanopi.index), rotation=0)
+    fig = ax.get_figure()
+    fig.set_size_inches(chart_width, 6)
+    fig.savefig(plot_name)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+
+    import archive
+
+    frames = {metric: archive.Archive(metric).to_dataframe(reindex=False)
+              for metric in ['bandwidth', 'jitter', 'latency', 'ping']}
+    nanopi_names = nanopi_registry.load()
+    joined = view(**frames)
+    print(correlations(joined).round(2).to_string())
+    plot_correlation(joined)
+    plot_scatter(joined, 'bandwidth_down', 'latency', nanopi_names=nanopi_names,
+                 plot_name='scatter_bandwidth_latency.svg')
+    plot_scatter(joined, 'jitter', 'latency', nanopi_names=nanopi_names, plot_name='scatter_jitter_latency.svg')
+    plot_correlation_by_nanopi(joined, 'bandwidth_down', 'latency', nanopi_names=nanopi_names)
+    instrument.summary()
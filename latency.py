@@ -2,35 +2,38 @@
 
 # Contains plotting functions related to latency test results.
 
-import requests
-from getpass import getpass
-import pandas as pd
-import numpy as np
 import matplotlib
 matplotlib.use('svg')
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-import common
+import instrument
+import plot_cache
+import plot_data
+import nanopi_registry
+import facets
+import anomaly
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_average(df, nanopi_names=None, plot_name='average_latency.svg',
                  title='Average Latency by Location', chart_width=10):
     """Produces a graph showing average latency over entire trial for each nanopi
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
     """
     averages = df.loc[:, 'latency'].groupby(['nanopi']).mean()
+    plot_data.save(averages, plot_name, 'latency')
     ax = averages.plot(kind='bar')
     ax.set(xlabel='Location', ylabel='Latency (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in averages.index:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, averages.index)
         ax.set_xticklabels(labels, rotation=0)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -38,18 +41,22 @@ def plot_average(df, nanopi_names=None, plot_name='average_latency.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_24h_average(df, nanopi_names=None, plot_name='24h_average_latency.svg',
                      title="Average Latency by Hour (Aggregate)", chart_width=10):
     """Produces a graph depicting average latency over all nanopis by hour of day
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
     """
     by_hour = df.loc[:, 'latency'].groupby(by=(lambda x: x[0].hour)).mean()
+    plot_data.save(by_hour, plot_name, 'latency', index=['hour'])
     ax = by_hour.plot()
     ax.set(xlabel='Hour of Day', ylabel='Latency (ms)', title=title)
     fig = ax.get_figure()
@@ -58,24 +65,32 @@ def plot_24h_average(df, nanopi_names=None, plot_name='24h_average_latency.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_24h(df, nanopi_names=None, plot_name='24h_latency.svg',
-             title="Average Latency by Hour (Individual)", chart_width=10):
+             title="Average Latency by Hour (Individual)", chart_width=10, facet=False):
     """Produces a graph showing the average hourly latency for each nanopi
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
     """
     by_hour = df.loc[:, 'latency'].unstack().groupby(by=(lambda x: x.hour)).mean()
+    plot_data.save(by_hour, plot_name, 'latency', index=['hour'])
+    if facet:
+        facets.save(facets.plot(by_hour, nanopi_names, groups=facet, title=title, xlabel='Hour of Day',
+                                ylabel='Latency (ms)', chart_width=chart_width, xticks=facets.HOUR_TICKS), plot_name)
+        return
     ax = by_hour.plot()
     ax.set(xlabel='Hour of Day', ylabel='Latency (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_hour.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_hour.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -83,6 +98,8 @@ def plot_24h(df, nanopi_names=None, plot_name='24h_latency.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_dow_average(df, plot_name='dow_average_latency.svg',
                      title="Average Latency by Day of Week (Aggregate)", chart_width=10):
     """Produces a graph showing the average aggregated latency for all nanopis by day of week
@@ -94,6 +111,7 @@ def plot_dow_average(df, plot_name='dow_average_latency.svg',
     chart_width - the width of the produced plot
     """
     by_dow = df.loc[:, 'latency'].groupby(by=(lambda x: x[0].dayofweek)).mean().reindex(range(7))
+    plot_data.save(by_dow, plot_name, 'latency', index=['dow'])
     ax = by_dow.plot()
     dows = ['_', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     ax.set_xticklabels(dows, rotation=0)
@@ -104,27 +122,35 @@ def plot_dow_average(df, plot_name='dow_average_latency.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_dow(df, nanopi_names=None, plot_name='dow_latency.svg',
-             title="Average Latency by Day of Week (Individual)", chart_width=10):
+             title="Average Latency by Day of Week (Individual)", chart_width=10, facet=False):
     """Produces a graph depicting the average individual latency for each nanopi by day of week
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
     """
     by_dow = df.loc[:, 'latency'].unstack().groupby(by=(lambda x: x.dayofweek)).mean().reindex(range(7))
+    plot_data.save(by_dow, plot_name, 'latency', index=['dow'])
+    if facet:
+        facets.save(facets.plot(by_dow, nanopi_names, groups=facet, title=title, xlabel='Day of Week',
+                                ylabel='Latency (ms)', chart_width=chart_width, xticks=facets.DOW_TICKS), plot_name)
+        return
     ax = by_dow.plot()
     # the _ is not shown because 0th element goes at origin but there is no xtick at origin
     dows = ['_', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     ax.set_xticklabels(dows, rotation=0)
     ax.set(xlabel='Day of Week', ylabel='Latency (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in by_dow.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, by_dow.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -132,6 +158,8 @@ def plot_dow(df, nanopi_names=None, plot_name='dow_latency.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_all_average(df, plot_name='all_average_latency.svg',
                      title="Latency over Entire Trial (Aggregate)", chart_width=10):
     """Use when you want to plot the average of multiple locations each hour over unlimited time
@@ -143,6 +171,7 @@ def plot_all_average(df, plot_name='all_average_latency.svg',
     chart_width - the width of the produced plot
     """
     averages = df.loc[:, 'latency'].groupby('datetime').mean()
+    plot_data.save(averages, plot_name, 'latency')
     ax = averages.plot()
     ax.set(xlabel='Date', ylabel='Latency (ms)', title=title)
     fig = ax.get_figure()
@@ -151,24 +180,37 @@ def plot_all_average(df, plot_name='all_average_latency.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_all(df, nanopi_names=None, plot_name='all_latency.svg',
-             title="Latency over Entire Trial (Individual)", chart_width=10):
+             title="Latency over Entire Trial (Individual)", chart_width=10, facet=False,
+             anomalies=None):
     """Plots every datapoint for each individual nanopi that you give it
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
+    facet - False for a single plot with a line per NanoPi, True for a grid of small plots with one
+            per NanoPi, or a dict of NanoPi IDs to group names for one small plot per group; see facets.py
+    anomalies - a dataframe of anomalous measurements from anomaly.detect(...) to mark with black crosses,
+                or None; not drawn when facet is set
     """
     data = df.loc[:, 'latency'].unstack()
+    plot_data.save(data, plot_name, 'latency')
+    if facet:
+        facets.save(facets.plot(data, nanopi_names, groups=facet, title=title, xlabel='Date',
+                                ylabel='Latency (ms)', chart_width=chart_width), plot_name)
+        return
     ax = data.plot()
+    if anomalies is not None:
+        anomaly.overlay(ax, anomalies)
     ax.set(xlabel='Date', ylabel='Latency (ms)', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in data.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, data.columns)
         ax.legend(labels)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -176,18 +218,22 @@ def plot_all(df, nanopi_names=None, plot_name='all_latency.svg',
     fig.clear()
 
 
+@instrument.instrumented
+@plot_cache.cached('latency')
 def plot_coverage(df, nanopi_names=None, plot_name='coverage_latency.svg',
              title="Coverage of Latency Tests", chart_width=10):
     """Produces a plot that depicts which latency tests were missed over the given data
 
     Arguments:
     df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
     """
     coverage = df.loc[:, 'latency'].unstack().fillna(value=False).apply(lambda y: y.apply(lambda x: bool(x)))
+    plot_data.save(coverage, plot_name, 'present')
     black_patch = mpatches.Patch(color='black', label='missing')
     white_patch = mpatches.Patch(color='white', label='present')
     data = []
@@ -196,9 +242,7 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_latency.svg',
     fig, ax = plt.subplots()
     ax.imshow(data, aspect='auto', cmap=plt.cm.gray, interpolation='nearest')
     if nanopi_names:
-        labels = []
-        for nanopi_id in coverage.columns:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, coverage.columns)
         ax.set_yticklabels(['_', *labels])
     #ax.set_xticklabels(coverage.index.date)
     #fig.autofmt_xdate()
@@ -212,12 +256,10 @@ def plot_coverage(df, nanopi_names=None, plot_name='coverage_latency.svg',
 
 if __name__ == '__main__':
 
-    username = input("API Username: ")
-    password = getpass(prompt="API Password: ")
-    auth = requests.auth.HTTPBasicAuth(username, password)
+    import common
 
-    nanopis = requests.get(common.NANOPI_URL, auth=auth).json()
-    nanopi_names = {nanopi.get('id'):nanopi.get('location_info') for nanopi in nanopis}
+    auth = common.get_auth()
+    nanopi_names = nanopi_registry.load(auth)
 
     df = common.get_latency_dataframe(auth)
     plot_average(df, nanopi_names=nanopi_names)
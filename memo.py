@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+# Memoized loaders: repeated requests for the same data cost nothing.
+#
+# load(metric, auth, params) returns the same dataframe as common.get_XX_dataframe(auth, params),
+# but remembers it, keyed by the metric, the URL and its parameters and a watermark of the data
+# on the API: by default the number of results the API reports for those parameters together
+# with the largest id and upload_date on its first and last pages, which takes one or two
+# requests to find out. Results added, removed or replaced change the watermark; a result
+# corrected in place without a new upload_date doesn't, so invalidate(...) after such a fix.
+# When the watermark hasn't changed since the dataframe was loaded, it is returned from memory,
+# or else from a pickle in data/memo/, without fetching anything.
+#
+# The columns of a remembered dataframe are shared between callers and read-only: every caller
+# gets a dataframe of its own over them, so replacing a column (df.loc[:, 'jitter'] = 0) only
+# changes the caller's dataframe, and assigning into one (df.loc[row, 'jitter'] = 0) raises an
+# error or, for times, quietly copies the column first. The memory used is bounded by
+# MAX_BYTES (LLV_MEMO_BYTES) and the disk used by MAX_DISK_BYTES (LLV_MEMO_DISK_BYTES);
+# the least recently used dataframes are dropped first. invalidate(...) forgets dataframes
+# explicitly.
+
+import os
+import glob
+import json
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+import common
+import instrument
+
+
+MEMO_DIR = 'data/memo'
+
+# the most memory the dataframes held in memory may use, in bytes
+MAX_BYTES = int(os.environ.get('LLV_MEMO_BYTES', 1024 ** 3))
+
+# the most disk space the pickled dataframes may use, in bytes; 0 turns the disk cache off
+MAX_DISK_BYTES = int(os.environ.get('LLV_MEMO_DISK_BYTES', 4 * 1024 ** 3))
+
+URLS = {'bandwidth': 'IPERF3_URL', 'jitter': 'JITTER_URL', 'latency': 'LATENCY_URL', 'ping': 'PING_URL'}
+
+DEFAULT_PARAMS = {'ping': {'state': 'down'}}
+
+# (metric, params, watermark) -> (dataframe, bytes), least recently used first
+_frames = OrderedDict()
+_bytes = 0
+_lock = threading.Lock()
+# one lock per key, so that a dataframe being loaded isn't loaded again at the same time
+_loading = {}
+
+
+def normalize(params):
+    """Returns URL parameters as a string that is the same for equivalent parameters.
+
+    Arguments:
+    params - a dict containing URL parameters, or None
+    """
+    return json.dumps({str(key): str(value) for key, value in (params or {}).items()}, sort_keys=True)
+
+
+def api_count(metric, auth, params=None):
+    """Returns the number of results the API has for a metric and URL parameters, using one request."""
+    return common._get(getattr(common, URLS[metric]), auth, params).json().get('count')
+
+
+def api_watermark(metric, auth, params=None):
+    """Returns a watermark of the results the API has for a metric and URL parameters, as a tuple.
+
+    The watermark is the number of results and the largest id and upload_date on the first
+    and last pages, whichever way the API orders them. It takes one request, or two if there
+    is more than one page.
+
+    Arguments:
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    auth - the requests auth object; see requests docs
+    params - a dict containing URL parameters for API requests
+    """
+    url = getattr(common, URLS[metric])
+    first = common._get(url, auth, params).json()
+    count = first.get('count')
+    results = list(first.get('results') or [])
+    if first.get('next') and results:
+        last_page = -(-count // len(results))
+        results.extend(common._get(url, auth, dict(params or {}, page=last_page)).json().get('results') or [])
+    ids = [result['id'] for result in results if result.get('id') is not None]
+    upload_dates = [str(result['upload_date']) for result in results if result.get('upload_date') is not None]
+    return count, max(ids, default=None), max(upload_dates, default=None)
+
+
+def _query(metric, params):
+    # the same parameters on the APIs of different sites are different data
+    return '{} {}'.format(getattr(common, URLS[metric]), normalize(params))
+
+
+def _base_name(metric, params):
+    return '{}-{}'.format(metric, hashlib.sha1(params.encode()).hexdigest()[:16])
+
+
+def _path(directory, metric, params, watermark):
+    digest = hashlib.sha1(str(watermark).encode()).hexdigest()[:16]
+    return os.path.join(directory, '{}-{}.pkl'.format(_base_name(metric, params), digest))
+
+
+def _freeze(df):
+    # returns the dataframe with read-only columns; timezone-aware times are copied once into a read-only
+    # array of nanoseconds since the epoch, the other numpy columns are the same arrays, not copies
+    columns = {}
+    for column in df.columns:
+        values = df.loc[:, column]
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            nanoseconds = values.to_numpy(dtype='datetime64[ns]').view('i8')
+            nanoseconds.setflags(write=False)
+            values = pd.array(nanoseconds, dtype=values.dtype, copy=False)
+        elif isinstance(values.dtype, np.dtype):
+            values = values.to_numpy()
+            values.setflags(write=False)
+        columns[column] = values
+    frozen = pd.DataFrame(columns, index=df.index, copy=False)
+    frozen.attrs = dict(df.attrs)
+    return frozen
+
+
+def _share(df):
+    # a dataframe of the caller's own over the remembered, read-only columns
+    shared = df.copy(deep=False)
+    shared.attrs = dict(df.attrs)
+    return shared
+
+
+def _remember(key, df):
+    global _bytes
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    with _lock:
+        # the same data at any other watermark is out of date
+        for old_key in [old_key for old_key in _frames if old_key[:2] == key[:2]]:
+            _bytes -= _frames.pop(old_key)[1]
+        if size > MAX_BYTES:
+            return
+        _frames[key] = (df, size)
+        _bytes += size
+        while _bytes > MAX_BYTES:
+            _, (_, evicted) = _frames.popitem(last=False)
+            _bytes -= evicted
+
+
+def _recall(key):
+    with _lock:
+        entry = _frames.get(key)
+        if entry is None:
+            return None
+        _frames.move_to_end(key)
+        return entry[0]
+
+
+def _trim_disk(directory):
+    # removes the least recently used pickles until the rest fit in MAX_DISK_BYTES
+    paths = sorted(glob.glob(os.path.join(directory, '*.pkl')), key=os.path.getmtime)
+    total = sum(os.path.getsize(path) for path in paths)
+    for path in paths:
+        if total <= MAX_DISK_BYTES:
+            break
+        total -= os.path.getsize(path)
+        os.remove(path)
+
+
+def _load(key, auth, params, loader, directory):
+    # loads a dataframe from disk or the API, and remembers it
+    metric = key[0]
+    with instrument.stage('memo.{}'.format(metric)) as stage:
+        path = _path(directory, *key) if directory and MAX_DISK_BYTES else None
+        if path and os.path.exists(path):
+            df = pd.read_pickle(path)
+            # the file's time is when it was last used
+            os.utime(path)
+            stage['source'] = 'disk'
+        else:
+            if loader is None:
+                import pipeline
+                loader = pipeline.load
+            df = loader(metric, auth, params)
+            stage['source'] = 'api'
+            if path:
+                os.makedirs(directory, exist_ok=True)
+                # older versions of the same data are no use any more
+                for old_path in glob.glob(os.path.join(directory, _base_name(metric, key[1]) + '-*.pkl')):
+                    os.remove(old_path)
+                temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+                df.to_pickle(temporary_path)
+                os.replace(temporary_path, path)
+                _trim_disk(directory)
+        stage['rows_out'] = len(df)
+    df = _freeze(df)
+    _remember(key, df)
+    return df
+
+
+def load(metric, auth, params=None, watermark='count', loader=None, directory=MEMO_DIR):
+    """Returns the same dataframe as common.get_XX_dataframe(auth, params), loading it only if it isn't remembered.
+
+    The dataframe's columns are shared with other callers and read-only: columns can be replaced
+    or added, but to change values in place, make a copy with df.copy() first.
+
+    Arguments:
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    auth - the requests auth object; see requests docs
+    params - a dict containing URL parameters for API requests; defaults to those of common.get_XX_dataframe(...)
+    watermark - 'count' to ask the API for api_watermark(...) (one or two requests), None to trust a
+                remembered dataframe however old it is, or any other value identifying the version of
+                the data, e.g. the time of the last upload
+    loader - a function called as loader(metric, auth, params) to load the dataframe; defaults to pipeline.load
+    directory - the directory the dataframes are pickled to, or None to only remember them in memory
+    """
+    params = DEFAULT_PARAMS.get(metric) if params is None else params
+    if watermark == 'count':
+        watermark = api_watermark(metric, auth, params)
+    key = (metric, _query(metric, params), watermark)
+    df = _recall(key)
+    if df is not None:
+        return _share(df)
+
+    with _lock:
+        key_lock = _loading.setdefault(key, threading.Lock())
+    with key_lock:
+        df = _recall(key)
+        if df is None:
+            df = _load(key, auth, params, loader, directory)
+    with _lock:
+        _loading.pop(key, None)
+    return _share(df)
+
+
+def invalidate(metric=None, params=None, directory=MEMO_DIR):
+    """Forgets remembered dataframes, in memory and on disk.
+
+    Arguments:
+    metric - the metric to forget, or None for all of them
+    params - the URL parameters to forget (for the given metric), or None for all of them
+    directory - the directory the dataframes are pickled to, or None
+    """
+    global _bytes
+    metrics = [metric] if metric else list(URLS)
+    queries = {_query(name, params) for name in metrics} if params is not None else None
+    with _lock:
+        for key in list(_frames):
+            if key[0] in metrics and (queries is None or key[1] in queries):
+                _bytes -= _frames.pop(key)[1]
+    if directory and os.path.isdir(directory):
+        patterns = (['{}-*.pkl'.format(_base_name(name, _query(name, params))) for name in metrics]
+                    if params is not None else ['{}-*.pkl'.format(metric or '*')])
+        for pattern in patterns:
+            for path in glob.glob(os.path.join(directory, pattern)):
+                os.remove(path)
+
+
+def status():
+    """Returns the number of dataframes held in memory and the bytes they use."""
+    with _lock:
+        return {'frames': len(_frames), 'bytes': _bytes, 'max_bytes': MAX_BYTES}
+
+
+def get_bandwidth_dataframe(auth, params=None):
+    """Memoized common.get_bandwidth_dataframe(...); see load(...)."""
+    return load('bandwidth', auth, params)
+
+
+def get_jitter_dataframe(auth, params=None):
+    """Memoized common.get_jitter_dataframe(...); see load(...)."""
+    return load('jitter', auth, params)
+
+
+def get_latency_dataframe(auth, params=None):
+    """Memoized common.get_latency_dataframe(...); see load(...)."""
+    return load('latency', auth, params)
+
+
+def get_ping_dataframe(auth, params=None):
+    """Memoized common.get_ping_dataframe(...); see load(...)."""
+    return load('ping', auth, params)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Manages the dataframes memoized in data/memo/.")
+    parser.add_argument('--clear', action='store_true', help="forget every memoized dataframe")
+    parser.add_argument('-d', dest='directory', default=MEMO_DIR, help="memo directory (default: {})".format(MEMO_DIR))
+    args = parser.parse_args()
+
+    if args.clear:
+        invalidate(directory=args.directory)
+    paths = sorted(glob.glob(os.path.join(args.directory, '*.pkl')))
+    for path in paths:
+        print("{:<50} {:>12,} bytes".format(os.path.basename(path), os.path.getsize(path)))
+    print("{} memoized dataframe(s)".format(len(paths)))
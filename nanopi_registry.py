@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# A local cache of the NanoPi list from the API.
+#
+# The list is saved to data/nanopis.json together with the time it was fetched, and
+# is only fetched again once it is older than TTL seconds (set LLV_NANOPI_TTL to change it).
+# Every NanoPi ever seen is kept, so data from NanoPis that have since been renamed
+# or retired still gets a label: a renamed NanoPi keeps its list of previous names,
+# and a NanoPi that is no longer in the API's list is marked as retired.
+#
+# A Registry can be passed as nanopi_names to any of the plotting functions.
+
+import os
+import json
+import time
+import argparse
+import collections.abc
+import pandas as pd
+
+
+CACHE_PATH = 'data/nanopis.json'
+
+# how long the cached list is used before it is fetched again, in seconds
+TTL = float(os.environ.get('LLV_NANOPI_TTL', 24 * 60 * 60))
+
+
+class Registry(collections.abc.Mapping):
+    """Every NanoPi ever seen, as a mapping from NanoPi ID to its name (location_info).
+
+    Arguments:
+    devices - a dict where the keys are NanoPi IDs and the values are dicts of the fields from the API,
+              plus 'previous_names', 'first_seen', 'last_seen' and 'retired'
+    fetched - when the list was last fetched from the API, in seconds since the epoch, or None
+    """
+
+    def __init__(self, devices=None, fetched=None):
+        self.devices = dict(devices or {})
+        self.fetched = fetched
+        self._names = None
+
+    def __getitem__(self, nanopi_id):
+        return self.devices[nanopi_id].get('location_info')
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def info(self, nanopi_id):
+        """Returns everything known about a NanoPi, or None if it has never been seen."""
+        return self.devices.get(nanopi_id)
+
+    def retired(self):
+        """Returns the IDs of the NanoPis that are no longer in the API's list."""
+        return sorted(nanopi_id for nanopi_id, device in self.devices.items() if device.get('retired'))
+
+    def update(self, nanopis, now=None):
+        """Merges a NanoPi list fetched from the API into the registry.
+
+        Arguments:
+        nanopis - the list returned by common.get_nanopi_list(...)
+        now - the time the list was fetched, in seconds since the epoch; defaults to now
+        """
+        now = time.time() if now is None else now
+        current = set()
+        for nanopi in nanopis:
+            nanopi_id = nanopi.get('id')
+            current.add(nanopi_id)
+            device = self.devices.get(nanopi_id)
+            if device is None:
+                device = {'previous_names': [], 'first_seen': now}
+            elif device.get('location_info') != nanopi.get('location_info'):
+                device['previous_names'] = device.get('previous_names', []) + [device.get('location_info')]
+            device.update(nanopi)
+            device['last_seen'] = now
+            device['retired'] = False
+            self.devices[nanopi_id] = device
+        for nanopi_id, device in self.devices.items():
+            if nanopi_id not in current:
+                device['retired'] = True
+        self.fetched = now
+        self._names = None
+
+    def is_stale(self, ttl=TTL):
+        """Returns whether the list is older than ttl seconds (or has never been fetched)."""
+        return self.fetched is None or time.time() - self.fetched > ttl
+
+    def labels(self, nanopi_ids, default=None):
+        """Returns the names of a sequence of NanoPi IDs (e.g. a dataframe's columns) as a list.
+
+        Arguments:
+        nanopi_ids - the NanoPi IDs
+        default - the label of IDs that have never been seen; None means 'NanoPi <id>'
+        """
+        if self._names is None:
+            self._names = pd.Series({nanopi_id: device.get('location_info')
+                                     for nanopi_id, device in self.devices.items()}, dtype=object)
+        ids = pd.Index(nanopi_ids)
+        names = self._names.reindex(ids).values
+        missing = pd.isnull(names)
+        if missing.any():
+            names[missing] = ['NanoPi {}'.format(nanopi_id) if default is None else default
+                              for nanopi_id in ids[missing]]
+        return list(names)
+
+    def save(self, path=CACHE_PATH):
+        """Saves the registry to a JSON file; an existing file is replaced atomically."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'wt') as file:
+            json.dump({'fetched': self.fetched, 'devices': list(self.devices.values())}, file, indent=1)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load_file(cls, path=CACHE_PATH):
+        """Loads a registry saved with save(...); returns an empty registry if the file doesn't exist.
+
+        A plain NanoPi list, as written by older versions, is also accepted.
+        """
+        try:
+            with open(path, 'rt') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return cls()
+        if isinstance(data, list):
+            data = {'fetched': None, 'devices': data}
+        return cls({device.get('id'): device for device in data.get('devices', [])}, data.get('fetched'))
+
+
+def load(auth=None, path=CACHE_PATH, ttl=TTL, refresh=False):
+    """Returns the NanoPi registry, fetching the list from the API only if the cached one is out of date.
+
+    Arguments:
+    auth - the requests auth object; see requests docs. If None, the cached list is used however old it is
+    path - the cache file
+    ttl - the age in seconds after which the cached list is fetched again
+    refresh - whether to fetch the list even if the cached one is still fresh
+    """
+    registry = Registry.load_file(path)
+    if auth is not None and (refresh or registry.is_stale(ttl)):
+        import common
+        registry.update(common.get_nanopi_list(auth))
+        registry.save(path)
+    return registry
+
+
+def labels(nanopi_names, nanopi_ids):
+    """Returns the labels for a sequence of NanoPi IDs, as used by the plotting functions.
+
+    Arguments:
+    nanopi_names - a Registry, or a dict where the keys are nanopi IDs and the values are the names
+    nanopi_ids - the NanoPi IDs
+    """
+    if isinstance(nanopi_names, Registry):
+        return nanopi_names.labels(nanopi_ids)
+    return [nanopi_names.get(nanopi_id) for nanopi_id in nanopi_ids]
+
+
+if __name__ == '__main__':
+
+    import common
+
+    parser = argparse.ArgumentParser(description="Updates the cached NanoPi list and prints it.")
+    parser.add_argument('-f', dest='path', default=CACHE_PATH, help="cache file (default: {})".format(CACHE_PATH))
+    parser.add_argument('--refresh', action='store_true', help="fetch the list even if the cached one is fresh")
+    args = parser.parse_args()
+
+    registry = load(common.get_auth(), args.path, refresh=args.refresh)
+    for nanopi_id in sorted(registry):
+        device = registry.info(nanopi_id)
+        print("{:>4}  {}{}{}".format(
+            nanopi_id, registry[nanopi_id],
+            ' (retired)' if device.get('retired') else '',
+            ' (previously {})'.format(', '.join(device['previous_names'])) if device.get('previous_names') else ''))
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+# Aggregates and plots archived data without loading it all into memory.
+#
+# The plotting functions in bandwidth.py, jitter.py and latency.py need the whole
+# dataframe in memory. The functions here instead stream an archive (see archive.py)
+# in fixed-size chunks of records, compute partial sums and counts for each chunk,
+# and add the partial results together. Memory use depends on the chunk size and the
+# size of the result, not on the size of the archive, and the averages are the same
+# as the ones the in-memory plotting functions compute.
+
+import argparse
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('svg')
+import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+
+import archive
+import instrument
+import nanopi_registry
+
+
+CHUNK_SIZE = 1000000
+
+# the name used in titles and the y axis label of each metric
+LABELS = {
+    'bandwidth': ('Bandwidth', 'Bandwidth (Mbit/s)'),
+    'jitter': ('Jitter', 'Jitter (ms)'),
+    'latency': ('Latency', 'Latency (ms)'),
+}
+
+# the _ is not shown because 0th element goes at origin but there is no xtick at origin
+DOWS = ['_', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def chunk_frame(arch, first, last):
+    """Returns the records of an archive at positions first to last - 1 as a dataframe.
+
+    The dataframe has the columns 'datetime' (in the archive's timezone), 'nanopi',
+    'direction' (if the metric has directions) and 'value'.
+    """
+    records = arch.records[first:last]
+    times = pd.DatetimeIndex(records['time'].astype('datetime64[ns]'))
+    if arch.meta['tz'] is not None:
+        times = times.tz_localize('UTC').tz_convert(arch.meta['tz'])
+    chunk = pd.DataFrame({'datetime': times,
+                          'nanopi': records['nanopi'].astype(np.int64),
+                          'value': np.array(records['value'])})
+    if arch.meta['has_direction']:
+        chunk.loc[:, 'direction'] = np.array(archive.DIRECTIONS, dtype=object)[records['direction']]
+    return chunk
+
+
+def iter_chunks(arch, start=None, end=None, chunk_size=CHUNK_SIZE):
+    """Yields the records of an archive between start and end as dataframes of at most chunk_size rows.
+
+    See chunk_frame(...) for the columns of the dataframes.
+
+    Arguments:
+    arch - an archive.Archive
+    start - the first time to include, or None
+    end - the last time to include, or None
+    chunk_size - the number of records per chunk
+    """
+    first, last = arch.bounds(start, end)
+    for position in range(first, last, chunk_size):
+        yield chunk_frame(arch, position, min(position + chunk_size, last))
+
+
+def _keys(chunk, by):
+    """Returns the columns of a chunk to group by, computing hour of day and day of week as needed."""
+    keys = []
+    for key in by:
+        if key == 'hour':
+            keys.append(pd.Series(chunk.loc[:, 'datetime'].dt.hour, name='hour'))
+        elif key == 'dayofweek':
+            keys.append(pd.Series(chunk.loc[:, 'datetime'].dt.dayofweek, name='dayofweek'))
+        else:
+            keys.append(chunk.loc[:, key])
+    return keys
+
+
+def partial_sums(chunks, by):
+    """Returns the sum and count of values for each group, added up over all chunks.
+
+    Returns a dataframe indexed by the groups with 'sum' and 'count' columns.
+
+    Arguments:
+    chunks - an iterable of chunks, as yielded by iter_chunks(...)
+    by - a list of the keys to group by: any of 'datetime', 'nanopi', 'direction',
+         'hour' (of day) and 'dayofweek'
+    """
+    total = None
+    for chunk in chunks:
+        partial = chunk.loc[:, 'value'].groupby(_keys(chunk, by)).agg(['sum', 'count'])
+        total = partial if total is None else total.add(partial, fill_value=0)
+    if total is None:
+        return pd.DataFrame({'sum': [], 'count': []})
+    return total.sort_index()
+
+
+def streaming_mean(arch, by, start=None, end=None, chunk_size=CHUNK_SIZE):
+    """Returns the mean value of each group of an archive, computed chunk by chunk; see partial_sums(...)."""
+    with instrument.stage('outofcore.{}.{}'.format(arch.metric, '_'.join(by))) as stage:
+        totals = partial_sums(iter_chunks(arch, start, end, chunk_size), by)
+        stage['rows_in'] = int(totals.loc[:, 'count'].sum())
+        stage['rows_out'] = len(totals)
+    return totals.loc[:, 'sum'] / totals.loc[:, 'count']
+
+
+def average(arch, **kwargs):
+    """The average of each NanoPi, like the plot_average(...) functions compute.
+
+    Indexed by NanoPi; for bandwidth, there is one column per direction.
+    """
+    if arch.meta['has_direction']:
+        return streaming_mean(arch, ['nanopi', 'direction'], **kwargs).unstack()
+    return streaming_mean(arch, ['nanopi'], **kwargs)
+
+
+def by_period(arch, period, individual, **kwargs):
+    """The average by hour of day or day of week, like the plot_24h/plot_dow functions compute.
+
+    Arguments:
+    arch - an archive.Archive
+    period - 'hour' or 'dayofweek'
+    individual - if True, there is a column for each NanoPi (for bandwidth, a column for
+                 each (direction, nanopi) pair); otherwise all NanoPis are averaged together
+                 (for bandwidth, with a column for each direction)
+    kwargs - passed on to streaming_mean(...)
+    """
+    by = [period]
+    if arch.meta['has_direction']:
+        by.append('direction')
+    if individual:
+        by.append('nanopi')
+    means = streaming_mean(arch, by, **kwargs)
+    if len(by) > 1:
+        means = means.unstack(by[1:])
+    if period == 'dayofweek' and (not arch.meta['has_direction'] or not individual):
+        means = means.reindex(range(7))
+    return means
+
+
+def coverage(arch, start=None, end=None, chunk_size=CHUNK_SIZE):
+    """Which hourly tests are present, like the plot_coverage(...) functions compute.
+
+    Returns a boolean dataframe indexed by hour with a column for each NanoPi
+    (for bandwidth, a column for each (direction, nanopi) pair).
+    As in the plot_coverage(...) functions, values of 0 count as missing.
+    """
+    first, last = arch.bounds(start, end)
+    if first == last:
+        return pd.DataFrame()
+    times = arch.times
+    tz = arch.meta['tz']
+
+    def timestamp(value):
+        return pd.Timestamp(value, tz='UTC').tz_convert(tz) if tz else pd.Timestamp(value)
+
+    hours = pd.date_range(timestamp(times[first]).floor('H'), timestamp(times[last - 1]).floor('H'), freq='H')
+
+    # a first pass over just the NanoPi IDs finds the columns, so that the second pass
+    # can fill in the grid chunk by chunk
+    nanopis = set()
+    for position in range(first, last, chunk_size):
+        nanopis.update(np.unique(arch.records['nanopi'][position:min(position + chunk_size, last)]).tolist())
+    nanopis = sorted(nanopis)
+    if arch.meta['has_direction']:
+        columns = pd.MultiIndex.from_product([sorted(archive.DIRECTIONS), nanopis], names=['direction', 'nanopi'])
+    else:
+        columns = pd.Index(nanopis, name='nanopi')
+
+    grid = np.zeros((len(hours), len(columns)), dtype=bool)
+    for chunk in iter_chunks(arch, start, end, chunk_size):
+        chunk = chunk.loc[chunk.loc[:, 'value'] != 0, :]
+        rows = hours.get_indexer(chunk.loc[:, 'datetime'])
+        if arch.meta['has_direction']:
+            column_keys = pd.MultiIndex.from_arrays([chunk.loc[:, 'direction'], chunk.loc[:, 'nanopi']])
+        else:
+            column_keys = pd.Index(chunk.loc[:, 'nanopi'])
+        grid[rows, columns.get_indexer(column_keys)] = True
+    return pd.DataFrame(grid, index=pd.Index(hours, name='datetime'), columns=columns)
+
+
+def _save(ax, chart_width, plot_name):
+    fig = ax.get_figure()
+    fig.set_size_inches(chart_width, 6)
+    fig.savefig(plot_name)
+    fig.clear()
+
+
+def _plot_lines(data, arch, nanopi_names, plot_name, title, xlabel, chart_width, dows=False):
+    """Plots one line per column, or a pair of plots (up and down) if the columns are per direction and NanoPi."""
+    _, ylabel = LABELS[arch.metric]
+    if isinstance(data, pd.DataFrame) and isinstance(data.columns, pd.MultiIndex):
+        for direction in ['up', 'down']:
+            part = data.loc[:, direction]
+            ax = part.plot()
+            if dows:
+                ax.set_xticklabels(DOWS, rotation=0)
+            ax.set(xlabel=xlabel, ylabel=ylabel, title='{} ({})'.format(title, direction.capitalize()))
+            if nanopi_names:
+                ax.legend(nanopi_registry.labels(nanopi_names, part.columns))
+            _save(ax, chart_width, '{}_{}'.format(direction, plot_name))
+        return
+    ax = data.plot()
+    if dows:
+        ax.set_xticklabels(DOWS, rotation=0)
+    ax.set(xlabel=xlabel, ylabel=ylabel, title=title)
+    if nanopi_names and isinstance(data, pd.DataFrame) and data.columns.name == 'nanopi':
+        ax.legend(nanopi_registry.labels(nanopi_names, data.columns))
+    _save(ax, chart_width, plot_name)
+
+
+def plot_average(arch, nanopi_names=None, plot_name=None, title=None, chart_width=10, **kwargs):
+    """Produces a bar graph of the average of each NanoPi, like the plot_average(...) functions.
+
+    Arguments:
+    arch - the archive.Archive used as a data source
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    plot_name - the file name of the plot; defaults to the same name as the in-memory function
+    title - a string that will become the title of the produced plot
+    chart_width - the width of the produced plot
+    kwargs - start, end and chunk_size; see streaming_mean(...)
+    """
+    name, ylabel = LABELS[arch.metric]
+    averages = average(arch, **kwargs)
+    ax = averages.plot(kind='bar')
+    ax.set(xlabel='Location', ylabel=ylabel, title=title or 'Average {} by Location'.format(name))
+    if nanopi_names:
+        ax.set_xticklabels(nanopi_registry.labels(nanopi_names, averages.index), rotation=0)
+    _save(ax, chart_width, plot_name or 'average_{}.svg'.format(arch.metric))
+
+
+def plot_24h_average(arch, plot_name=None, title=None, chart_width=10, **kwargs):
+    """Produces a graph of the average of all NanoPis by hour of day, like the plot_24h_average(...) functions.
+
+    Arguments are as for plot_average(...).
+    """
+    name, _ = LABELS[arch.metric]
+    _plot_lines(by_period(arch, 'hour', False, **kwargs), arch, None,
+                plot_name or '24h_average_{}.svg'.format(arch.metric),
+                title or 'Average {} by Hour (Aggregate)'.format(name), 'Hour of Day', chart_width)
+
+
+def plot_24h(arch, nanopi_names=None, plot_name=None, title=None, chart_width=10, **kwargs):
+    """Produces a graph of the average of each NanoPi by hour of day, like the plot_24h(...) functions.
+
+    Arguments are as for plot_average(...).
+    """
+    name, _ = LABELS[arch.metric]
+    _plot_lines(by_period(arch, 'hour', True, **kwargs), arch, nanopi_names,
+                plot_name or '24h_{}.svg'.format(arch.metric),
+                title or 'Average {} by Hour (Individual)'.format(name), 'Hour of Day', chart_width)
+
+
+def plot_dow_average(arch, plot_name=None, title=None, chart_width=10, **kwargs):
+    """Produces a graph of the average of all NanoPis by day of week, like the plot_dow_average(...) functions.
+
+    Arguments are as for plot_average(...).
+    """
+    name, _ = LABELS[arch.metric]
+    _plot_lines(by_period(arch, 'dayofweek', False, **kwargs), arch, None,
+                plot_name or 'dow_average_{}.svg'.format(arch.metric),
+                title or 'Average {} by Day of Week (Aggregate)'.format(name), 'Day of Week', chart_width,
+                dows=True)
+
+
+def plot_dow(arch, nanopi_names=None, plot_name=None, title=None, chart_width=10, **kwargs):
+    """Produces a graph of the average of each NanoPi by day of week, like the plot_dow(...) functions.
+
+    Arguments are as for plot_average(...).
+    """
+    name, _ = LABELS[arch.metric]
+    _plot_lines(by_period(arch, 'dayofweek', True, **kwargs), arch, nanopi_names,
+                plot_name or 'dow_{}.svg'.format(arch.metric),
+                title or 'Average {} by Day of Week (Individual)'.format(name), 'Day of Week', chart_width,
+                dows=True)
+
+
+def plot_coverage(arch, nanopi_names=None, plot_name=None, title=None, chart_width=10, **kwargs):
+    """Produces a plot of which tests were missed, like the plot_coverage(...) functions.
+
+    Arguments are as for plot_average(...).
+    """
+    name, _ = LABELS[arch.metric]
+    title = title or 'Coverage of {} Tests'.format(name)
+    plot_name = plot_name or 'coverage_{}.svg'.format(arch.metric)
+    present = coverage(arch, **kwargs)
+    black_patch = mpatches.Patch(color='black', label='missing')
+    white_patch = mpatches.Patch(color='white', label='present')
+    if arch.meta['has_direction']:
+        parts = [('up_' + plot_name, title + ' (Up)', present.loc[:, 'up']),
+                 ('down_' + plot_name, title + ' (Down)', present.loc[:, 'down'])]
+    else:
+        parts = [(plot_name, title, present)]
+    for part_name, part_title, part in parts:
+        fig, ax = plt.subplots()
+        ax.imshow(part.values.T, aspect='auto', cmap=plt.cm.gray, interpolation='nearest')
+        if nanopi_names:
+            ax.set_yticklabels(['_', *nanopi_registry.labels(nanopi_names, part.columns)])
+        ax.set(ylabel='Location', title=part_title)
+        ax.legend(handles=[black_patch, white_patch])
+        fig.set_size_inches(chart_width, 6)
+        fig.savefig(part_name)
+        fig.clear()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Plots archived data without loading it all into memory.")
+    parser.add_argument('metrics', nargs='*', default=list(LABELS))
+    parser.add_argument('-d', dest='directory', default=archive.ARCHIVE_DIR, help="archive directory")
+    parser.add_argument('-c', dest='chunk_size', default=CHUNK_SIZE, type=int, help="records per chunk")
+    args = parser.parse_args()
+
+    # the cached NanoPi list, if there is one; the API isn't asked
+    nanopi_names = nanopi_registry.load()
+    for metric in args.metrics:
+        print("Creating plots for {}".format(metric))
+        arch = archive.Archive(metric, args.directory)
+        plot_average(arch, nanopi_names=nanopi_names, chunk_size=args.chunk_size)
+        plot_24h_average(arch, chunk_size=args.chunk_size)
+        plot_24h(arch, nanopi_names=nanopi_names, chunk_size=args.chunk_size)
+        plot_dow_average(arch, chunk_size=args.chunk_size)
+        plot_dow(arch, nanopi_names=nanopi_names, chunk_size=args.chunk_size)
+        plot_coverage(arch, nanopi_names=nanopi_names, chunk_size=args.chunk_size)
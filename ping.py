@@ -1,36 +1,100 @@
 #!/usr/bin/env python3
 
 # Contains plotting functions related to ping test results.
+#
+# Every function takes either raw pings (from common.get_ping_dataframe(...) or an archive)
+# or the hourly counts kept by rollup.py, which are much smaller and are what the
+# command line tools plot by default.
 
-import requests
-from getpass import getpass
 import pandas as pd
-import numpy as np
 import matplotlib
 matplotlib.use('svg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
-import common
+import instrument
+import plot_cache
+import plot_data
+import nanopi_registry
+import rollup
 
 
+@instrument.instrumented
+@plot_cache.cached(['state', 'down'])
 def plot_down_count(df, nanopi_names=None, plot_name='down_count.svg',
                     title='Number of Failed Pings', chart_width=10):
     """Produces a bar graph depicting number of failed pings in given dataframe
 
     Arguments:
-    df - the pandas dataframe used as a data source
-    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot
+    df - the pandas dataframe used as a data source: raw pings, or hourly counts from rollup.py
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
     plot_name - the file name of the plot that is produced by this function
     title - a string that will become the title of the produced plot
     chart_width - the width of the produced plot
     """
-    counts = df.loc[:, 'state'].groupby('nanopi').count()
+    counts = rollup.counts(df).loc[:, 'down'].groupby('nanopi').sum()
+    plot_data.save(counts, plot_name, 'down')
     ax = counts.plot(kind='bar')
     ax.set(xlabel='Location', ylabel='Failed Ping Count', title=title)
     if nanopi_names:
-        labels = []
-        for nanopi_id in counts.index:
-            labels.append(nanopi_names.get(nanopi_id))
+        labels = nanopi_registry.labels(nanopi_names, counts.index)
+        ax.set_xticklabels(labels, rotation=0)
+    fig = ax.get_figure()
+    fig.set_size_inches(chart_width, 6)
+    fig.savefig(plot_name)
+    fig.clear()
+
+
+@instrument.instrumented
+@plot_cache.cached(['state', 'down'])
+def plot_daily_down(df, nanopi_names=None, plot_name='daily_down.svg',
+                    title='Failed Pings per Day', chart_width=10):
+    """Plots the number of failed pings of each NanoPi on each day.
+
+    Arguments:
+    df - the pandas dataframe used as a data source: raw pings, or hourly counts from rollup.py
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
+    plot_name - the file name of the plot that is produced by this function
+    title - a string that will become the title of the produced plot
+    chart_width - the width of the produced plot
+    """
+    data = rollup.daily_counts(rollup.counts(df)).loc[:, 'down'].unstack().fillna(value=0)
+    plot_data.save(data, plot_name, 'down')
+    ax = data.plot()
+    ax.set(xlabel='Date', ylabel='Failed Ping Count', title=title)
+    if nanopi_names:
+        labels = nanopi_registry.labels(nanopi_names, data.columns)
+        ax.legend(labels)
+    fig = ax.get_figure()
+    fig.set_size_inches(chart_width, 6)
+    fig.savefig(plot_name)
+    fig.clear()
+
+
+@instrument.instrumented
+@plot_cache.cached(['state', 'down'])
+def plot_outage_hours(df, nanopi_names=None, plot_name='outage_hours.svg',
+                      title='Hours with Failed Pings', chart_width=10):
+    """Produces a bar graph of the number of hours in which each NanoPi had failed pings,
+    split into the longest outage and the rest; see rollup.outage_stats(...).
+
+    Arguments:
+    df - the pandas dataframe used as a data source: raw pings, or hourly counts from rollup.py
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want on the plot,
+                   or a nanopi_registry.Registry
+    plot_name - the file name of the plot that is produced by this function
+    title - a string that will become the title of the produced plot
+    chart_width - the width of the produced plot
+    """
+    stats = rollup.outage_stats(df)
+    plot_data.save(stats, plot_name)
+    data = pd.DataFrame({'Longest outage': stats.loc[:, 'longest'],
+                         'Other outages': stats.loc[:, 'hours'] - stats.loc[:, 'longest']})
+    ax = data.plot(kind='bar', stacked=True)
+    ax.set(xlabel='Location', ylabel='Hours', title=title)
+    if nanopi_names:
+        labels = nanopi_registry.labels(nanopi_names, data.index)
         ax.set_xticklabels(labels, rotation=0)
     fig = ax.get_figure()
     fig.set_size_inches(chart_width, 6)
@@ -40,15 +104,17 @@ def plot_down_count(df, nanopi_names=None, plot_name='down_count.svg',
 
 if __name__ == '__main__':
 
-    username = input("API Username: ")
-    password = getpass(prompt="API Password: ")
-    auth = requests.auth.HTTPBasicAuth(username, password)
+    import common
 
-    nanopis = requests.get(common.NANOPI_URL, auth=auth).json()
-    nanopi_names = {nanopi.get('id'):nanopi.get('location_info') for nanopi in nanopis}
+    auth = common.get_auth()
+    nanopi_names = nanopi_registry.load(auth)
 
-    df = common.get_ping_dataframe(auth)
-    plot_down_count(df, nanopi_names=nanopi_names)
+    counts = rollup.Rollup()
+    counts.update(common.get_ping_dataframe(auth), source='api')
+    counts.save()
+    plot_down_count(counts.hourly(), nanopi_names=nanopi_names)
+    plot_daily_down(counts.hourly(), nanopi_names=nanopi_names)
+    plot_outage_hours(counts.hourly(), nanopi_names=nanopi_names)
 
 #    df_wo_demetrios = df.loc[(slice(None), [11, 12, 13, 14, 17], slice(None)), :]
 #    plot_average(df_wo_demetrios, nanopi_names, plot_name='average_bandwidth_wo_demetrios.svg',
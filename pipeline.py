@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Loads dataframes from the API with fetching and parsing overlapped.
+#
+# The common.get_XX_dataframe(...) functions fetch every page, then parse every result,
+# then build the dataframe, so the CPU is idle while waiting for the network and the
+# network is idle while parsing. load(...) runs the same steps as a pipeline of threads
+# connected by bounded queues:
+#
+#   fetch    requests each page and decodes its JSON into columns with one of the decoders in
+#            decoders.py (the URL of the next page is in it)
+#   parse    gathers the columns of pages until it has BATCH_ROWS results, and turns them into
+#            a dataframe with common.parse_columns(...)
+#   finish   (the calling thread) concatenates the pages and removes duplicates and
+#            re-indexes with common.finalize(...)
+#
+# Requests release the GIL while waiting on the socket, so parsing one page overlaps
+# with fetching the next, and the total time approaches the larger of the network time
+# and the parsing time rather than their sum. The queues hold at most PREFETCH pages,
+# so a fast network can't fill memory with pages that haven't been parsed yet.
+# While a pipeline runs, Python switches threads more often than usual (SWITCH_INTERVAL), so
+# that the fetch thread gets the GIL back soon after each response arrives instead of
+# waiting for the parse thread to give it up.
+# The result is the same dataframe common.get_XX_dataframe(...) returns.
+
+import sys
+import queue
+import argparse
+import contextlib
+import threading
+import pandas as pd
+
+import common
+import decoders
+import instrument
+
+
+# pages waiting between two stages
+PREFETCH = 4
+
+# results parsed together; building a dataframe has a fixed cost that dwarfs parsing a single page
+BATCH_ROWS = 20000
+
+# the name of the URL in common.py and the default URL parameters of each metric
+METRICS = {
+    'bandwidth': ('IPERF3_URL', None),
+    'jitter': ('JITTER_URL', None),
+    'latency': ('LATENCY_URL', None),
+    'ping': ('PING_URL', {'state': 'down'}),
+}
+
+# how often, in seconds, Python switches threads while a pipeline runs; the default is 0.005
+SWITCH_INTERVAL = 0.001
+
+# put on a queue after the last page
+_DONE = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(out, item, stop):
+    # waits for room on the queue, giving up if a later stage has failed
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            out.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _take(source, stop):
+    # waits for the next item on the queue, giving up if another stage has failed
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return source.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+
+_switch_lock = threading.Lock()
+_switch_users = 0
+_switch_default = None
+
+
+@contextlib.contextmanager
+def _switching():
+    # lowers the switch interval while any pipeline is running, and restores it after the last one
+    global _switch_users, _switch_default
+    with _switch_lock:
+        if _switch_users == 0:
+            _switch_default = sys.getswitchinterval()
+            sys.setswitchinterval(min(SWITCH_INTERVAL, _switch_default))
+        _switch_users += 1
+    try:
+        yield
+    finally:
+        with _switch_lock:
+            _switch_users -= 1
+            if _switch_users == 0:
+                sys.setswitchinterval(_switch_default)
+
+
+def _stage(name, func, stop, errors):
+    # runs one stage, passing any exception on to the calling thread and stopping the other stages
+    def run():
+        try:
+            func()
+        except _Stopped:
+            pass
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+    return threading.Thread(target=run, name=name, daemon=True)
+
+
+def load(metric, auth, params=None, prefetch=PREFETCH, decoder=None, batch_rows=BATCH_ROWS):
+    """Gets data from the API and formats it as a pandas dataframe, overlapping fetching and parsing.
+
+    Returns the same dataframe as common.get_XX_dataframe(auth, params).
+
+    Arguments:
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    auth - the requests auth object; see requests docs
+    params - a dict containing URL parameters for API requests; defaults to those of common.get_XX_dataframe(...)
+    prefetch - the most pages waiting between two stages
+    decoder - the JSON decoder to use, from decoders.get(...); defaults to decoders.get()
+    batch_rows - the number of results parsed together
+    """
+    url_name, default_params = METRICS[metric]
+    decoder = decoder or decoders.get()
+    url = getattr(common, url_name)
+    params = default_params if params is None else params
+    endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+    # fetch_all(...) sets the progress callback in the calling thread
+    progress = getattr(common._progress, 'callback', None)
+    pages = queue.Queue(maxsize=prefetch)
+    frames = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    errors = []
+
+    def fetch():
+        with instrument.stage('fetch.' + endpoint, pages=0, bytes=0, rows_out=0) as stage:
+            next_url, next_params = url, params
+            while next_url:
+                response = common._get(next_url, auth, next_params)
+                # the next url already contains the parameters
+                next_params = None
+                columns, count, next_url = decoder.columns(response.content, metric)
+                rows = len(columns['id'])
+                stage['pages'] += 1
+                stage['bytes'] += len(response.content)
+                stage['rows_out'] += rows
+                if progress:
+                    progress(stage['pages'], stage['rows_out'], count, next_url is None)
+                if rows:
+                    _put(pages, columns, stop)
+        _put(pages, _DONE, stop)
+
+    def parse_pages():
+        with instrument.stage('{}.parse'.format(metric), rows_in=0) as stage:
+            batch = []
+            rows = 0
+            while True:
+                columns = _take(pages, stop)
+                if columns is not _DONE:
+                    batch.append(columns)
+                    rows += len(columns['id'])
+                    stage['rows_in'] += len(columns['id'])
+                if batch and (columns is _DONE or rows >= batch_rows):
+                    _put(frames, common.parse_columns(metric, decoders.concatenate(batch, metric)), stop)
+                    batch = []
+                    rows = 0
+                if columns is _DONE:
+                    break
+        _put(frames, _DONE, stop)
+
+    print("Getting and parsing data from API...")
+    threads = [_stage('{}.fetch'.format(metric), fetch, stop, errors),
+               _stage('{}.parse'.format(metric), parse_pages, stop, errors)]
+    parts = []
+    with _switching():
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                frame = _take(frames, stop)
+                if frame is _DONE:
+                    break
+                parts.append(frame)
+        except _Stopped:
+            pass
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+    if errors:
+        raise errors[0]
+
+    print("Putting initial dataframe together...")
+    with instrument.stage('{}.build'.format(metric), rows_in=sum(len(part) for part in parts)) as stage:
+        if parts:
+            df = pd.concat(parts)
+        else:
+            df = common.parse_columns(metric, decoders.concatenate([], metric))
+        stage['rows_out'] = len(df)
+    return common.finalize(metric, df)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Fetches data from the API with a pipeline and saves it to data/.")
+    parser.add_argument('metrics', nargs='*', default=list(METRICS))
+    parser.add_argument('-p', dest='prefetch', default=PREFETCH, type=int,
+                        help="pages waiting between stages (default: {})".format(PREFETCH))
+    args = parser.parse_args()
+
+    auth = common.get_auth()
+    import archive
+    for metric in args.metrics:
+        df = load(metric, auth, prefetch=args.prefetch)
+        archive.write(df, metric)
+        print("{}: {} rows saved".format(metric, len(df)))
+    instrument.summary()
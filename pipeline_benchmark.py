@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# Runs the whole nightly pipeline against a local stand-in API and a generated SQLite
+# database at several scales, and records how each stage scales.
+#
+# The stages are the scripts a deployment runs, each in a process of its own, in order:
+#
+#   to_csv        ./to_csv.py                   CSV exports of bandwidth, jitter and latency
+#   get_ping      ./get_ping.py -n DAYS         daily ping counts from testresults_pingresult
+#   combine_ping  ./combine_ping.py             ping.csv from the daily counts
+#   fetch         ./cli.py fetch                archives and ping rollup, which plot.py reads
+#   plot          ./plot.py                     every plot
+#
+# For every stage the wall time, user and system CPU time, peak memory (from the rusage
+# of the stage's process) and the size of the files it wrote are recorded. Scales are
+# given as NANOPISxDAYS:
+#
+#     ./pipeline_benchmark.py -s 10x30 -s 50x365 -o before.json
+#     ./pipeline_benchmark.py -s 10x30 -s 50x365 -o after.json
+#     ./pipeline_benchmark.py --compare before.json after.json
+#
+# If any stage fails, the benchmark exits with status 1 without writing the results file, so a
+# broken pipeline is never recorded as a baseline; the stages' output is in stages.log (keep it with -w).
+# --compare prints the change of every measurement and exits with status 1 if any stage
+# failed, or got slower, bigger or used more memory than the threshold allows, so it can gate a change.
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+
+import fake_api
+import synthetic
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SCALES = ['10x30', '50x365']
+
+START = '2018-05-01'
+
+# (name, command); {year}, {month}, {day} and {days} are filled in for each scale
+STAGES = [
+    ('to_csv', ['to_csv.py']),
+    ('get_ping', ['get_ping.py', '-y', '{year}', '-m', '{month}', '-d', '{day}', '-n', '{days}']),
+    ('combine_ping', ['combine_ping.py']),
+    ('fetch', ['cli.py', 'fetch']),
+    ('plot', ['plot.py']),
+]
+
+# Runs a stage and writes its exit code, wall time and rusage as JSON to a file descriptor.
+# Linux starts a child's peak memory at the memory of the process it was forked from, so stages
+# are started from this small process rather than from the benchmark, which holds all the data.
+LAUNCHER = '''
+import os, sys, json, time, subprocess
+start = time.perf_counter()
+process = subprocess.Popen(sys.argv[2:])
+_, status, usage = os.wait4(process.pid, 0)
+seconds = time.perf_counter() - start
+os.write(int(sys.argv[1]), json.dumps([os.waitstatus_to_exitcode(status), seconds, usage.ru_utime,
+                                       usage.ru_stime, usage.ru_maxrss]).encode())
+'''
+
+# measurements compared by --compare, with the smallest change that counts as a regression
+# whatever the threshold, so that noise in small numbers isn't flagged
+MEASUREMENTS = [
+    ('seconds', 0.5),
+    ('peak_rss', 32 * 2 ** 20),
+    ('output_bytes', 2 ** 20),
+]
+
+
+def write_sqlite(records, path, table='testresults_pingresult'):
+    """Writes ping records, as produced by synthetic.generate(...), to a table shaped like the API's.
+
+    Arguments:
+    records - a list of dicts with the keys 'nanopi', 'state' and 'time'
+    path - the SQLite database to write
+    table - the name of the table
+    """
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('create table {} (id integer primary key, nanopi_id integer, state varchar(4), '
+                     'time datetime)'.format(table))
+        # the API's database keeps times as 'YYYY-MM-DD HH:MM:SS' in UTC
+        conn.executemany('insert into {} (nanopi_id, state, time) values (?, ?, ?)'.format(table),
+                         ((record['nanopi'], record['state'], record['time'][:19].replace('T', ' '))
+                          for record in records))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _files(directory):
+    # returns a dict where the keys are paths of files and the values are (size, modification time)
+    found = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            status = os.stat(path)
+            found[path] = (status.st_size, status.st_mtime_ns)
+    return found
+
+
+def run_stage(name, command, directory, environ, log):
+    """Runs one stage in a process of its own and returns its measurements.
+
+    Arguments:
+    name - the name of the stage
+    command - the script in the repository and its arguments
+    directory - the directory the stage runs in
+    environ - the environment variables of the stage
+    log - an open file the stage's output goes to
+    """
+    before = _files(directory)
+    log.write("### {}: {}\n".format(name, ' '.join(command)))
+    log.flush()
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd, 'rb') as pipe:
+        try:
+            subprocess.run([sys.executable, '-S', '-c', LAUNCHER, str(write_fd), sys.executable,
+                            os.path.join(REPO_DIR, command[0])] + command[1:],
+                           cwd=directory, env=environ, stdin=subprocess.DEVNULL, stdout=log,
+                           stderr=subprocess.STDOUT, pass_fds=[write_fd], check=True)
+        finally:
+            os.close(write_fd)
+        returncode, seconds, user_seconds, system_seconds, maxrss = json.loads(pipe.read())
+    after = _files(directory)
+    written = [path for path, stat in after.items() if before.get(path) != stat]
+    return {
+        'stage': name,
+        'returncode': returncode,
+        'seconds': round(seconds, 3),
+        'user_seconds': round(user_seconds, 3),
+        'system_seconds': round(system_seconds, 3),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss': maxrss * 1024,
+        'output_files': len(written),
+        'output_bytes': sum(after[path][0] for path in written),
+    }
+
+
+def run_scale(nanopis, days, directory, page_size=100, seed=0):
+    """Runs every stage at one scale in a directory and returns a list of result dicts."""
+    data = synthetic.generate(nanopis=nanopis, days=days, start=START, seed=seed)
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    sqlite_path = os.path.join(directory, 'db.sqlite3')
+    write_sqlite(data['ping'], sqlite_path)
+    sync_dir = os.path.join(directory, 'sync')
+    os.makedirs(sync_dir, exist_ok=True)
+
+    api = fake_api.FakeAPI(data, page_size=page_size)
+    environ = dict(os.environ, LLV_CONFIG=os.path.join(directory, 'llv.ini'),
+                   LLV_API_USERNAME='benchmark', LLV_API_PASSWORD='benchmark', MPLBACKEND='Agg')
+    environ.pop('LLV_SITE', None)
+    year, month, day = START.split('-')
+    fields = {'year': year, 'month': month, 'day': day, 'days': days}
+    results = []
+    try:
+        with open(environ['LLV_CONFIG'], 'wt') as file:
+            file.write("[benchmark]\nbase_url = {}\ndata_dir = {}\nsync_dir = {}\nsqlite_path = {}\n".format(
+                api.start(), os.path.join(directory, 'data'), sync_dir, sqlite_path))
+        with open(os.path.join(directory, 'stages.log'), 'wt') as log:
+            for name, command in STAGES:
+                result = run_stage(name, [part.format(**fields) for part in command], directory, environ, log)
+                result.update(nanopis=nanopis, days=days)
+                results.append(result)
+                print("{:>4}x{:<5} {:<14} {:>9.2f}s {:>8.1f} MB peak {:>9.1f} MB written{}".format(
+                    nanopis, days, name, result['seconds'], result['peak_rss'] / 2 ** 20,
+                    result['output_bytes'] / 2 ** 20,
+                    '' if result['returncode'] == 0 else '  FAILED ({})'.format(result['returncode'])))
+    finally:
+        api.stop()
+    return results
+
+
+def compare(old, new, threshold=0.2):
+    """Compares two lists of results and returns a list of lines, and whether there was a regression.
+
+    A measurement regresses when it grows by more than threshold (e.g. 0.2 for 20%) and by more
+    than its smallest change in MEASUREMENTS. A stage that failed in either run is a regression
+    too, as its measurements can't be compared.
+
+    Arguments:
+    old - the results of the earlier run
+    new - the results of the later run
+    threshold - the fraction a measurement may grow by
+    """
+    def key(result):
+        return result['nanopis'], result['days'], result['stage']
+
+    old_results = {key(result): result for result in old}
+    lines = ["{:>10} {:<14} {:<13} {:>12} {:>12} {:>8}".format('scale', 'stage', 'measurement', 'old', 'new', 'change')]
+    regressed = False
+    for result in new:
+        previous = old_results.get(key(result))
+        scale = '{}x{}'.format(result['nanopis'], result['days'])
+        if previous is None:
+            regressed = regressed or result['returncode'] != 0
+            lines.append("{:>10} {:<14} (new){}".format(
+                scale, result['stage'], '' if result['returncode'] == 0 else '  failed ({})  REGRESSION'.format(
+                    result['returncode'])))
+            continue
+        if result['returncode'] != 0 or previous['returncode'] != 0:
+            regressed = True
+            lines.append("{:>10} {:<14} failed (old {}, new {})  REGRESSION".format(
+                scale, result['stage'], previous['returncode'], result['returncode']))
+            continue
+        for measurement, floor in MEASUREMENTS:
+            before, after = previous[measurement], result[measurement]
+            change = (after - before) / before if before else 0.0
+            worse = change > threshold and after - before > floor
+            regressed = regressed or worse
+            lines.append("{:>10} {:<14} {:<13} {:>12} {:>12} {:>+7.1%}{}".format(
+                scale, result['stage'], measurement, before, after, change, '  REGRESSION' if worse else ''))
+    return lines, regressed
+
+
+def parse_scale(scale):
+    nanopis, days = scale.lower().split('x')
+    return int(nanopis), int(days)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks the nightly pipeline end to end against synthetic data.")
+    parser.add_argument('-s', dest='scales', action='append', metavar='NANOPISxDAYS',
+                        help="scale to run at; may be repeated (default: {})".format(' '.join(DEFAULT_SCALES)))
+    parser.add_argument('-o', dest='output', default=None, help="write results to this JSON file")
+    parser.add_argument('-w', dest='work', default=None,
+                        help="directory to run the pipeline in, kept afterwards (default: a temporary directory)")
+    parser.add_argument('--page-size', dest='page_size', default=100, type=int)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two results files instead")
+    parser.add_argument('-t', dest='threshold', default=0.2, type=float,
+                        help="fraction a measurement may grow by before --compare calls it a regression (default: 0.2)")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], 'rt') as file:
+            old = json.load(file)
+        with open(args.compare[1], 'rt') as file:
+            new = json.load(file)
+        lines, regressed = compare(old, new, args.threshold)
+        print('\n'.join(lines))
+        sys.exit(1 if regressed else 0)
+
+    work = args.work or tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    results = []
+    try:
+        for scale in args.scales or DEFAULT_SCALES:
+            nanopis, days = parse_scale(scale)
+            results.extend(run_scale(nanopis, days, os.path.join(work, '{}x{}'.format(nanopis, days)),
+                                     page_size=args.page_size))
+    finally:
+        if not args.work:
+            shutil.rmtree(work)
+
+    failed = ['{}x{} {}'.format(result['nanopis'], result['days'], result['stage'])
+              for result in results if result['returncode'] != 0]
+    if failed:
+        sys.exit("Stage(s) failed, so no results were written: {}".format(', '.join(failed)))
+    if args.output:
+        with open(args.output, 'wt') as file:
+            json.dump(results, file, indent=2)
@@ -2,28 +2,33 @@
 
 # This file contains example scripts.
 # The idea is that you read them as examples while creating your own plots.
+# It plots from the memory-mapped archives in <data_dir>/archive/ that ./cli.py fetch writes;
+# to plot from the HDF5 snapshots instead, use common.read_snapshot(site.data_path('<metric>.h5')).
+# The NanoPi names come from the API, and data_dir from the settings, of the site in llv.ini (see config.py).
 
 import os
-import requests
-from getpass import getpass
 import pandas as pd
 
 import common
+import config
+import archive
+import instrument
+import nanopi_registry
 import bandwidth
 import jitter
 import latency
 import ping
+import rollup
 
-username = input("API Username: ")
-password = getpass(prompt="API Password: ")
-auth = requests.auth.HTTPBasicAuth(username, password)
+site = config.get().apply()
+auth = site.auth()
 
-nanopis = common.get_nanopi_list(auth)
-nanopi_names = {nanopi.get('id'):nanopi.get('location_info') for nanopi in nanopis}
+# the NanoPi list is cached in <data_dir>/nanopis.json and only fetched again once a day
+nanopi_names = nanopi_registry.load(auth, site.data_path('nanopis.json'))
 
 # bandwidth
 print("Creating plots for bandwidth")
-df = pd.read_hdf('data/bandwidth.h5', 'df')
+df = archive.Archive('bandwidth', site.data_path('archive')).to_dataframe()
 bandwidth.plot_average(df, nanopi_names=nanopi_names)
 bandwidth.plot_24h_average(df)
 bandwidth.plot_24h(df, nanopi_names=nanopi_names)
@@ -35,7 +40,7 @@ bandwidth.plot_coverage(df, nanopi_names=nanopi_names)
 
 # jitter
 print("Creating plots for jitter")
-df = pd.read_hdf('data/jitter.h5', 'df')
+df = archive.Archive('jitter', site.data_path('archive')).to_dataframe()
 jitter.plot_average(df, nanopi_names=nanopi_names)
 jitter.plot_24h_average(df)
 jitter.plot_24h(df, nanopi_names=nanopi_names)
@@ -47,7 +52,7 @@ jitter.plot_coverage(df, nanopi_names=nanopi_names)
 
 # latency
 print("Creating plots for latency")
-df = pd.read_hdf('data/latency.h5', 'df')
+df = archive.Archive('latency', site.data_path('archive')).to_dataframe()
 latency.plot_average(df, nanopi_names=nanopi_names)
 latency.plot_24h_average(df)
 latency.plot_24h(df, nanopi_names=nanopi_names)
@@ -59,8 +64,13 @@ latency.plot_coverage(df, nanopi_names=nanopi_names)
 
 # ping
 print("Creating plots for ping")
-df = pd.read_hdf('data/ping.h5', 'df')
+df = rollup.load(site.data_path('rollup'), site.data_path('archive')).hourly()
 ping.plot_down_count(df, nanopi_names=nanopi_names)
+ping.plot_daily_down(df, nanopi_names=nanopi_names)
+ping.plot_outage_hours(df, nanopi_names=nanopi_names)
+
+# timing summary; only printed when LLV_INSTRUMENT=1
+instrument.summary()
 
 
 ## ensure plots/ is created
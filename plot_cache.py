@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Skips re-rendering plots whose inputs haven't changed.
+#
+# Each plotting function decorated with cached(...) computes a fingerprint of
+# everything that determines its output: the data it plots, its arguments,
+# the NanoPi names and the source code of the module the function is in and of the
+# helper modules in HELPER_MODULES it draws with. The fingerprint of every
+# plot written is recorded in a manifest file (.plot_manifest.json) in the directory
+# the plot was written to. If a plot file exists and its recorded fingerprint matches,
+# the function returns without rendering anything.
+#
+# When plot_data.data_format is set, the data file saved next to each plot must exist too.
+#
+# The cache is off unless it's turned on, either here with enabled = True or with the
+# LLV_PLOT_CACHE environment variable set to 1, since a function skipped this way returns
+# None and draws nothing. The source code is read once, when a plotting module is imported.
+
+import os
+import json
+import hashlib
+import inspect
+import functools
+import importlib.util
+import pandas as pd
+
+import plot_data
+
+
+MANIFEST_NAME = '.plot_manifest.json'
+
+# bump this to invalidate every cached plot, e.g. after a matplotlib style change
+CACHE_VERSION = 1
+
+# modules whose code the plotting functions use, so changing them re-renders every plot;
+# add any module that plotting functions start to use
+HELPER_MODULES = ['facets', 'anomaly', 'nanopi_registry', 'plot_data', 'rollup']
+
+# True to skip plots whose inputs haven't changed
+enabled = os.environ.get('LLV_PLOT_CACHE') == '1'
+
+
+def _json_default(value):
+    # pandas arguments (such as a table of anomalies) are identified by a hash of their contents
+    if isinstance(value, (pd.Series, pd.DataFrame, pd.Index)):
+        return pd.util.hash_pandas_object(value, index=True).sum().item()
+    return str(value)
+
+
+@functools.lru_cache(maxsize=None)
+def _source(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _helpers_version(names):
+    # found without importing them, since they may import the plotting modules
+    return ' '.join(_source(importlib.util.find_spec(name).origin) for name in names)
+
+
+def code_version(func):
+    """Returns a string identifying the code a plotting function runs: the source of its module and of HELPER_MODULES."""
+    return '{} {}'.format(_source(inspect.getsourcefile(func)), _helpers_version(tuple(HELPER_MODULES)))
+
+
+def fingerprint(data, params, nanopi_names=None, code=''):
+    """Returns a hex digest identifying the output of a plotting function.
+
+    Arguments:
+    data - the pandas series or dataframe being plotted
+    params - a dict of the other arguments to the plotting function
+    nanopi_names - the dict of NanoPi names, if any
+    code - a string identifying the version of the plotting code
+    """
+    digest = hashlib.sha1()
+    digest.update('{}\n{}\n'.format(CACHE_VERSION, code).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=_json_default).encode())
+    if nanopi_names:
+        names = sorted((str(key), str(value)) for key, value in dict(nanopi_names).items())
+        digest.update(json.dumps(names).encode())
+    digest.update(str(list(getattr(data, 'index', pd.Index([])).names)).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def _manifest_path(path):
+    return os.path.join(os.path.dirname(path), MANIFEST_NAME)
+
+
+def _read_manifest(path):
+    try:
+        with open(path, 'rt') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_current(paths, digest):
+    """Returns whether every one of the given plot files exists and was made from inputs with the given fingerprint."""
+    for path in paths:
+        if not os.path.exists(path):
+            return False
+        manifest = _read_manifest(_manifest_path(path))
+        if manifest.get(os.path.basename(path)) != digest:
+            return False
+    return True
+
+
+def record(paths, digest):
+    """Records in the manifest that the given plot files were made from inputs with the given fingerprint."""
+    for path in paths:
+        manifest_path = _manifest_path(path)
+        manifest = _read_manifest(manifest_path)
+        manifest[os.path.basename(path)] = digest
+        temporary_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+        with open(temporary_path, 'wt') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(temporary_path, manifest_path)
+
+
+def cached(column, prefixes=('',)):
+    """Decorator that skips a plotting function when its output would be unchanged.
+
+    The decorated function must take the dataframe as its first argument and have
+    a plot_name argument; a nanopi_names argument is optional.
+
+    Arguments:
+    column - the column of the dataframe that the function plots, or a list of columns;
+             columns in the list that the dataframe doesn't have are ignored
+    prefixes - the prefixes the function adds to plot_name for the files it writes,
+               e.g. ('up_', 'down_') for functions that produce a pair of plots
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        code = code_version(func)
+
+        @functools.wraps(func)
+        def wrapper(df, *args, **kwargs):
+            if not enabled:
+                return func(df, *args, **kwargs)
+            arguments = signature.bind(df, *args, **kwargs)
+            arguments.apply_defaults()
+            params = dict(arguments.arguments)
+            del params[next(iter(signature.parameters))]
+            nanopi_names = params.pop('nanopi_names', None)
+            paths = [plot_data.prefixed(prefix, params['plot_name']) for prefix in prefixes]
+            if plot_data.data_format:
+                # the data saved next to the plot is part of its output
+                params['data_format'] = plot_data.data_format
+                paths.append(plot_data.path(params['plot_name']))
+            data = (df.loc[:, [name for name in column if name in df.columns]] if isinstance(column, list)
+                    else df.loc[:, column])
+            digest = fingerprint(data, params, nanopi_names, code)
+            if is_current(paths, digest):
+                return None
+            result = func(df, *args, **kwargs)
+            record(paths, digest)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Saves the data behind each plot next to the plot, and serves it.
+#
+# Every plotting function computes a small aggregate (averages by NanoPi, by hour of day,
+# by day of week, coverage and so on) before drawing it. When data_format is set, either
+# here or with the LLV_PLOT_DATA environment variable, each function also writes that
+# aggregate next to its plot: 24h_jitter.svg comes with 24h_jitter.parquet (or .json).
+# Aggregates are saved in long form, one row per value, e.g.:
+#
+#     hour  nanopi  jitter
+#        0      11   0.412
+#        0      12   0.397
+#
+# so dashboards can re-style or serve charts without loading the raw data.
+# load(...) reads an aggregate back and ./plot_data.py serves a directory of them over HTTP:
+#
+#     ./plot_data.py -d plots -p 8001
+#
+#   /                  JSON list of the aggregates in the directory
+#   /<name>.json       an aggregate as JSON records, e.g. /24h_jitter.json?nanopi=11
+
+import os
+import json
+import glob
+import argparse
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import pandas as pd
+
+
+# file extension of each format
+FORMATS = {'parquet': '.parquet', 'json': '.json'}
+
+# 'parquet', 'json', or None to not save the data behind plots
+data_format = os.environ.get('LLV_PLOT_DATA') or None
+
+
+def path(plot_name, data_format=None):
+    """Returns the path of the file holding the data behind a plot.
+
+    Arguments:
+    plot_name - the file name of the plot, e.g. '24h_jitter.svg'
+    data_format - 'parquet' or 'json'; defaults to the module's data_format
+    """
+    data_format = data_format or globals()['data_format']
+    if data_format not in FORMATS:
+        raise ValueError("the data format must be one of {}".format(', '.join(FORMATS)))
+    return os.path.splitext(plot_name)[0] + FORMATS[data_format]
+
+
+def prefixed(prefix, plot_name):
+    """Returns the path of one of several plots a function writes for plot_name, e.g. 'plots/up_24h_bandwidth.svg'.
+
+    Arguments:
+    prefix - the prefix of the plot, e.g. 'up_'
+    plot_name - the file name of the plot, e.g. 'plots/24h_bandwidth.svg'
+    """
+    directory, name = os.path.split(plot_name)
+    return os.path.join(directory, prefix + name)
+
+
+def tidy(data, value_name=None, index=None, columns=None):
+    """Returns a series or dataframe as a flat dataframe with one row per value; missing values are left out.
+
+    Arguments:
+    data - the pandas series or dataframe behind a plot
+    value_name - the name of the column of values; None keeps the columns of a dataframe as they are
+    index - names for the levels of the index, for levels that don't have one (e.g. ['hour'])
+    columns - names for the levels of the columns of a dataframe that is stacked into value_name
+    """
+    if index:
+        data = data.rename_axis(index)
+    if isinstance(data, pd.DataFrame) and value_name is not None:
+        if columns:
+            data = data.rename_axis(columns=columns)
+        levels = list(range(data.columns.nlevels))
+        try:
+            data = data.stack(levels, future_stack=True)
+        except TypeError:
+            # pandas before 2.1
+            data = data.stack(levels, dropna=False)
+    if isinstance(data, pd.Series):
+        data = data.rename(value_name or data.name or 'value').dropna().to_frame()
+    return data.reset_index()
+
+
+def save(data, plot_name, value_name=None, index=None, columns=None):
+    """Saves the data behind a plot next to it, if data_format is set; see tidy(...) for the arguments.
+
+    Returns the path written, or None.
+
+    Arguments:
+    data - the pandas series or dataframe behind the plot
+    plot_name - the file name of the plot
+    """
+    if not data_format:
+        return None
+    table = tidy(data, value_name, index, columns)
+    table.columns = [str(column) for column in table.columns]
+    file_path = path(plot_name)
+    temporary_path = '{}.{}.tmp'.format(file_path, os.getpid())
+    if data_format == 'parquet':
+        table.to_parquet(temporary_path, index=False)
+    else:
+        table.to_json(temporary_path, orient='table', index=False, date_format='iso',
+                      double_precision=15)
+    os.replace(temporary_path, file_path)
+    return file_path
+
+
+def load(file_path):
+    """Reads the data behind a plot, saved by save(...).
+
+    Arguments:
+    file_path - the path of a .parquet or .json file, or of the plot itself
+    """
+    if os.path.splitext(file_path)[1] not in FORMATS.values():
+        candidates = [path(file_path, data_format) for data_format in FORMATS]
+        existing = [candidate for candidate in candidates if os.path.exists(candidate)]
+        if not existing:
+            raise FileNotFoundError("no data saved for {}".format(file_path))
+        file_path = max(existing, key=os.path.getmtime)
+    if file_path.endswith(FORMATS['parquet']):
+        return pd.read_parquet(file_path)
+    return pd.read_json(file_path, orient='table')
+
+
+def available(directory='.'):
+    """Returns a dict where the keys are the names of the plots with saved data and the values are the paths of the data."""
+    found = {}
+    for extension in FORMATS.values():
+        for file_path in glob.glob(os.path.join(directory, '*' + extension)):
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            if name not in found or os.path.getmtime(file_path) > os.path.getmtime(found[name]):
+                found[name] = file_path
+    return dict(sorted(found.items()))
+
+
+def select(table, filters):
+    """Returns the rows of an aggregate whose columns equal the given values.
+
+    Arguments:
+    table - a dataframe returned by load(...)
+    filters - a dict of column names to values, as strings; commas separate alternatives, e.g. {'nanopi': '11,12'}
+    """
+    mask = pd.Series(True, index=table.index)
+    for column, values in filters.items():
+        if column not in table.columns:
+            raise KeyError(column)
+        mask &= table.loc[:, column].astype(str).isin(values.split(','))
+    return table.loc[mask]
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory='.', host='127.0.0.1', port=8001):
+    """Serves the aggregates saved in a directory over HTTP until interrupted."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            name = parts.path.strip('/')
+            found = available(directory)
+            if not name:
+                return self._send(json.dumps(sorted(found)))
+            if not name.endswith('.json') or name[:-len('.json')] not in found:
+                return self.send_error(404)
+            table = load(found[name[:-len('.json')]])
+            try:
+                table = select(table, dict(parse_qsl(parts.query)))
+            except KeyError as e:
+                return self.send_error(400, "unknown column {}".format(e))
+            self._send(table.to_json(orient='records', date_format='iso'))
+
+        def _send(self, body):
+            content = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    print("Serving plot data from {} at http://{}:{}/".format(os.path.abspath(directory), host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serves the data saved next to plots over HTTP.")
+    parser.add_argument('-d', dest='directory', default='.', help="directory of plots (default: .)")
+    parser.add_argument('-p', dest='port', default=8001, type=int, help="port to listen on (default: 8001)")
+    args = parser.parse_args()
+
+    serve(args.directory, port=args.port)
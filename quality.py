@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Data-quality statistics of each metric, in numbers rather than coverage plots.
+#
+# For bandwidth, jitter and latency, measure(...) reads the hourly grid that the loaders
+# re-index onto (common.reindex_hourly(...)) as one matrix of hours by NanoPi (and direction)
+# and computes, in a single vectorized pass over it:
+#
+#   - the share of expected hourly tests present for each NanoPi on each day
+#   - the share present over the whole trial, the longest run of missing hours and when
+#     it started, and the last hour with data
+#   - the number of duplicate results that the loaders removed
+#
+# For ping, which is only fetched for failed pings, only the number of pings and of
+# duplicates are reported. report(...) combines the measurements of every metric into a
+# compact daily table and a summary, which write(...) saves as quality.csv and quality.json.
+# ./cli.py fetch and ./cli.py sync write them after every run, and
+#
+#     ./quality.py -d data
+#
+# computes them from the archives written by ./cli.py fetch.
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+import common
+
+
+# the column holding the measurements of each metric
+COLUMNS = {'bandwidth': 'bandwidth', 'jitter': 'jitter', 'latency': 'latency', 'ping': 'state'}
+
+HOUR = pd.Timedelta(hours=1)
+
+
+def duplicates(df):
+    """Returns the number of duplicate results in a dataframe, or removed from it by common.finalize(...)."""
+    return int(df.attrs.get('duplicates', 0)) + int(df.index.duplicated().sum())
+
+
+def _grid(df, metric):
+    # returns the hours, the series labels and a matrix of hours by series of whether each hour is missing
+    index = df.index.remove_unused_levels()
+    shape = [len(level) for level in index.levels]
+    size = int(np.prod(shape))
+    # the loaders' dataframes are the full product of their levels already, in order
+    is_grid = len(df) == size and size > 0
+    if is_grid:
+        stride = size
+        for codes, length in zip(index.codes, shape):
+            stride //= length
+            if not np.array_equal(codes, np.arange(size) // stride % length):
+                is_grid = False
+                break
+    if is_grid and shape[0] > 1:
+        is_grid = bool((np.diff(index.levels[0].asi8) == HOUR.value).all())
+    if not is_grid:
+        df = df.loc[~df.index.duplicated(keep='last'), :].sort_index()
+        df = common.reindex_hourly(df, directions=['up', 'down'] if 'direction' in df.index.names else None)
+        index = df.index
+        shape = [len(level) for level in index.levels]
+    missing = df.loc[:, COLUMNS[metric]].isna().values.reshape(shape[0], -1)
+    series = pd.MultiIndex.from_product(index.levels[1:]) if len(shape) > 2 else index.levels[1]
+    labels = ['-'.join(str(part) for part in key) if isinstance(key, tuple) else str(key) for key in series]
+    return index.levels[0], labels, missing
+
+
+def _runs(missing):
+    # returns the length and first row of the longest run of True in each column (0 and -1 if there is none)
+    rows, columns = missing.shape
+    padded = np.zeros((columns, rows + 2), dtype=np.int8)
+    padded[:, 1:-1] = missing.T
+    changes = np.diff(padded, axis=1).ravel()
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    lengths = ends - starts
+    column = starts // (rows + 1)
+    longest = np.zeros(columns, dtype=np.int64)
+    first = np.full(columns, -1, dtype=np.int64)
+    if len(lengths):
+        # the longest run of each column is the last one after sorting by column, then length
+        order = np.lexsort((-starts, lengths, column))
+        last = np.r_[column[order][1:] != column[order][:-1], True]
+        chosen = order[last]
+        longest[column[chosen]] = lengths[chosen]
+        first[column[chosen]] = starts[chosen] - column[chosen] * (rows + 1)
+    return longest, first
+
+
+def measure(df, metric, tz=None):
+    """Computes the data-quality statistics of one metric.
+
+    Returns a dict with the keys 'summary' (a dict of statistics of the metric and of each
+    NanoPi, or NanoPi and direction) and 'daily' (a dataframe indexed by (date, series) with the
+    columns 'expected', 'present' and 'percent'; None for ping).
+
+    Arguments:
+    df - a dataframe from common.get_XX_dataframe(...), pipeline.load(...) or an archive
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    tz - the timezone whose midnights divide days; defaults to common.TIMEZONE
+    """
+    tz = tz or common.TIMEZONE
+    removed = duplicates(df)
+    times = df.index.get_level_values('datetime')
+    if metric == 'ping' or not len(df):
+        measurements = int(df.loc[:, COLUMNS[metric]].notna().sum())
+        summary = {'measurements': measurements, 'duplicates': removed,
+                   'duplicate_rate': removed / (measurements + removed) if measurements + removed else None,
+                   'first': times.min().isoformat() if len(df) else None,
+                   'last': times.max().isoformat() if len(df) else None}
+        return {'summary': summary, 'daily': None}
+
+    hours, labels, missing = _grid(df, metric)
+    present = ~missing
+    local = hours.tz_convert(tz) if hours.tz is not None else hours
+    days = local.tz_localize(None).normalize()
+    day_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    present_by_day = np.add.reduceat(present.astype(np.int64), day_starts, axis=0)
+    hours_by_day = np.diff(np.r_[day_starts, len(hours)])
+
+    daily = pd.DataFrame({
+        'expected': np.repeat(hours_by_day, len(labels)),
+        'present': present_by_day.ravel(),
+    }, index=pd.MultiIndex.from_product([days[day_starts].date, labels], names=['date', 'series']))
+    daily.loc[:, 'percent'] = (100 * daily.loc[:, 'present'] / daily.loc[:, 'expected']).round(1)
+
+    longest, first = _runs(missing)
+    present_count = present.sum(axis=0)
+    # the last row with data in each column, or -1
+    last = len(hours) - 1 - np.argmax(present[::-1], axis=0)
+    last[present_count == 0] = -1
+    series = {}
+    for i, label in enumerate(labels):
+        series[label] = {
+            'expected': int(len(hours)),
+            'present': int(present_count[i]),
+            'percent': round(100 * present_count[i] / len(hours), 1),
+            'longest_gap': int(longest[i]),
+            'longest_gap_start': local[first[i]].isoformat() if first[i] >= 0 else None,
+            'last_present': local[last[i]].isoformat() if last[i] >= 0 else None,
+        }
+    measurements = int(present_count.sum())
+    summary = {'measurements': measurements, 'expected': int(missing.size),
+               'percent': round(100 * measurements / missing.size, 1),
+               'duplicates': removed,
+               'duplicate_rate': removed / (measurements + removed) if measurements + removed else None,
+               'first': local[0].isoformat(), 'last': local[-1].isoformat(),
+               'series': series}
+    return {'summary': summary, 'daily': daily}
+
+
+def report(measurements):
+    """Combines the measurements of several metrics.
+
+    Returns a tuple of (daily, summary): a dataframe indexed by (metric, date, series) with the
+    columns 'expected', 'present' and 'percent', and a dict of the summary of each metric.
+
+    Arguments:
+    measurements - a dict where the keys are metrics and the values are returned by measure(...)
+    """
+    daily = [(metric, result['daily']) for metric, result in measurements.items() if result['daily'] is not None]
+    table = (pd.concat([frame for _, frame in daily], keys=[metric for metric, _ in daily], names=['metric'])
+             if daily else pd.DataFrame(columns=['expected', 'present', 'percent']))
+    summary = {metric: result['summary'] for metric, result in measurements.items()}
+    return table, summary
+
+
+def write(daily, summary, directory='data'):
+    """Writes the daily table to quality.csv and the summary to quality.json in a directory; returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+    csv_path = os.path.join(directory, 'quality.csv')
+    json_path = os.path.join(directory, 'quality.json')
+    daily.to_csv(csv_path)
+    with open(json_path, 'wt') as file:
+        json.dump(summary, file, indent=1)
+    return csv_path, json_path
+
+
+def format_summary(summary):
+    """Returns the summary as a compact text table, one line per NanoPi (and direction) of each metric."""
+    lines = ["{:<10} {:<10} {:>8} {:>12} {:>10}  {}".format('metric', 'series', 'present', 'longest gap',
+                                                          'dupes', 'last data')]
+    for metric, stats in summary.items():
+        rate = '' if stats['duplicate_rate'] is None else '{:.2%}'.format(stats['duplicate_rate'])
+        if 'series' not in stats:
+            lines.append("{:<10} {:<10} {:>8} {:>12} {:>10}  {}".format(
+                metric, 'all', stats['measurements'], '', rate, stats['last'] or ''))
+            continue
+        for label, series in stats['series'].items():
+            lines.append("{:<10} {:<10} {:>7.1f}% {:>11}h {:>10}  {}".format(
+                metric, label, series['percent'], series['longest_gap'], '', series['last_present'] or ''))
+        lines.append("{:<10} {:<10} {:>7.1f}% {:>12} {:>10}  {}".format(
+            metric, 'all', stats['percent'], '', rate, stats['last']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    import time
+    import archive
+
+    parser = argparse.ArgumentParser(description="Reports the coverage and duplicates of the archived data.")
+    parser.add_argument('metrics', nargs='*', default=list(COLUMNS), help="metrics to report on")
+    parser.add_argument('-d', dest='data', default='data', help="data directory written by ./cli.py fetch (default: data)")
+    parser.add_argument('-o', dest='output', default=None, help="directory to write quality.csv and quality.json to "
+                                                                "(default: the data directory)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    measurements = {}
+    for metric in args.metrics:
+        df = archive.Archive(metric, os.path.join(args.data, 'archive')).to_dataframe()
+        measurements[metric] = measure(df, metric)
+    daily, summary = report(measurements)
+    print(format_summary(summary))
+    paths = write(daily, summary, args.output or args.data)
+    print("Wrote {} in {:.2f}s".format(' and '.join(paths), time.perf_counter() - start))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Fast filtering of dataframes by time and NanoPi.
+#
+# The dataframes produced by the common.get_XX_dataframe(...) functions are indexed by
+# datetime first. select(...) finds the requested time range with binary search instead
+# of scanning the whole index, and keeps a precomputed list of row positions for every
+# NanoPi (and direction) so that filtering by NanoPi doesn't need a scan either.
+
+import weakref
+import numpy as np
+import pandas as pd
+
+
+class TimeDeviceIndex:
+    """Row positions of a dataframe, grouped by NanoPi (and direction) and sorted by time.
+
+    Building one takes a single pass over the index; after that every lookup is a
+    binary search per group.
+
+    Arguments:
+    df - a dataframe whose index has a 'datetime' level first, sorted by datetime
+    """
+
+    def __init__(self, df):
+        index = df.index
+        datetimes = index.get_level_values('datetime')
+        if not datetimes.is_monotonic_increasing:
+            raise ValueError("dataframe must be sorted by datetime; call df.sort_index() first")
+        self.tz = datetimes.tz
+        self.times = np.ascontiguousarray(datetimes.asi8)
+
+        # group the remaining levels (nanopi, and direction if present)
+        self.names = [name for name in index.names if name != 'datetime']
+        if isinstance(index, pd.MultiIndex) and self.names:
+            keys = pd.MultiIndex.from_arrays([index.get_level_values(name) for name in self.names])
+            codes, uniques = pd.factorize(keys)
+            order = np.argsort(codes, kind='mergesort')
+            boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+            self.groups = {}
+            for key, positions in zip(uniques, np.split(order, boundaries)):
+                if len(self.names) == 1:
+                    key = key[0] if isinstance(key, tuple) else key
+                self.groups[key] = (positions, self.times[positions])
+        else:
+            self.groups = None
+
+    def _timestamp(self, value, end=False):
+        if value is None:
+            return None
+        if isinstance(value, str) and end:
+            # like .loc, a partial date string as the end includes the whole period, e.g. the whole day
+            timestamp = pd.Period(value).end_time
+        else:
+            timestamp = pd.Timestamp(value)
+        if timestamp.tz is None and self.tz is not None:
+            timestamp = timestamp.tz_localize(self.tz)
+        elif timestamp.tz is not None and self.tz is not None:
+            timestamp = timestamp.tz_convert(self.tz)
+        return timestamp.value
+
+    @staticmethod
+    def _bounds(times, start, end):
+        first = 0 if start is None else np.searchsorted(times, start, side='left')
+        last = len(times) if end is None else np.searchsorted(times, end, side='right')
+        return first, max(first, last)
+
+    def positions(self, start=None, end=None, nanopis=None, direction=None):
+        """Returns the row positions that match; see select(...).
+
+        Returns a slice if the rows are contiguous, otherwise a sorted array of positions.
+        """
+        start = self._timestamp(start)
+        end = self._timestamp(end, end=True)
+        if (nanopis is None and direction is None) or self.groups is None:
+            first, last = self._bounds(self.times, start, end)
+            return slice(first, last)
+
+        if nanopis is not None and np.ndim(nanopis) == 0:
+            nanopis = [nanopis]
+        if direction is not None and np.ndim(direction) == 0:
+            direction = [direction]
+        wanted_nanopis = None if nanopis is None else set(nanopis)
+        wanted_directions = None if direction is None else set(direction)
+        chunks = []
+        for key, (positions, times) in self.groups.items():
+            parts = key if isinstance(key, tuple) else (key,)
+            values = dict(zip(self.names, parts))
+            if wanted_nanopis is not None and values.get('nanopi') not in wanted_nanopis:
+                continue
+            if wanted_directions is not None and values.get('direction') not in wanted_directions:
+                continue
+            first, last = self._bounds(times, start, end)
+            chunks.append(positions[first:last])
+        if not chunks:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(chunks))
+
+
+# TimeDeviceIndex objects for dataframes that select(...) has seen, keyed by id(df)
+_cache = {}
+
+
+def get_index(df):
+    """Returns the TimeDeviceIndex of a dataframe, building it the first time it is asked for.
+
+    The index is kept for as long as the dataframe exists. If you modify the index of
+    a dataframe in place after selecting from it, call forget(df).
+    """
+    key = id(df)
+    entry = _cache.get(key)
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+    index = TimeDeviceIndex(df)
+    _cache[key] = (weakref.ref(df, lambda ref, key=key: _cache.pop(key, None)), index)
+    return index
+
+
+def forget(df):
+    """Discards the cached TimeDeviceIndex of a dataframe."""
+    _cache.pop(id(df), None)
+
+
+def select(df, start=None, end=None, nanopis=None, direction=None):
+    """Returns the rows of a dataframe within a time range and for certain NanoPis and directions.
+
+    Equivalent to slicing with df.loc[(slice(start, end), nanopis, direction), :],
+    but takes O(log n) per NanoPi instead of a scan over the whole dataframe,
+    and works whether or not the index is lexsorted (as long as it is sorted by datetime).
+
+    Arguments:
+    df - a dataframe produced by one of the common.get_XX_dataframe(...) functions
+    start - the first time to include, e.g. '2018-05-30 22:30:00'; None means no lower limit
+    end - the last time to include; a date such as '2018-05-31' includes that whole day,
+          like it does with .loc; None means no upper limit
+    nanopis - a NanoPi ID or list of NanoPi IDs to include; None means all of them
+    direction - 'up', 'down' or a list of them, for dataframes with a direction level;
+                None means both
+    """
+    positions = get_index(df).positions(start, end, nanopis, direction)
+    return df.iloc[positions]
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+# Hourly and daily counts of up and down pings per NanoPi, kept up to date on disk.
+#
+# Raw ping rows are only needed to drill down into a particular outage; the plots and
+# the outage statistics only need counts. A Rollup keeps those counts in data/rollup/:
+#   ping.hourly.npy   records of (hour, nanopi, up, down), sorted by hour
+#   ping.daily.npy    the same per day in common.TIMEZONE
+#   ping.json         the ID of the newest ping counted, and where the counts came from
+#
+# The counts can be built from a ping dataframe (from the API or an archive) or straight
+# from the SQLite database of the API (the source get_ping.py reads), where they are counted
+# by the database itself. Updates are incremental: only pings with an ID greater than the
+# newest one counted so far are added, so updating with overlapping data is harmless.
+# Dataframes without IDs, such as those read from an archive, replace the counts instead.
+# IDs from the API and from SQLite aren't mixed: the API only gives failed pings, so counts from
+# the API are counted again from scratch by the first SQLite update, and counts from SQLite
+# can't be updated from the API.
+#
+# The plotting functions in ping.py take either raw pings or counts from here, and
+# outages(...) and outage_stats(...) summarize the hours in which pings failed.
+
+import os
+import json
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+import common
+import instrument
+
+
+ROLLUP_DIR = 'data/rollup'
+
+RECORD_DTYPE = np.dtype([
+    ('time', '<i8'),        # the start of the hour (or day), nanoseconds since the epoch, UTC
+    ('nanopi', '<i4'),
+    ('up', '<i8'),
+    ('down', '<i8'),
+])
+
+# the table of the API's database that holds pings
+SQLITE_TABLE = 'testresults_pingresult'
+
+COLUMNS = ['up', 'down']
+
+
+def _paths(directory):
+    base = os.path.join(directory, 'ping')
+    return base + '.hourly.npy', base + '.daily.npy', base + '.json'
+
+
+def _empty(tz=None):
+    index = pd.MultiIndex.from_arrays([pd.DatetimeIndex([], tz=tz or common.TIMEZONE), pd.Index([], dtype=np.int64)],
+                                      names=['datetime', 'nanopi'])
+    return pd.DataFrame({column: pd.Series([], dtype=np.int64) for column in COLUMNS}, index=index)
+
+
+def _group(times, nanopis, up, down, tz):
+    # sums counts per (time, nanopi) and returns them as a sorted dataframe
+    if not len(times):
+        return _empty(tz)
+    df = pd.DataFrame({'up': up, 'down': down},
+                      index=pd.MultiIndex.from_arrays([times, nanopis], names=['datetime', 'nanopi']))
+    return df.groupby(level=['datetime', 'nanopi'], sort=True).sum().astype(np.int64)
+
+
+def hourly_counts(df):
+    """Counts the up and down pings of each NanoPi in each hour.
+
+    Returns a dataframe indexed by (datetime, nanopi), where datetime is the start of the hour,
+    with the columns 'up' and 'down'. Hours without pings are left out.
+
+    Arguments:
+    df - a dataframe of pings, as produced by common.get_ping_dataframe(...) or archive.Archive('ping')
+    """
+    with instrument.stage('rollup.hourly', rows_in=len(df)) as stage:
+        times = df.index.get_level_values('datetime')
+        state = df.loc[:, 'state'].values
+        down = (state == 'down').astype(np.int64)
+        up = (state == 'up').astype(np.int64)
+        counts = _group(times.floor('H'), df.index.get_level_values('nanopi').astype(np.int64), up, down,
+                        times.tz or common.TIMEZONE)
+        stage['rows_out'] = len(counts)
+    return counts
+
+
+def daily_counts(hourly, tz=None):
+    """Adds up hourly counts into daily ones.
+
+    Arguments:
+    hourly - a dataframe returned by hourly_counts(...) or Rollup.hourly(...)
+    tz - the timezone whose midnights divide the days; defaults to common.TIMEZONE
+    """
+    tz = tz or common.TIMEZONE
+    times = hourly.index.get_level_values('datetime')
+    days = times.tz_convert(tz).floor('D') if times.tz is not None else times.floor('D')
+    return _group(days, hourly.index.get_level_values('nanopi'), hourly.loc[:, 'up'].values,
+                  hourly.loc[:, 'down'].values, tz)
+
+
+def counts(df):
+    """Returns hourly counts for a dataframe that is either raw pings or hourly counts already.
+
+    Arguments:
+    df - a dataframe of pings (with a 'state' column) or of counts (with 'up' and 'down' columns)
+    """
+    if 'down' in df.columns:
+        return df
+    return hourly_counts(df)
+
+
+def sqlite_counts(conn, after_id=None, table=SQLITE_TABLE):
+    """Counts pings per hour in the API's SQLite database, which does the counting itself.
+
+    Returns a tuple of (counts, last_id), where counts is a dataframe like the one returned
+    by hourly_counts(...) and last_id is the ID of the newest ping counted (or after_id if there are none).
+
+    Arguments:
+    conn - a sqlite3 connection, e.g. sqlite3.connect('db.sqlite3')
+    after_id - only count pings with an ID greater than this; None counts all of them
+    table - the name of the table of pings
+    """
+    # times are stored in UTC as 'YYYY-MM-DD HH:MM:SS', so the first 13 characters are the hour
+    query = ('select nanopi_id, substr(time, 1, 13) as hour, '
+             'sum(state = "up") as up, sum(state = "down") as down, max(id) as last_id '
+             'from {} where id > ? group by nanopi_id, hour'.format(table))
+    with instrument.stage('rollup.sqlite') as stage:
+        rows = pd.read_sql_query(query, conn, params=(after_id if after_id is not None else -1,))
+        stage['rows_out'] = len(rows)
+    if not len(rows):
+        return _empty(), after_id
+    times = pd.to_datetime(rows.loc[:, 'hour'], format='%Y-%m-%d %H').dt.tz_localize('UTC').dt.tz_convert(
+        common.TIMEZONE)
+    hourly = _group(pd.DatetimeIndex(times), rows.loc[:, 'nanopi_id'].values.astype(np.int64),
+                    rows.loc[:, 'up'].values, rows.loc[:, 'down'].values, common.TIMEZONE)
+    return hourly, int(rows.loc[:, 'last_id'].max())
+
+
+def _to_records(df):
+    records = np.empty(len(df), dtype=RECORD_DTYPE)
+    records['time'] = df.index.get_level_values('datetime').asi8
+    records['nanopi'] = df.index.get_level_values('nanopi')
+    records['up'] = df.loc[:, 'up'].values
+    records['down'] = df.loc[:, 'down'].values
+    return records
+
+
+def _from_records(records, tz):
+    times = pd.DatetimeIndex(records['time'].astype('datetime64[ns]')).tz_localize('UTC').tz_convert(tz)
+    index = pd.MultiIndex.from_arrays([times, records['nanopi'].astype(np.int64)], names=['datetime', 'nanopi'])
+    return pd.DataFrame({'up': np.array(records['up']), 'down': np.array(records['down'])}, index=index)
+
+
+class Rollup:
+    """The hourly and daily ping counts kept in a directory.
+
+    Arguments:
+    directory - the directory the counts are kept in; they are empty if it doesn't have any yet
+    """
+
+    def __init__(self, directory=ROLLUP_DIR):
+        self.directory = directory
+        hourly_path, daily_path, meta_path = _paths(directory)
+        try:
+            with open(meta_path, 'rt') as file:
+                self.meta = json.load(file)
+            self._hourly = _from_records(np.load(hourly_path), self.meta['tz'])
+            self._daily = _from_records(np.load(daily_path), self.meta['tz'])
+        except (OSError, ValueError):
+            self.meta = {'tz': common.TIMEZONE, 'last_id': None, 'id_source': None, 'sources': []}
+            self._hourly = _empty()
+            self._daily = _empty()
+
+    def __len__(self):
+        return len(self._hourly)
+
+    @property
+    def last_id(self):
+        """The ID of the newest ping counted, or None."""
+        return self.meta['last_id']
+
+    @property
+    def id_source(self):
+        """Where the pings up to last_id were counted from: 'api', 'sqlite' or None."""
+        if 'id_source' not in self.meta and self.last_id is not None:
+            # counts saved before id_source was kept
+            return 'sqlite' if 'sqlite' in self.meta['sources'] else 'api'
+        return self.meta.get('id_source')
+
+    def _select(self, df, start, end, nanopis):
+        if start is not None or end is not None:
+            df = df.loc[(slice(start, end), slice(None)), :]
+        if nanopis is not None:
+            df = df.loc[df.index.get_level_values('nanopi').isin(nanopis)]
+        return df
+
+    def hourly(self, start=None, end=None, nanopis=None):
+        """Returns the hourly counts as a dataframe indexed by (datetime, nanopi) with the columns 'up' and 'down'.
+
+        Arguments:
+        start - the first hour to include, e.g. '2018-05-30'; None for the first one counted
+        end - the last hour to include; None for the last one counted
+        nanopis - a list of NanoPi IDs to include, or None for all of them
+        """
+        return self._select(self._hourly, start, end, nanopis)
+
+    def daily(self, start=None, end=None, nanopis=None):
+        """Returns the daily counts; see hourly(...)."""
+        return self._select(self._daily, start, end, nanopis)
+
+    def _merge(self, hourly, replace):
+        hourly = hourly.copy()
+        hourly.index = hourly.index.set_levels(hourly.index.levels[0].tz_convert(self.meta['tz']), level='datetime')
+        if replace or not len(self._hourly):
+            merged = hourly
+        else:
+            merged = pd.concat([self._hourly, hourly]).groupby(level=['datetime', 'nanopi'], sort=True).sum()
+        self._hourly = merged.astype(np.int64)
+        self._daily = daily_counts(self._hourly, self.meta['tz'])
+
+    def update(self, df, source='dataframe'):
+        """Adds the pings of a dataframe that haven't been counted yet.
+
+        Pings are told apart by their 'id' column. A dataframe without one (such as one
+        read from an archive) replaces all the counts instead.
+
+        Arguments:
+        df - a dataframe of pings, as produced by common.get_ping_dataframe(...) or archive.Archive('ping')
+        source - a description of where the pings came from, kept in the metadata
+        """
+        with instrument.stage('rollup.update', rows_in=len(df)) as stage:
+            if 'id' in df.columns:
+                if self.id_source == 'sqlite':
+                    # the API only gives failed pings, so the successes counted from SQLite after
+                    # last_id would be missing, and the failures counted twice
+                    raise ValueError("the counts in {} are kept from the SQLite database; keep updating them "
+                                     "from it, or remove the directory to count pings from the API".format(
+                                         self.directory))
+                ids = df.loc[:, 'id'].values
+                if self.last_id is not None:
+                    df = df.loc[ids > self.last_id]
+                    ids = df.loc[:, 'id'].values
+                if len(df):
+                    self._merge(hourly_counts(df), replace=False)
+                    self.meta['last_id'] = int(np.nanmax(ids))
+                    self.meta['id_source'] = 'api'
+            else:
+                self._merge(hourly_counts(df), replace=True)
+                self.meta['last_id'] = None
+                self.meta['id_source'] = None
+                self.meta['sources'] = []
+            stage['rows_out'] = len(df)
+        self._note(source)
+
+    def update_from_sqlite(self, conn, table=SQLITE_TABLE):
+        """Adds the pings in the API's SQLite database that haven't been counted yet.
+
+        Counts kept from anywhere else are counted again from the database, which has every ping:
+        the API only gives failed ones, so counting on from its last_id would miss the successes.
+
+        Arguments:
+        conn - a sqlite3 connection, e.g. sqlite3.connect('db.sqlite3')
+        table - the name of the table of pings
+        """
+        rebuild = self.id_source != 'sqlite' and len(self._hourly) > 0
+        if rebuild:
+            print("Counting every ping in the SQLite database again, since the counts came from {}".format(
+                ', '.join(self.meta['sources']) or 'elsewhere'))
+            self.meta['sources'] = []
+        hourly, last_id = sqlite_counts(conn, None if rebuild else self.last_id, table)
+        if len(hourly) or rebuild:
+            self._merge(hourly, replace=rebuild)
+            self.meta['last_id'] = last_id
+            self.meta['id_source'] = 'sqlite'
+        self._note('sqlite')
+
+    def _note(self, source):
+        if source not in self.meta['sources']:
+            self.meta['sources'].append(source)
+
+    def save(self):
+        """Writes the counts to the directory, replacing the files atomically."""
+        os.makedirs(self.directory, exist_ok=True)
+        hourly_path, daily_path, meta_path = _paths(self.directory)
+        for path, df in [(hourly_path, self._hourly), (daily_path, self._daily)]:
+            temporary_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+            np.save(temporary_path, _to_records(df))
+            os.replace(temporary_path, path)
+        temporary_path = '{}.{}.tmp'.format(meta_path, os.getpid())
+        with open(temporary_path, 'wt') as file:
+            json.dump(dict(self.meta, hours=len(self._hourly)), file)
+        os.replace(temporary_path, meta_path)
+
+
+def load(directory=ROLLUP_DIR, archive_dir=None):
+    """Returns the hourly ping counts, building them from the ping archive if they haven't been built yet.
+
+    Arguments:
+    directory - the directory the counts are kept in
+    archive_dir - the archive directory to build them from; defaults to archive.ARCHIVE_DIR
+    """
+    rollup = Rollup(directory)
+    if not len(rollup):
+        import archive
+        path = archive_dir or archive.ARCHIVE_DIR
+        if os.path.exists(os.path.join(path, 'ping.json')):
+            rollup.update(archive.Archive('ping', path).to_dataframe(), source='archive')
+            rollup.save()
+    return rollup
+
+
+def outages(df, min_down=1):
+    """Returns the outages of each NanoPi: runs of consecutive hours in which pings failed.
+
+    Returns a dataframe with a row per outage and the columns 'nanopi', 'start', 'end'
+    (the start of the last hour), 'hours' and 'down' (the number of failed pings).
+
+    Arguments:
+    df - a dataframe of pings or of hourly counts; see counts(...)
+    min_down - the fewest failed pings for an hour to count as part of an outage
+    """
+    hourly = counts(df)
+    failed = hourly.loc[hourly.loc[:, 'down'] >= min_down]
+    columns = ['nanopi', 'start', 'end', 'hours', 'down']
+    if not len(failed):
+        return pd.DataFrame(columns=columns)
+    table = failed.reset_index().sort_values(['nanopi', 'datetime'], kind='stable')
+    new_nanopi = (table.loc[:, 'nanopi'] != table.loc[:, 'nanopi'].shift()).values
+    gap = (table.loc[:, 'datetime'].diff() != pd.Timedelta('1H')).values
+    table.loc[:, 'outage'] = np.cumsum(new_nanopi | gap)
+    result = table.groupby('outage').agg(nanopi=('nanopi', 'first'), start=('datetime', 'min'),
+                                         end=('datetime', 'max'), hours=('datetime', 'size'), down=('down', 'sum'))
+    return result.sort_values(['start', 'nanopi']).reset_index(drop=True).loc[:, columns]
+
+
+def outage_stats(df, min_down=1):
+    """Summarizes the outages of each NanoPi.
+
+    Returns a dataframe indexed by nanopi with the columns 'outages', 'hours' (in outages),
+    'longest' (hours), 'down' (failed pings) and 'availability' (the fraction of pings that
+    succeeded, or NaN if only failed pings were counted).
+
+    Arguments:
+    df - a dataframe of pings or of hourly counts; see counts(...)
+    min_down - the fewest failed pings for an hour to count as part of an outage
+    """
+    hourly = counts(df)
+    table = outages(hourly, min_down)
+    totals = hourly.groupby(level='nanopi').sum()
+    stats = pd.DataFrame(index=totals.index.rename('nanopi'))
+    grouped = table.groupby('nanopi')
+    stats.loc[:, 'outages'] = grouped.size().reindex(stats.index, fill_value=0)
+    stats.loc[:, 'hours'] = grouped['hours'].sum().reindex(stats.index, fill_value=0)
+    stats.loc[:, 'longest'] = grouped['hours'].max().reindex(stats.index, fill_value=0)
+    stats.loc[:, 'down'] = totals.loc[:, 'down']
+    pings = totals.loc[:, 'up'] + totals.loc[:, 'down']
+    # pings are usually fetched with state=down, in which case there are no successes to compare with
+    stats.loc[:, 'availability'] = (totals.loc[:, 'up'] / pings).where(totals.loc[:, 'up'] > 0)
+    return stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Updates the hourly and daily ping counts and prints outage statistics.")
+    parser.add_argument('-d', dest='directory', default=ROLLUP_DIR, help="rollup directory (default: {})".format(ROLLUP_DIR))
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--sqlite', help="count the pings in the API's SQLite database at this path")
+    source.add_argument('--archive', help="rebuild the counts from the ping archive in this directory")
+    source.add_argument('--api', action='store_true', help="count the pings fetched from the API")
+    args = parser.parse_args()
+
+    rollup = Rollup(args.directory)
+    if args.sqlite:
+        conn = sqlite3.connect(args.sqlite)
+        rollup.update_from_sqlite(conn)
+        conn.close()
+    elif args.archive:
+        import archive
+        rollup.update(archive.Archive('ping', args.archive).to_dataframe(), source='archive')
+    elif args.api:
+        rollup.update(common.get_ping_dataframe(common.get_auth()), source='api')
+    else:
+        rollup = load(args.directory)
+    rollup.save()
+
+    print("{} hours counted".format(len(rollup)))
+    print(outage_stats(rollup.hourly()).to_string())
+    instrument.summary()
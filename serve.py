@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# Long-running service that keeps the data in memory and renders plots on demand.
+#
+# Data is loaded from the API once at startup and then refreshed on a timer.
+# Rendered plots are kept in memory until the data they were made from changes,
+# so asking for the same plot again (e.g. on a dashboard refresh) costs next to nothing.
+#
+# Endpoints:
+#   /                                   JSON list of available plots
+#   /status                             JSON with the rows, version and refresh time of each metric
+#   /plot/<metric>/<type>.svg           a plot, e.g. /plot/jitter/24h.svg
+#   /plot/<metric>/<type>/<up|down>.svg one of the two plots that bandwidth functions produce
+#
+# Query parameters (start, end, nanopis=11,12) limit the data that is plotted; ones that can't be
+# read as times or NanoPi IDs get a 400 response.
+#
+# The API and credentials are those of the site chosen with --site (see config.py); credentials
+# missing from the configuration are asked for once at startup. Run one service per site.
+
+import argparse
+import importlib
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+import socketserver
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import pandas as pd
+import matplotlib.pyplot as plt
+
+import common
+import config
+import memo
+import query
+import plot_data
+import nanopi_registry
+
+
+METRICS = OrderedDict([
+    ('bandwidth', (common.get_bandwidth_dataframe, ['up', 'down'])),
+    ('jitter', (common.get_jitter_dataframe, None)),
+    ('latency', (common.get_latency_dataframe, None)),
+    ('ping', (common.get_ping_dataframe, None)),
+])
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def plot_functions(metric):
+    """Returns a dict where the keys are plot types (e.g. '24h') and the values are plotting functions."""
+    module = importlib.import_module(metric)
+    return {name[len('plot_'):]: getattr(module, name) for name in dir(module)
+            if name.startswith('plot_') and callable(getattr(module, name))}
+
+
+def merge_dataframes(old, new, metric):
+    """Adds newly fetched rows to a dataframe, keeping the newest copy of duplicated rows.
+
+    Arguments:
+    old - the dataframe currently held
+    new - a dataframe produced by the same loader, with only newer data
+    metric - the name of the metric the dataframes hold
+    """
+    if old is None or not len(old):
+        return new
+    if not len(new):
+        return old
+    if metric == 'ping':
+        df = pd.concat([old, new])
+        return df.loc[~df.loc[:, 'id'].duplicated(keep='last'), :].sort_index()
+    _, directions = METRICS[metric]
+    df = pd.concat([old.dropna(subset=['id']), new.dropna(subset=['id'])])
+    df = df.loc[~df.index.duplicated(keep='last'), :].sort_index()
+    return common.reindex_hourly(df, directions=directions)
+
+
+class PlotService:
+    """Holds the latest data of every metric and renders plots from it.
+
+    Arguments:
+    auth - the requests auth object; see requests docs
+    metrics - the names of the metrics to keep loaded
+    since_param - the name of a URL parameter that limits API results to those uploaded
+                  at or after a given time (e.g. 'upload_date__gte'); if given, refreshes
+                  only fetch new data, otherwise they fetch everything again
+    cache_size - the number of rendered plots to keep in memory
+    """
+
+    def __init__(self, auth, metrics=None, since_param=None, cache_size=256):
+        self.auth = auth
+        self.metrics = list(metrics or METRICS)
+        self.since_param = since_param
+        self.cache_size = cache_size
+        self.frames = {}
+        self.versions = {metric: 0 for metric in self.metrics}
+        self.refreshed = {}
+        self.watermarks = {}
+        self.nanopi_names = nanopi_registry.Registry()
+        self.rendered = OrderedDict()
+        self.functions = {metric: plot_functions(metric) for metric in self.metrics}
+        self._data_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        # matplotlib's pyplot interface is not thread-safe, so plots are rendered one at a time
+        self._render_lock = threading.Lock()
+
+    def refresh(self):
+        """Fetches new data for every metric from the API."""
+        self.nanopi_names.update(common.get_nanopi_list(self.auth))
+        for metric in self.metrics:
+            get_dataframe, _ = METRICS[metric]
+            old = self.frames.get(metric)
+            if self.since_param and old is not None and len(old):
+                params = {self.since_param: old.loc[:, 'upload_date'].max().isoformat()}
+                if metric == 'ping':
+                    params['state'] = 'down'
+                # the loaders can't build a dataframe from no results, so ask how many there are first
+                if memo.api_count(metric, self.auth, params) == 0:
+                    new = old.iloc[:0]
+                else:
+                    new = get_dataframe(self.auth, params)
+                    # a filter such as upload_date__gte fetches the newest rows held again; they aren't new
+                    since = old.loc[:, 'upload_date'].max()
+                    held = new.loc[:, 'id'].isin(old.loc[:, 'id']) & (new.loc[:, 'upload_date'] <= since)
+                    new = new.loc[new.loc[:, 'id'].notna() & ~held, :]
+                # the same dataframe, and so the same version, unless there are new rows
+                df = merge_dataframes(old, new, metric)
+            else:
+                # kept in memory, so a refresh when nothing has changed costs a request or two and keeps the dataframe
+                watermark = memo.api_watermark(metric, self.auth, memo.DEFAULT_PARAMS.get(metric))
+                if old is not None and watermark == self.watermarks.get(metric):
+                    df = old
+                else:
+                    df = memo.load(metric, self.auth, watermark=watermark, directory=None)
+                    self.watermarks[metric] = watermark
+            with self._data_lock:
+                if df is not old:
+                    self.frames[metric] = df
+                    self.versions[metric] += 1
+                self.refreshed[metric] = time.time()
+
+    def status(self):
+        """Returns a dict describing the data currently held."""
+        with self._data_lock:
+            return {metric: {'rows': len(self.frames[metric]) if metric in self.frames else 0,
+                             'version': self.versions[metric],
+                             'refreshed': self.refreshed.get(metric)}
+                    for metric in self.metrics}
+
+    def render(self, metric, plot_type, variant=None, start=None, end=None, nanopis=None):
+        """Returns a rendered plot as SVG bytes, from memory if the data hasn't changed since it was last rendered.
+
+        Arguments:
+        metric - e.g. 'bandwidth'
+        plot_type - the name of the plotting function without 'plot_', e.g. '24h'
+        variant - 'up' or 'down' for plotting functions that produce a pair of plots
+        start - the first time to include, or None
+        end - the last time to include, or None
+        nanopis - a list of NanoPi IDs to include, or None for all of them
+        """
+        func = self.functions[metric][plot_type]
+        with self._data_lock:
+            df = self.frames[metric]
+            version = self.versions[metric]
+        names = tuple(sorted(self.nanopi_names.items()))
+        key = (metric, plot_type, variant, start, end, tuple(nanopis) if nanopis else None, version, names)
+        with self._cache_lock:
+            if key in self.rendered:
+                self.rendered.move_to_end(key)
+                return self.rendered[key]
+
+        if start or end or nanopis:
+            df = query.select(df, start=start, end=end, nanopis=nanopis)
+        kwargs = {}
+        if 'nanopi_names' in inspect.signature(func).parameters:
+            kwargs['nanopi_names'] = self.nanopi_names
+        with self._render_lock, tempfile.TemporaryDirectory() as directory:
+            # an absolute path, since changing the current directory would change it for every thread
+            plot_name = os.path.join(directory, 'plot.svg')
+            try:
+                func(df, plot_name=plot_name, **kwargs)
+            finally:
+                # the plotting functions leave their figures open, which would pile up in a long-running process
+                plt.close('all')
+            with open(plot_name if variant is None else plot_data.prefixed(variant + '_', plot_name), 'rb') as file:
+                content = file.read()
+
+        with self._cache_lock:
+            self.rendered[key] = content
+            while len(self.rendered) > self.cache_size:
+                self.rendered.popitem(last=False)
+        return content
+
+    def start_refreshing(self, interval):
+        """Refreshes the data every interval seconds in a background thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print("Refresh failed: {}".format(e))
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, host='127.0.0.1', port=8000):
+        """Serves plots over HTTP until interrupted."""
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                service._handle(self)
+
+        server = _ThreadingHTTPServer((host, port), Handler)
+        print("Serving plots at http://{}:{}/".format(host, server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+
+    def _handle(self, request):
+        parts = urlsplit(request.path)
+        path = [part for part in parts.path.split('/') if part]
+        params = dict(parse_qsl(parts.query))
+
+        if not path:
+            body = {metric: sorted(functions) for metric, functions in self.functions.items()}
+            return self._send(request, json.dumps(body).encode(), 'application/json')
+        if path == ['status']:
+            return self._send(request, json.dumps(self.status()).encode(), 'application/json')
+        if path[0] != 'plot' or len(path) not in (3, 4) or not path[-1].endswith('.svg'):
+            return request.send_error(404)
+
+        path[-1] = path[-1][:-len('.svg')]
+        metric, plot_type = path[1], path[2]
+        variant = path[3] if len(path) == 4 else None
+        if metric not in self.frames or plot_type not in self.functions.get(metric, {}):
+            return request.send_error(404)
+        if variant not in (None, 'up', 'down'):
+            return request.send_error(404)
+        nanopis = params.get('nanopis')
+        try:
+            nanopis = [int(nanopi) for nanopi in nanopis.split(',')] if nanopis else None
+            for name in ('start', 'end'):
+                if params.get(name):
+                    pd.Timestamp(params[name])
+        except ValueError as e:
+            return request.send_error(400, explain=str(e))
+        try:
+            content = self.render(metric, plot_type, variant, params.get('start'), params.get('end'), nanopis)
+        except FileNotFoundError:
+            # e.g. asked for /up.svg of a plot that only produces one file
+            return request.send_error(404)
+        self._send(request, content, 'image/svg+xml')
+
+    @staticmethod
+    def _send(request, content, content_type):
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Keeps living-lab data in memory and serves plots over HTTP.")
+    parser.add_argument('metrics', nargs='*', default=list(METRICS), help="metrics to serve")
+    parser.add_argument('-p', dest='port', default=8000, type=int, help="port to listen on")
+    parser.add_argument('-i', dest='interval', default=3600, type=int, help="seconds between refreshes")
+    parser.add_argument('--since-param', dest='since_param', default=None,
+                        help="API filter for rows uploaded at or after a time, e.g. upload_date__gte; "
+                             "makes refreshes incremental")
+    parser.add_argument('--config', dest='config', default=None, help="configuration file (default: LLV_CONFIG or llv.ini)")
+    parser.add_argument('--site', dest='site', default=None, help="site to serve (default: LLV_SITE, or the only site)")
+    args = parser.parse_args()
+
+    site = config.get(args.site, args.config).apply()
+    auth = site.auth()
+
+    service = PlotService(auth, args.metrics, since_param=args.since_param)
+    service.refresh()
+    service.start_refreshing(args.interval)
+    service.serve(port=args.port)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Generates synthetic living-lab data that looks like what the API returns,
+# so that the loaders and plots can be exercised without the real API.
+# The data has the same quirks as the real thing: tests that were missed,
+# tests that were uploaded twice, and outages where a NanoPi goes quiet
+# and its pings fail.
+
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+LOCATIONS = ['Demetrios', 'Library', 'Town Office', 'School', 'Clinic', 'Arena',
+             'Church', 'Store', 'Band Office', 'Fire Hall', 'Hotel', 'Airport']
+
+
+def _isoformat(times):
+    """Formats a DatetimeIndex the way the API does (UTC, microseconds, trailing Z)."""
+    return list(times.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+
+
+def _test_times(rng, nanopi_ids, hours, outages, gap_rate, duplicate_rate):
+    """Picks the upload times of one hourly test for every NanoPi.
+
+    Returns a tuple of (times, nanopis) arrays, sorted by time.
+    Missed tests and outages are left out, and some tests are repeated
+    (within the same hour) to imitate duplicate uploads.
+    """
+    n_hours = len(hours)
+    nanopis = np.repeat(nanopi_ids, n_hours)
+    hour_index = np.tile(np.arange(n_hours), len(nanopi_ids))
+    keep = (rng.random_sample(len(nanopis)) >= gap_rate) & ~outages.ravel()
+    nanopis = nanopis[keep]
+    hour_index = hour_index[keep]
+    duplicated = rng.random_sample(len(nanopis)) < duplicate_rate
+    nanopis = np.concatenate([nanopis, nanopis[duplicated]])
+    hour_index = np.concatenate([hour_index, hour_index[duplicated]])
+    offsets = pd.to_timedelta(rng.randint(0, 3600, len(nanopis)), unit='s')
+    times = hours[hour_index] + offsets
+    order = np.argsort(times.values, kind='mergesort')
+    return times[order], nanopis[order]
+
+
+def _outages(rng, n_nanopis, n_hours, outage_rate, mean_outage_hours):
+    """Returns a boolean (nanopi, hour) array that is True while a NanoPi is out."""
+    out = np.zeros((n_nanopis, n_hours), dtype=bool)
+    starts = rng.random_sample((n_nanopis, n_hours)) < outage_rate
+    for row, column in zip(*np.nonzero(starts)):
+        length = 1 + rng.poisson(mean_outage_hours)
+        out[row, column:column + length] = True
+    return out
+
+
+def generate(nanopis=10, days=30, start='2018-05-01', seed=0, gap_rate=0.02,
+             duplicate_rate=0.01, outage_rate=0.002, mean_outage_hours=6, pings_per_hour=6):
+    """Generates synthetic data for every API endpoint.
+
+    Returns a dict where the keys are endpoint names ('nanopi', 'iperf3', 'jitter',
+    'sockperf' and 'ping') and the values are lists of records shaped like the
+    ones the API returns, sorted by upload date.
+
+    Arguments:
+    nanopis - the number of NanoPis
+    days - the number of days of data
+    start - the date of the first test
+    seed - the seed of the random number generator, so that the same data can be reproduced
+    gap_rate - the fraction of tests that are missed
+    duplicate_rate - the fraction of tests that are uploaded twice
+    outage_rate - the chance that a NanoPi goes out in any given hour
+    mean_outage_hours - the average length of an outage in hours
+    pings_per_hour - the number of pings each NanoPi sends per hour
+    """
+    rng = np.random.RandomState(seed)
+    nanopi_ids = np.arange(1, nanopis + 1)
+    hours = pd.date_range(start, periods=days * 24, freq='H', tz='UTC')
+    outages = _outages(rng, nanopis, len(hours), outage_rate, mean_outage_hours)
+    data = {}
+
+    data['nanopi'] = [{'id': int(nanopi_id),
+                       'location_info': '{} {}'.format(LOCATIONS[i % len(LOCATIONS)], i // len(LOCATIONS) + 1)
+                                        if i >= len(LOCATIONS) else LOCATIONS[i]}
+                      for i, nanopi_id in enumerate(nanopi_ids)]
+
+    # every NanoPi has its own typical values, and all of them are worse in the evening
+    base_down = rng.lognormal(np.log(20), 0.5, nanopis + 1)
+    base_up = base_down * rng.uniform(0.1, 0.5, nanopis + 1)
+    base_jitter = rng.lognormal(np.log(3), 0.4, nanopis + 1)
+    base_latency = rng.lognormal(np.log(40000), 0.3, nanopis + 1)
+
+    def evening(times):
+        return 1 + 0.4 * np.exp(-((times.hour.values - 20) ** 2) / 8.0)
+
+    # bandwidth has one up and one down test per hour
+    records = []
+    for direction, base in (('up', base_up), ('down', base_down)):
+        times, ids = _test_times(rng, nanopi_ids, hours, outages, gap_rate, duplicate_rate)
+        values = base[ids] / evening(times) * rng.lognormal(0, 0.2, len(ids))
+        records.append(pd.DataFrame({'nanopi': ids, 'direction': direction,
+                                     'bandwidth': values.round(3), 'upload_date': times}))
+    iperf3 = pd.concat(records).sort_values('upload_date', kind='mergesort')
+    data['iperf3'] = _to_records(iperf3, ['nanopi', 'direction', 'bandwidth'])
+
+    times, ids = _test_times(rng, nanopi_ids, hours, outages, gap_rate, duplicate_rate)
+    values = base_jitter[ids] * evening(times) * rng.lognormal(0, 0.3, len(ids))
+    jitter = pd.DataFrame({'nanopi': ids, 'jitter': values.round(3), 'upload_date': times})
+    data['jitter'] = _to_records(jitter, ['nanopi', 'jitter'])
+
+    times, ids = _test_times(rng, nanopi_ids, hours, outages, gap_rate, duplicate_rate)
+    values = base_latency[ids] * evening(times) * rng.lognormal(0, 0.2, len(ids))
+    sockperf = pd.DataFrame({'nanopi': ids, 'latency': values.round(0), 'upload_date': times})
+    data['sockperf'] = _to_records(sockperf, ['nanopi', 'latency'])
+
+    # pings are evenly spaced, fail during outages and occasionally fail otherwise
+    n_pings = len(hours) * pings_per_hour
+    ping_times = pd.date_range(start, periods=n_pings, freq='{}S'.format(3600 // pings_per_hour), tz='UTC')
+    ids = np.repeat(nanopi_ids, n_pings)
+    times = ping_times[np.tile(np.arange(n_pings), nanopis)]
+    down = np.repeat(outages, pings_per_hour, axis=1).ravel()
+    down |= rng.random_sample(len(ids)) < 0.005
+    ping = pd.DataFrame({'nanopi': ids, 'state': np.where(down, 'down', 'up'),
+                         'time': times,
+                         'upload_date': times + pd.to_timedelta(rng.randint(0, 600, len(ids)), unit='s')})
+    ping = ping.sort_values('time', kind='mergesort')
+    ping = ping.assign(time=_isoformat(pd.DatetimeIndex(ping.loc[:, 'time'])))
+    data['ping'] = _to_records(ping, ['nanopi', 'state', 'time'])
+
+    return data
+
+
+def _to_records(df, columns):
+    """Turns a dataframe with an 'upload_date' column into a list of API-shaped records."""
+    df = df.reset_index(drop=True)
+    df.insert(0, 'id', np.arange(1, len(df) + 1))
+    df = df.assign(upload_date=_isoformat(pd.DatetimeIndex(df.loc[:, 'upload_date'])),
+                   nanopi=df.loc[:, 'nanopi'].astype(int))
+    return df.loc[:, ['id', *columns, 'upload_date']].to_dict(orient='records')
+
+
+def _link(url, page):
+    if url is None:
+        return page
+    separator = '&' if '?' in url else '?'
+    return '{}{}page={}'.format(url, separator, page)
+
+
+def page(records, number, page_size=100, url=None):
+    """Returns one page of records, shaped like a paginated API response.
+
+    The page is a dict with 'count', 'next', 'previous' and 'results' keys.
+
+    Arguments:
+    records - a list of records, as produced by generate(...)
+    number - the number of the page, starting at 1
+    page_size - the number of records per page
+    url - the URL that 'next' and 'previous' are built from; if None they are page numbers
+    """
+    first = (number - 1) * page_size
+    return {'count': len(records),
+            'next': _link(url, number + 1) if first + page_size < len(records) else None,
+            'previous': _link(url, number - 1) if number > 1 else None,
+            'results': records[first:first + page_size]}
+
+
+def pages(records, page_size=100, url=None):
+    """Yields every page of records in turn; see page(...)."""
+    n_pages = max(1, -(-len(records) // page_size))
+    for number in range(1, n_pages + 1):
+        yield page(records, number, page_size, url)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Writes synthetic API data to JSON files.")
+    parser.add_argument('-n', dest='nanopis', default=10, type=int, help="number of NanoPis")
+    parser.add_argument('-d', dest='days', default=30, type=int, help="number of days")
+    parser.add_argument('-s', dest='seed', default=0, type=int, help="random seed")
+    parser.add_argument('-o', dest='output', default='data/synthetic', help="output directory")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    data = generate(nanopis=args.nanopis, days=args.days, seed=args.seed)
+    for endpoint, records in data.items():
+        print("Writing {} {} records...".format(len(records), endpoint))
+        with open(os.path.join(args.output, '{}.json'.format(endpoint)), 'wt') as file:
+            json.dump(records, file)
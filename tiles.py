@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Writes multi-resolution tiles of each metric for the zoomable viewer in viewer.html.
+#
+# Each metric is aggregated per NanoPi (and direction) at three levels of detail:
+#
+#   hour   one value per hour, in tiles of a week
+#   day    one value per day, in tiles of 52 weeks
+#   week   one value per week (starting on Monday), in tiles of 520 weeks
+#
+# Every value comes with the minimum, maximum and number of measurements it was made from,
+# so the viewer can draw the spread and show the hours, days or weeks without data.
+# Tiles are small JSON files at <output>/<metric>/<series>/<level>/<tile start>.json, listed
+# in <output>/index.json. The viewer only fetches the tiles of the level of detail that fits
+# the zoom and the time range on screen, so browsing years of data stays quick.
+#
+#     ./tiles.py -d data -o tiles --serve 8002
+#
+# builds tiles from the archives written by ./cli.py fetch and serves the viewer at
+# http://localhost:8002/viewer.html. Tiles whose contents haven't changed aren't rewritten.
+
+import os
+import json
+import math
+import time
+import shutil
+import argparse
+import functools
+import http.server
+import numpy as np
+import pandas as pd
+
+import common
+import rollup
+import nanopi_registry
+
+
+TILES_DIR = 'tiles'
+
+VIEWER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer.html')
+
+WEEK = 7 * 24 * 3600 * 1000
+
+# (name, length of a bucket in milliseconds, length of a tile in milliseconds)
+LEVELS = [
+    ('hour', 3600 * 1000, WEEK),
+    ('day', 24 * 3600 * 1000, 52 * WEEK),
+    ('week', WEEK, 520 * WEEK),
+]
+
+# the column plotted for each metric, how it is aggregated and its axis label
+METRICS = {
+    'bandwidth': ('bandwidth', 'mean', 'Bandwidth (Mbit/s)'),
+    'jitter': ('jitter', 'mean', 'Jitter (ms)'),
+    'latency': ('latency', 'mean', 'Latency (ms)'),
+    'ping': ('down', 'sum', 'Failed Ping Count'),
+}
+
+
+def _series(df, metric):
+    # returns the times, series keys (e.g. '11' or '11-up') and values of a metric's dataframe
+    column = METRICS[metric][0]
+    if metric == 'ping':
+        df = rollup.counts(df)
+    values = df.loc[:, column]
+    keys = values.index.get_level_values('nanopi').astype(str)
+    if 'direction' in values.index.names:
+        keys = keys + '-' + values.index.get_level_values('direction').astype(str)
+    return values.index.get_level_values('datetime'), np.asarray(keys), values.values.astype(float)
+
+
+def buckets(times, level, tz=None):
+    """Returns the start of the hour, day or week each time falls in, in milliseconds since the epoch.
+
+    Days and weeks start at midnight in the given timezone.
+
+    Arguments:
+    times - a pandas DatetimeIndex
+    level - 'hour', 'day' or 'week'
+    tz - the timezone of times without one, and whose midnights divide days; defaults to common.TIMEZONE
+    """
+    tz = tz or common.TIMEZONE
+    if times.tz is None:
+        times = times.tz_localize(tz, ambiguous='NaT', nonexistent='shift_forward')
+    if level == 'hour':
+        starts = times.tz_convert('UTC').floor('H')
+    else:
+        days = times.tz_convert(tz).tz_localize(None).normalize()
+        if level == 'week':
+            days = days - pd.to_timedelta(days.dayofweek, unit='D')
+        starts = days.tz_localize(tz, ambiguous=True, nonexistent='shift_forward')
+    return starts.asi8 // 10 ** 6
+
+
+def aggregate(df, metric, level, tz=None):
+    """Aggregates a metric at one level of detail.
+
+    Returns a dataframe indexed by (series, start) with the columns 'value' (the mean, or for
+    ping the total number of failed pings), 'min', 'max' and 'count' (the number of measurements).
+    Buckets whose measurements are all missing are kept, with a count of 0.
+
+    Arguments:
+    df - a dataframe from common.get_XX_dataframe(...) or an archive; for ping, also hourly counts from rollup.py
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    level - 'hour', 'day' or 'week'
+    tz - the timezone whose midnights divide days
+    """
+    times, keys, values = _series(df, metric)
+    table = pd.DataFrame({'series': keys, 'start': buckets(times, level, tz), 'value': values})
+    result = table.groupby(['series', 'start'], sort=True)['value'].agg([METRICS[metric][1], 'min', 'max', 'count'])
+    result.columns = ['value', 'min', 'max', 'count']
+    if METRICS[metric][1] == 'sum':
+        # a sum of nothing is missing rather than 0
+        result.loc[result.loc[:, 'count'] == 0, 'value'] = np.nan
+    return result
+
+
+def _list(values, digits):
+    # JSON has no NaN, so missing values become null
+    return [None if math.isnan(value) else round(value, digits) for value in values.tolist()]
+
+
+def _write_if_changed(path, content):
+    # returns whether the file was written
+    try:
+        with open(path, 'rt') as file:
+            if file.read() == content:
+                return False
+    except OSError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wt') as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+    return True
+
+
+def build_metric(df, metric, directory=TILES_DIR, tz=None, digits=4):
+    """Writes the tiles of one metric and returns its entry for index.json.
+
+    Tiles left over from earlier builds that no longer have data are removed.
+
+    Arguments:
+    df - a dataframe from common.get_XX_dataframe(...) or an archive; for ping, also hourly counts from rollup.py
+    metric - 'bandwidth', 'jitter', 'latency' or 'ping'
+    directory - the directory the tiles are written to
+    tz - the timezone whose midnights divide days
+    digits - the number of decimal places kept
+    """
+    metric_dir = os.path.join(directory, metric)
+    entry = {'label': METRICS[metric][2], 'series': [], 'tiles': {}, 'start': None, 'end': None}
+    paths = set()
+    written = 0
+    for level, bucket, span in LEVELS:
+        table = aggregate(df, metric, level, tz)
+        if not len(table):
+            continue
+        starts = table.index.get_level_values('start')
+        entry['start'] = int(starts.min()) if entry['start'] is None else min(entry['start'], int(starts.min()))
+        entry['end'] = int(starts.max()) + bucket if entry['end'] is None else max(entry['end'], int(starts.max()) + bucket)
+        tile_starts = starts // span * span
+        for (series, tile), tile_table in table.groupby([table.index.get_level_values('series'), tile_starts]):
+            content = json.dumps({
+                'start': int(tile), 'bucket': bucket,
+                't': tile_table.index.get_level_values('start').tolist(),
+                'value': _list(tile_table.loc[:, 'value'].values, digits),
+                'min': _list(tile_table.loc[:, 'min'].values, digits),
+                'max': _list(tile_table.loc[:, 'max'].values, digits),
+                'count': tile_table.loc[:, 'count'].astype(int).tolist(),
+            }, separators=(',', ':'))
+            path = os.path.join(metric_dir, series, level, '{}.json'.format(int(tile)))
+            paths.add(path)
+            written += _write_if_changed(path, content)
+            entry['tiles'].setdefault(level, {}).setdefault(series, []).append(int(tile))
+    entry['series'] = sorted(entry['tiles'].get('hour', {}), key=lambda key: [int(part) if part.isdigit() else part
+                                                                               for part in key.split('-')])
+    for root, _, files in os.walk(metric_dir):
+        for name in files:
+            if os.path.join(root, name) not in paths:
+                os.remove(os.path.join(root, name))
+    print("{}: {} tiles, {} rewritten".format(metric, len(paths), written))
+    return entry
+
+
+def build(frames, directory=TILES_DIR, nanopi_names=None, tz=None):
+    """Writes the tiles of several metrics, their index and the viewer.
+
+    Arguments:
+    frames - a dict where the keys are metrics and the values are their dataframes
+    directory - the directory the tiles are written to
+    nanopi_names - a dict where the keys are nanopi IDs and the values are the names you want in the viewer,
+                   or a nanopi_registry.Registry
+    tz - the timezone whose midnights divide days, also used for the times shown in the viewer;
+         defaults to common.TIMEZONE
+    """
+    tz = tz or common.TIMEZONE
+    index = {'tz': tz, 'generated': int(time.time() * 1000),
+             'levels': [{'name': level, 'bucket': bucket, 'span': span} for level, bucket, span in LEVELS],
+             'metrics': {}, 'names': {}}
+    for metric, df in frames.items():
+        index['metrics'][metric] = build_metric(df, metric, directory, tz)
+    if nanopi_names:
+        ids = sorted({int(key.split('-')[0]) for entry in index['metrics'].values() for key in entry['series']})
+        index['names'] = dict(zip((str(nanopi_id) for nanopi_id in ids), nanopi_registry.labels(nanopi_names, ids)))
+    _write_if_changed(os.path.join(directory, 'index.json'), json.dumps(index, separators=(',', ':')))
+    shutil.copyfile(VIEWER, os.path.join(directory, 'viewer.html'))
+    return index
+
+
+def serve(directory=TILES_DIR, host='127.0.0.1', port=8002):
+    """Serves the tiles and the viewer over HTTP until interrupted."""
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    print("Serving the viewer at http://{}:{}/viewer.html".format(host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    import archive
+
+    parser = argparse.ArgumentParser(description="Writes zoomable multi-resolution tiles of the archived data.")
+    parser.add_argument('metrics', nargs='*', default=list(METRICS), help="metrics to write tiles of")
+    parser.add_argument('-d', dest='data', default='data', help="data directory written by ./cli.py fetch (default: data)")
+    parser.add_argument('-o', dest='output', default=TILES_DIR, help="directory to write tiles to (default: {})".format(TILES_DIR))
+    parser.add_argument('--serve', dest='port', type=int, default=None, help="serve the viewer on this port afterwards")
+    args = parser.parse_args()
+
+    frames = {}
+    for metric in args.metrics:
+        if metric == 'ping':
+            frames[metric] = rollup.load(os.path.join(args.data, 'rollup'), os.path.join(args.data, 'archive')).hourly()
+        else:
+            frames[metric] = archive.Archive(metric, os.path.join(args.data, 'archive')).to_dataframe()
+    nanopi_names = nanopi_registry.load(path=os.path.join(args.data, 'nanopis.json'))
+    build(frames, args.output, nanopi_names)
+    if args.port is not None:
+        serve(args.output, port=args.port)
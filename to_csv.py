@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 
 # Pulls data from the API (not directly from the sqlite database),
-# formats/processes it, and writes it to /home/ubuntu/data/ .
+# formats/processes it, and writes it to the site's sync_dir (/home/ubuntu/data/ by default; see config.py).
+# The metrics are written as <metric>.csv, or, if the site's export_format is 'compact'
+# (e.g. LLV_EXPORT_FORMAT=compact), as compact gzipped <metric>.csv.gz files (see export.py):
+# hours with no data are left out, and pd.read_csv(...) reads the files directly.
+# The file of the other format is removed, so that nobody keeps reading a stale one.
+# The anomalous intervals of each metric (see anomaly.py) go in <metric>_anomalies.csv.
+# LLV_SITE chooses the site when llv.ini has several.
 
 import os
+import sys
 import datetime
-import requests
 import pandas as pd
+import config
+import export
+import anomaly
 from common import (
+    fetch_all,
     get_bandwidth_dataframe,
     get_jitter_dataframe,
     get_latency_dataframe,
@@ -17,12 +27,35 @@ from common import (
 with open('log.txt', 'at') as file:
     file.write("Ran at {}\n".format(datetime.datetime.now()))
 
-data_dir = '/home/ubuntu/data'
-username = "admin"
-password = "Atmop*8twtiwytd"
-auth = requests.auth.HTTPBasicAuth(username, password)
+site = config.get().apply()
+data_dir = site.sync_dir
+try:
+    # run by cron, so there is nobody to ask for credentials
+    auth = site.auth(interactive=False)
+except ValueError as e:
+    sys.exit(str(e))
+if site.export_format not in ('plain', 'compact'):
+    raise ValueError("export_format must be 'plain' or 'compact', not {}".format(site.export_format))
 
-pd.DataFrame(get_nanopi_list(auth)).to_csv(os.path.join(data_dir, 'nanopis.csv'))
-get_bandwidth_dataframe(auth).to_csv(os.path.join(data_dir, 'bandwidth.csv'))
-get_jitter_dataframe(auth).to_csv(os.path.join(data_dir, 'jitter.csv'))
-get_latency_dataframe(auth).to_csv(os.path.join(data_dir, 'latency.csv'))
+
+def export_metric(metric, df):
+    base = os.path.join(data_dir, metric)
+    if site.export_format == 'compact':
+        export.write(df, base)
+        stale_path = base + '.csv'
+    else:
+        df.to_csv(base + '.csv')
+        stale_path = base + '.csv.gz'
+    if os.path.exists(stale_path):
+        os.remove(stale_path)
+    anomaly.intervals(anomaly.detect(df)).to_csv(os.path.join(data_dir, '{}_anomalies.csv'.format(metric)),
+                                                 index=False)
+
+
+# the endpoints are independent, so fetch them all at once
+fetch_all([
+    ('nanopis', lambda: pd.DataFrame(get_nanopi_list(auth)).to_csv(os.path.join(data_dir, 'nanopis.csv'))),
+    ('bandwidth', lambda: export_metric('bandwidth', get_bandwidth_dataframe(auth))),
+    ('jitter', lambda: export_metric('jitter', get_jitter_dataframe(auth))),
+    ('latency', lambda: export_metric('latency', get_latency_dataframe(auth))),
+])